@@ -4,9 +4,18 @@ import time
 
 import cv.CV_GUI_Handler
 import cv.CV_Video_Capture_Handler
+from cv.Fiducials import FiducialLayout, locate_data_area
 from cv.ImageProcessing import *
+from cv.ScreenDetector import detect_screen, get_detection_range, refine_corners
+from cv.SymbolClassifier import SymbolClassifier
+from rcvr.clock_recovery import ClockRecovery
 from utils import Constants
+from utils.CalibrationProfile import CalibrationProfile, get_profile_key, load_profile, save_profile
+from utils.Instrumentation import Instrumentation, write_chrome_trace, write_prometheus_text
+from utils.Modulation import get_candidates, get_evenly_spaced_hues
+from utils.SymbolCodec import get_num_symbols
 from utils.Symbols import *
+from utils.VirtualClock import RealClock
 
 
 class State_Machine(object):
@@ -15,9 +24,33 @@ class State_Machine(object):
     CONVERGENCE_BOUND_THRESHOLD = 15
     CONVERGENCE_THRESHOLD = 10000
     BLACK_THRESHOLD = 200000
+    # Period at which the capture is polled until its first frame
+    FRAME_WAIT_PERIOD = 0.01
+
+    def __init__(self, cap=None, cv_handler=None, name=None):
+        """
+        :param cap: capture backend of the link (by default, the first camera, or the simulated camera)
+        :param cv_handler: display backend of the link (by default, a full screen window, or the simulated screen)
+        :param name: name of the state machine in the instrumentation, e.g. to tell the links apart
+        """
+        # All the time measurements and sleeps go through the clock, which is virtual in the headless simulation
+        self.clock = Constants.CLOCK if Constants.CLOCK is not None else RealClock()
+        self.state_times = {}
+        self.last_state = None
+        self.last_state_time = None
+        self.instrumentation = Instrumentation(name if name is not None else type(self).__name__.lower(),
+                                               enabled=Constants.INSTRUMENTATION)
 
-    def __init__(self):
         self.clock_start = -1
+        self.symbol_period = State_Machine.TRANSMISSION_RATE
+        # Data modulation, which can be changed after the calibration. The hues are copied, so that the receiver
+        # calibration of its references does not change the hues displayed by the transmitter
+        self.num_bits = NUM_BITS
+        self.symbols = SYMBOLS.copy()
+        # Hues of the NO ACK and ACK symbols of the peer screen as seen by the camera, the displayed hues until they
+        # are calibrated
+        self.ack_hues = np.float64([S_NO_ACK, S_ACK])
+        self.clock_recovery = None
         self.tick_count = 0
         self.log_count = 0
         self.capture_count = 0
@@ -31,26 +64,32 @@ class State_Machine(object):
             self.screen_mask = None
         else:
             self.screen_boundaries = None
+            self.screen_corners = None
             self.SYMBOL_ZERO_REF = None
             self.SYMBOL_ONE_REF = None
             self.ACK_REF = None
             self.NO_ACK_REF = None
             self.VOID_REF = None
 
-        if Constants.SIMULATE:
-            self.cv_handler = None
-            self.cap = None
-        else:
-            self.cv_handler = cv.CV_GUI_Handler.OpenCvHandler()
-            self.cap = cv.CV_Video_Capture_Handler.CV_Video_Capture_Handler()
+        # Calibration profile of this side, loaded once the capture and display backends are known
+        self.profile_key = None
+        self.profile = None
+
+        self.cv_handler = cv_handler
+        self.cap = cap
+        if not Constants.SIMULATE:
+            if self.cv_handler is None:
+                self.cv_handler = cv.CV_GUI_Handler.OpenCvHandler()
+            if self.cap is None:
+                self.cap = cv.CV_Video_Capture_Handler.CV_Video_Capture_Handler()
 
     def compute_screen_mask(self, color_range):
         converged = False
-        ret, frame = self.cap.readHSVFrame()
+        frame = State_Machine.read_frame(self)
         prev_mask = getMask(frame, color_range)
 
         while not converged:
-            ret, frame = self.cap.readHSVFrame()
+            frame = State_Machine.read_frame(self)
             mask = getMask(frame, color_range)
 
             s = np.sum(mask)
@@ -67,7 +106,7 @@ class State_Machine(object):
             if not Constants.SIMULATE:
                 self.cv_handler.display_hsv_frame(
                     superimpose(self.NO_ACK_MASK, np.uint8(mask[::10, ::10])[..., np.newaxis]))
-            time.sleep(0.2)
+            self.clock.sleep(0.2)
 
         print("Synchronization OK")
 
@@ -77,112 +116,199 @@ class State_Machine(object):
         self.NO_ACK_MASK = SYMBOL_NO_ACK_REF * self.screen_mask
 
     def compute_screen_boundaries(self, color_target):
-        hue_target = color_target
-        saturation_target = 255
-        value_target = 255
-
-        max_delta_hue = 20
-        max_delta_saturation = 130
-        max_delta_value = 130
+        """
+        Detects the screen showing the given color, until its position is stable over two camera frames. Each frame
+        is searched on a coarse level with color ranges of increasing width, keeping the largest screen found, whose
+        corners are then refined at full resolution. Finer levels are only searched when the screen is too small to be
+        found on the coarse one. With the fiducial markers, the screen is localized from its finder patterns instead
+        
+        :param color_target: hue shown by the screen
+        :return: 
+        """
+        if Constants.FIDUCIAL_MARKERS:
+            corners, frame = State_Machine._locate_fiducial_screen(self, color_target)
+        else:
+            corners, frame = State_Machine._detect_color_screen(self, color_target)
+        State_Machine._set_screen(self, corners, frame)
+
+    def restore_screen(self, color_target) -> bool:
+        """
+        Warm start of the screen detection: waits until the screen corners of the calibration profile frame a screen
+        showing the given color, under the stored camera exposure. Other colors on the stored screen mean that the
+        peer is still in an earlier state, and are waited for as in the detection.
+
+        :param color_target: hue shown by the screen
+        :return: True if the stored screen was found, False if no screen was seen at the stored corners for
+        CALIBRATION_PROFILE_TIMEOUT seconds, in which case the screen must be detected. The stored corners staying
+        dark do not count, as the peer screen is dark until the peer starts.
+        """
+        corners = self.profile.screen_corners
+        self.cap.set_exposure_settings(self.profile.exposure)
+
+        last_seen_time = self.clock.time()
+        while self.clock.time() - last_seen_time < Constants.CALIBRATION_PROFILE_TIMEOUT:
+            self.clock.sleep(Constants.SCREEN_DETECTION_PERIOD)
+            frame = State_Machine.read_frame(self)
+            with self.instrumentation.timer("screen_detection"):
+                screen = State_Machine._get_screen(self, frame, corners)
+                hue_mean = State_Machine._get_screen_hue(self, screen)
+            if hue_mean is None:
+                if screen[:, :, 2].mean() < Constants.SCREEN_DARK_VALUE:
+                    last_seen_time = self.clock.time()
+                continue
+
+            last_seen_time = self.clock.time()
+            if np.sqrt(compute_cyclic_score(hue_mean, np.float64(color_target))) <= Constants.SCREEN_HUE_TOLERANCE:
+                logging.info("Stored screen found with hue " + str(round(hue_mean, 1)))
+                State_Machine._set_screen(self, corners, frame)
+                return True
+
+        logging.info("Stored screen not found, detecting the screen")
+        return False
+
+    def _set_screen(self, corners, frame):
+        """Locks the screen at the given corners, found in the given frame"""
+        self.screen_corners = corners
+        # Pixels whose center is inside the bounding box of the screen
+        self.screen_boundaries = (int(np.ceil(corners[:, 0].min())), int(np.floor(corners[:, 0].max())),
+                                  int(np.ceil(corners[:, 1].min())), int(np.floor(corners[:, 1].max())))
+        if Constants.DEBUG:
+            # Captured frames are read-only views of the capture buffer
+            frame = frame.copy()
+            cv2.polylines(frame, [np.int32(np.round(self.screen_corners))], True, (255, 255, 255), thickness=1)
+            cv2.imwrite("../captured.jpg", frame)
 
-        min_x = min_y = max_x = max_y = 0
+        State_Machine._compute_references_values(self)
 
-        iteration = 0
-        min_iteration = 0
+    def _detect_color_screen(self, color_target):
+        """:return: (outer screen corners, frame in which they were found)"""
+        detection_proportion = 200 if Constants.SIMULATE else Constants.DETECTION_PROPORTION
+        min_area = 30 if Constants.SIMULATE else 400
+        max_area = 30000
         max_iteration = 30
 
+        previous_corners = None
         converged = False
-
         while not converged:
-            time.sleep(0.2)
-            ret, frame = self.cap.readHSVFrame()
-
-            hue_delta_coeff = smooth_step(2.0 * iteration, min_iteration, max_iteration)
-            delta_coeff = smooth_step(iteration, min_iteration, max_iteration)
-            iteration = iteration + 1
-
-            min_hsv = np.array([u8clamp(hue_target - hue_delta_coeff * max_delta_hue),
-                                u8clamp(saturation_target - delta_coeff * max_delta_saturation),
-                                u8clamp(value_target - delta_coeff * max_delta_value)])
-
-            max_hsv = np.array([u8clamp(hue_target + hue_delta_coeff * max_delta_hue),
-                                u8clamp(saturation_target),
-                                u8clamp(value_target)])
-
-            logging.info("Iteration with min: " + str(min_hsv) + " and max: " + str(max_hsv))
-
-            frame_thresholded = getMask(frame, min_hsv, max_hsv)
-            # self.cv_handler.display_frame(frame_thresholded)
-            canny_frame = cv2.Canny(frame_thresholded, 50, 150, apertureSize=3)
-            contoured_frame, contours0, hierarchy = cv2.findContours(canny_frame, mode=cv2.RETR_EXTERNAL,
-                                                                     method=cv2.CHAIN_APPROX_SIMPLE)
-
-            # Approximate contour by multiple straight lines
-            contours = [cv2.approxPolyDP(cnt, 3, True) for cnt in contours0]
-
-            logging.info("Got " + str(len(contours)) + " contours")
-
-            if 10 > len(contours) > 0:
-
-                # Filter contours
-                most_beautiful_contour = None
-                max_area = 0
-
-                for cnt in contours:
-                    area = cv2.contourArea(cnt, oriented=False)
-
-                    cntmin_x = np.min(cnt[:, 0, 0])
-                    cntmax_x = np.max(cnt[:, 0, 0])
-                    cntmin_y = np.min(cnt[:, 0, 1])
-                    cntmax_y = np.max(cnt[:, 0, 1])
-
-                    from utils.Constants import DETECTION_PROPORTION
-                    if Constants.SIMULATE:
-                        DETECTION_PROPORTION = 200
-                    if (cntmin_x < WIDTH / DETECTION_PROPORTION or
-                                cntmin_y < HEIGHT / DETECTION_PROPORTION or
-                                cntmax_x > (WIDTH - WIDTH / DETECTION_PROPORTION) or
-                                cntmax_y > (HEIGHT - HEIGHT / DETECTION_PROPORTION)):
-                        print("Skipping contour, out of bounds")
-                        continue
-
-                    print("Contour area: " + str(area))
-                    if 30000 > area > (30 if Constants.SIMULATE else 400) and cv2.isContourConvex(cnt):
-                        if area > max_area:
-                            max_area = area
-                            most_beautiful_contour = cnt
-
-                if most_beautiful_contour is not None:
-                    # cv2.drawContours(frame, [most_beautiful_contour], -1, (255, 255, 255), thickness=2)
-                    # self.cv_handler.display_hsv_frame(frame)
-
-                    # Extract interesting portion of image
-                    newmin_x = np.min(most_beautiful_contour[:, 0, 0])
-                    newmax_x = np.max(most_beautiful_contour[:, 0, 0])
-                    newmin_y = np.min(most_beautiful_contour[:, 0, 1])
-                    newmax_y = np.max(most_beautiful_contour[:, 0, 1])
-
-                    d1 = abs(newmin_x - min_x)
-                    d2 = abs(newmin_y - min_y)
-                    d3 = abs(newmax_x - max_x)
-                    d4 = abs(newmax_y - max_y)
-
-                    if [d1, d2, d3, d4] < [State_Machine.CONVERGENCE_BOUND_THRESHOLD] * 4:
-                        converged = True
-                        cv2.rectangle(frame, (min_x, min_y), (max_x, max_y), (0, 255, 0), thickness=2)
-                        cv2.imwrite("../captured.jpg", frame)
-
-                    min_x = newmin_x + 1
-                    max_x = newmax_x
-                    min_y = newmin_y + 1
-                    max_y = newmax_y
-
-        self.screen_boundaries = (min_x, max_x, min_y, max_y)
-        State_Machine._compute_references_values(self)
+            self.clock.sleep(Constants.SCREEN_DETECTION_PERIOD)
+            frame = State_Machine.read_frame(self)
+            border = min(frame.shape[0], frame.shape[1]) / detection_proportion
+
+            with self.instrumentation.timer("screen_detection"):
+                corners = None
+                for level in range(Constants.SCREEN_DETECTION_PYRAMID_LEVELS, -1, -1):
+                    best_area = 0
+                    for iteration in np.linspace(0, max_iteration, Constants.SCREEN_DETECTION_RANGE_STEPS):
+                        min_hsv, max_hsv = get_detection_range(color_target, iteration, max_iteration)
+                        candidate = detect_screen(frame, min_hsv, max_hsv, level, min_area, max_area, border)
+                        if candidate is not None and cv2.contourArea(candidate) > best_area:
+                            corners = candidate
+                            corners_range = (min_hsv, max_hsv)
+                            best_area = cv2.contourArea(candidate)
+                    if corners is not None:
+                        break
+
+                if corners is None:
+                    logging.info("No screen found")
+                    continue
+                # The coarse corners are accurate to about the size of a coarse pixel
+                corners = refine_corners(frame, corners, corners_range[0], corners_range[1], 2 ** (level + 1))
+
+            logging.info("Screen found at " + str(np.round(corners, 1).tolist()) + " with range " +
+                         str(corners_range[0]) + " - " + str(corners_range[1]))
+            if previous_corners is not None and \
+                    np.abs(corners - previous_corners).max() < State_Machine.CONVERGENCE_BOUND_THRESHOLD:
+                converged = True
+            previous_corners = corners
+
+        return corners, frame
+
+    def _locate_fiducial_screen(self, color_target):
+        """
+        Localizes the data area of the screen from its finder patterns, in the first frame in which they are found and
+        the data area shows the given color, so that the screen of the peer is only accepted in the expected state
+
+        :return: (outer corners of the data area, frame in which they were found)
+        """
+        layout = FiducialLayout(cv.CV_GUI_Handler.WIDTH, cv.CV_GUI_Handler.HEIGHT, True, Constants.FIDUCIAL_SIZE)
+        while True:
+            self.clock.sleep(Constants.SCREEN_DETECTION_PERIOD)
+            frame = State_Machine.read_frame(self)
+
+            with self.instrumentation.timer("screen_detection"):
+                corners = locate_data_area(frame, layout, Constants.FIDUCIAL_MIN_AREA)
+                if corners is None:
+                    logging.info("No finder patterns found")
+                    continue
+                hue_mean = State_Machine._get_screen_hue(self, State_Machine._get_screen(self, frame, corners))
+
+            logging.info("Data area found at " + str(np.round(corners, 1).tolist()) + " with hue " + str(hue_mean))
+            if hue_mean is not None and \
+                    np.sqrt(compute_cyclic_score(hue_mean, np.float64(color_target))) <= Constants.SCREEN_HUE_TOLERANCE:
+                return corners, frame
+
+    def _get_screen(self, frame, corners):
+        """HSV screen framed by the given corners, rectified to RECTIFIED_WIDTH x RECTIFIED_HEIGHT"""
+        width = Constants.RECTIFIED_WIDTH
+        height = Constants.RECTIFIED_HEIGHT
+        return warp(frame, get_rectifying_homography(corners, width, height), width, height)
+
+    def _get_screen_hue(self, screen):
+        """
+        :param screen: rectified HSV screen
+        :return: circular hue mean of the screen, or None if it does not show a single color, i.e. if it is dark or not
+        saturated, or if the hue of one of its 3x3 parts differs from the mean by more than SCREEN_HUE_TOLERANCE
+        """
+        # A dark screen has no meaningful hue, so the colors are only compared on saturated and bright screens (as
+        # the widest color detection range)
+        if screen[:, :, 1].mean() < 125 or screen[:, :, 2].mean() < 125:
+            return None
+
+        hue_mean = compute_grid_cyclic_hue_means(screen, 1, 1, Constants.GRID_CELL_MARGIN)[0, 0]
+        part_hues = compute_grid_cyclic_hue_means(screen, 3, 3, Constants.GRID_CELL_MARGIN)
+        if np.sqrt(compute_cyclic_score(part_hues, hue_mean)).max() > Constants.SCREEN_HUE_TOLERANCE:
+            return None
+        return hue_mean
+
+    def load_calibration_profile(self):
+        """Loads the calibration profile of this side for its camera and display, when the profiles are enabled"""
+        if Constants.CALIBRATION_PROFILE is None:
+            return
+        self.profile_key = get_profile_key(self.instrumentation.name, self.cap.get_camera_name(),
+                                           self.cv_handler.get_display_name())
+        self.profile = load_profile(Constants.CALIBRATION_PROFILE, self.profile_key)
+        logging.info(("Loaded" if self.profile is not None else "No") + " calibration profile " + self.profile_key)
+
+    def save_calibration_profile(self, symbols, spreads=None, ack_hues=None):
+        """
+        Stores the current screen corners, modulation and camera exposure in the calibration profile of this side
+
+        :param symbols: hue centroid of each symbol
+        :param spreads: hue spread of each symbol, 0 for the symbols that were not measured
+        :param ack_hues: (NO ACK hue, ACK hue) seen by the camera
+        :return:
+        """
+        if self.profile_key is None:
+            return
+        self.profile = CalibrationProfile(self.screen_corners, self.num_bits, self.symbol_period, symbols, spreads,
+                                          ack_hues, self.cap.get_exposure_settings())
+        save_profile(Constants.CALIBRATION_PROFILE, self.profile_key, self.profile)
+        logging.info("Saved calibration profile " + self.profile_key)
+
+    def set_capture_screen(self):
+        """Registers the detected screen on the capture side, either as a homography or as a bounding box crop"""
+        if Constants.USE_HOMOGRAPHY:
+            self.cap.set_screen_corners(self.screen_corners)
+        else:
+            self.cap.set_screen_boundaries(self.screen_boundaries)
 
     def _compute_references_values(self):
-        dx = self.screen_boundaries[1] - self.screen_boundaries[0] + 1
-        dy = self.screen_boundaries[3] - self.screen_boundaries[2] + 1
+        if Constants.USE_HOMOGRAPHY:
+            dx = Constants.RECTIFIED_WIDTH
+            dy = Constants.RECTIFIED_HEIGHT
+        else:
+            dx = self.screen_boundaries[1] - self.screen_boundaries[0] + 1
+            dy = self.screen_boundaries[3] - self.screen_boundaries[2] + 1
 
         self.SYMBOL_ONE_REF = np.full((dy, dx, 3), fill_value=[S_ONE, 255, 255], dtype=np.uint8)
         self.SYMBOL_ZERO_REF = np.full((dy, dx, 3), fill_value=[S_ZERO, 255, 255], dtype=np.uint8)
@@ -191,7 +317,7 @@ class State_Machine(object):
         self.VOID_REF = np.full((dy, dx, 3), fill_value=[S_VOID, 0, 0], dtype=np.uint8)
 
     def get_masked_ack_scores(self):
-        ret, frame = self.cap.readHSVFrame()
+        frame = State_Machine.read_frame(self)
         masked_frame = frame * self.screen_mask
 
         ack_score = compute_score(masked_frame, self.ACK_MASK)
@@ -202,13 +328,29 @@ class State_Machine(object):
     def get_ack_scores(self):
         hue_mean = self.get_hue_mean()
         logging.info("Hue mean for ack score computation is: " + str(hue_mean))
-        ack_score = compute_cyclic_score(hue_mean, np.float64(S_ACK))
-        no_ack_score = compute_cyclic_score(hue_mean, np.float64(S_NO_ACK))
+        ack_score = compute_cyclic_score(hue_mean, self.ack_hues[1])
+        no_ack_score = compute_cyclic_score(hue_mean, self.ack_hues[0])
 
         return ack_score, no_ack_score
 
+    def get_sync_scores(self):
+        """
+        :return: (ACK score, NO ACK score, warm start ACK score) of the peer screen, the lowest being the closest. A
+        dark screen, e.g. before the peer displays anything, has no meaningful hue, and is scored as NO ACK
+        """
+        frame = State_Machine.read_frame(self)
+        hue_mean = frame[:, :, 0].mean()
+        if frame[:, :, 1].mean() < 125 or frame[:, :, 2].mean() < 125:
+            hue_mean = self.ack_hues[0]
+        logging.info("Hue mean for ack score computation is: " + str(hue_mean))
+        ack_score = compute_cyclic_score(hue_mean, self.ack_hues[1])
+        no_ack_score = compute_cyclic_score(hue_mean, self.ack_hues[0])
+        warm_ack_score = compute_cyclic_score(hue_mean, np.float64(S_WARM_ACK))
+
+        return ack_score, no_ack_score, warm_ack_score
+
     def get_masked_symbols_scores(self, first_symbol, second_symbol):
-        ret, frame = self.cap.readHSVFrame()
+        frame = State_Machine.read_frame(self)
         masked_frame = frame * self.screen_mask
 
         first_score = compute_score(masked_frame, first_symbol)
@@ -217,7 +359,7 @@ class State_Machine(object):
         return first_score, second_score
 
     def get_symbols_scores(self, first_symbol, second_symbol):
-        ret, frame = self.cap.readHSVFrame()
+        frame = State_Machine.read_frame(self)
 
         first_score = compute_score(frame, first_symbol)
         second_score = compute_score(frame, second_symbol)
@@ -234,7 +376,7 @@ class State_Machine(object):
         return self._get_mean(2)
 
     def _get_mean(self, i):
-        ret, frame = self.cap.readHSVFrame()
+        frame = State_Machine.read_frame(self)
 
         if Constants.DEBUG:
             cvtframe = cv2.cvtColor(frame, cv2.COLOR_HSV2BGR)
@@ -247,13 +389,12 @@ class State_Machine(object):
         return self._compute_mean(self, frame, 0)
 
     def get_cyclic_hue_mean_to_reference(self, ref):
-        ret, frame = self.cap.readHSVFrame()
+        frame = State_Machine.read_frame(self)
         return self.compute_cyclic_hue_mean_to_reference(frame, ref)
 
     def compute_cyclic_hue_mean_to_reference(self, frame, ref):
-        ret, frame = self.cap.readHSVFrame()
-
-        delta = 90 - ref
+        # The reference may be a uint8 hue, which must not wrap around
+        delta = 90 - int(ref)
 
         adjusted_frame = (np.int32(frame[:, :, 0]) + delta) % 180
 
@@ -277,24 +418,223 @@ class State_Machine(object):
     def _compute_mean(self, frame, i):
         return frame[:, :, i].mean()
 
+    def record_state_time(self):
+        """Accumulates the time spent in the previous state, to be called at each iteration of the run loop"""
+        current_time = self.clock.time()
+        if self.last_state is not None:
+            self.state_times[self.last_state] = self.state_times.get(self.last_state, 0.0) + \
+                                                current_time - self.last_state_time
+        self.last_state = self.state
+        self.last_state_time = current_time
+        self.instrumentation.set_state(self.state.value)
+
+    def export_instrumentation(self):
+        """Writes the instrumentation of the state machine, if an output is configured"""
+        self.instrumentation.close()
+        if Constants.INSTRUMENTATION and Constants.INSTRUMENTATION_OUTPUT is not None:
+            file_prefix = Constants.INSTRUMENTATION_OUTPUT + "_" + self.instrumentation.name
+            write_chrome_trace(file_prefix + ".json", [self.instrumentation])
+            write_prometheus_text(file_prefix + ".prom", [self.instrumentation])
+
+    def get_symbols_per_tick(self) -> int:
+        """In grid mode, each cell of the screen carries one symbol per tick"""
+        if Constants.GRID_MODE:
+            return Constants.GRID_ROWS * Constants.GRID_COLS
+        return 1
+
+    def get_symbol_start_time(self):
+        """Time at which the symbol of the current tick starts to be seen by the camera"""
+        return self.clock_start - State_Machine.SAMPLING_OFFSET + self.tick_count * self.symbol_period
+
+    def get_symbol_middle_time(self):
+        """Time at the middle of the symbol period of the current tick, as seen by the camera"""
+        return State_Machine.get_symbol_start_time(self) + 0.5 * self.symbol_period
+
+    def read_frame(self) -> np.ndarray:
+        """Reads the latest captured frame, waiting for the first frame to be captured if needed"""
+        ret, frame = self.cap.readHSVFrame()
+        while not ret:
+            self.clock.sleep(State_Machine.FRAME_WAIT_PERIOD)
+            ret, frame = self.cap.readHSVFrame()
+        return frame
+
+    def read_symbol_frame(self):
+        """
+        Reads the captured frame that is the closest to the middle of the current symbol period, waiting for it to
+        be captured if needed
+        
+        :return: 
+        """
+        middle_time = State_Machine.get_symbol_middle_time(self)
+        self.clock.sleep(middle_time - self.clock.time())
+
+        with self.instrumentation.timer("frame_read"):
+            ret, frame = self.cap.readHSVFrameAt(middle_time)
+        if not ret:
+            frame = State_Machine.read_frame(self)
+        return True, frame
+
+    def read_symbol_frames(self):
+        """
+        Reads all the frames captured during the stable part of the current symbol period, i.e. without the
+        frames captured within INTEGRATION_GUARD symbol periods of a transition. Waits until the end of that
+        part of the symbol period.
+        
+        :return: list of HSV frames, containing at least one frame
+        """
+        symbol_start = State_Machine.get_symbol_start_time(self)
+        start_time = symbol_start + Constants.INTEGRATION_GUARD * self.symbol_period
+        end_time = symbol_start + (1.0 - Constants.INTEGRATION_GUARD) * self.symbol_period
+
+        self.clock.sleep(end_time - self.clock.time())
+
+        with self.instrumentation.timer("frame_read"):
+            frames = self.cap.readHSVFramesBetween(start_time, end_time)
+            if len(frames) == 0:
+                ret, frame = self.cap.readHSVFrameAt((start_time + end_time) / 2.0)
+                frames = [frame if ret else State_Machine.read_frame(self)]
+
+        return frames
+
+    def get_symbols_per_packet(self) -> int:
+        return get_num_symbols(Constants.RS_packet_size, self.num_bits)
+
+    def get_ticks_per_packet(self) -> int:
+        return int(np.ceil(State_Machine.get_symbols_per_packet(self) / State_Machine.get_symbols_per_tick(self)))
+
+    def is_pilot_slot(self, slot) -> bool:
+        """Whether the given packet slot of the sliding window carries pilot symbols instead of a packet"""
+        return Constants.SLIDING_WINDOW and Constants.SYMBOL_TRACKING and Constants.TRACKING_PILOT_INTERVAL > 0 and \
+               (slot + 1) % Constants.TRACKING_PILOT_INTERVAL == 0
+
+    def get_pilot_symbols(self) -> np.ndarray:
+        """Symbols of a pilot slot: all the symbols of the constellation in turn"""
+        return np.arange(State_Machine.get_symbols_per_packet(self)) % len(self.symbols)
+
+    def set_modulation(self, num_bits, symbol_period):
+        """
+        Switches to the evenly spaced constellation of 2^num_bits hues and to the given symbol period, from the
+        current tick on. Both sides must switch at the same tick.
+
+        :param num_bits:
+        :param symbol_period:
+        :return:
+        """
+        self.num_bits = num_bits
+        self.symbols = get_evenly_spaced_hues(2 ** num_bits)
+
+        # The current tick keeps its time, and the next ones follow at the new period
+        tick_time = self.clock_start + self.tick_count * self.symbol_period
+        if self.clock_recovery is not None:
+            self.clock_recovery.set_period(self.tick_count, symbol_period)
+        self.symbol_period = symbol_period
+        self.clock_start = tick_time - self.tick_count * symbol_period
+        logging.info("Switched to " + str(num_bits) + " bits per symbol, with a symbol period of " +
+                     str(symbol_period) + " s")
+
+    def send_choice_bits(self, bits):
+        """Shows each bit for MODULATION_CHOICE_TICKS ticks, as ACK for 1 and NO ACK for 0, and then blacks out"""
+        for bit in bits:
+            self.cv_handler.display_hsv_color(S_ACK if bit else S_NO_ACK)
+            for x in range(0, Constants.MODULATION_CHOICE_TICKS):
+                State_Machine.sleep_until_next_tick(self)
+        self.cv_handler.black_out()
+
+    def read_choice_bits(self, count) -> list:
+        """
+        Reads the bits shown by the peer with send_choice_bits, classified against the ACK hues seen by the camera
+
+        :param count: number of bits
+        :return: list of the bits
+        """
+        ack_classifier = SymbolClassifier(self.ack_hues)
+        bits = []
+        for i in range(0, count):
+            hold_start = self.clock.time()
+            for x in range(0, Constants.MODULATION_CHOICE_TICKS - 1):
+                State_Machine.sleep_until_next_tick(self)
+
+            # The first and last ticks of the bit are skipped, as the camera sees the peer screen with a delay and the
+            # ticks of both sides are only aligned to about a tick
+            with self.instrumentation.timer("frame_read"):
+                frames = self.cap.readHSVFramesBetween(hold_start + self.symbol_period, self.clock.time())
+                if len(frames) == 0:
+                    frames = [State_Machine.read_frame(self)]
+            bits.append(ack_classifier.classify_frames(frames)[0])
+            State_Machine.sleep_until_next_tick(self)
+        return bits
+
+    def send_confirmation(self, confirmed):
+        """Confirms (ACK) or rejects (NO ACK) what the peer sent, with MODULATION_CONFIRMATION_BITS repeated bits"""
+        State_Machine.send_choice_bits(self, [1 if confirmed else 0] * Constants.MODULATION_CONFIRMATION_BITS)
+
+    def read_confirmation(self) -> bool:
+        """Reads the repeated bits of send_confirmation by majority, True if the peer confirmed"""
+        bits = State_Machine.read_choice_bits(self, Constants.MODULATION_CONFIRMATION_BITS)
+        return 2 * sum(bits) > len(bits)
+
+    def get_profile_choice(self):
+        """
+        Index of the modulation of the calibration profile among the candidates, the one with the same number of bits
+        and the closest symbol period, as the clock recovery of the receiver adjusts its symbol period
+
+        :return: the candidate index, None if no candidate has the number of bits of the profile
+        """
+        choices = [i for i, (num_bits, symbol_period) in enumerate(get_candidates())
+                   if num_bits == self.profile.num_bits]
+        if len(choices) == 0:
+            return None
+        return min(choices, key=lambda i: abs(get_candidates()[i][1] - self.profile.symbol_period))
+
+    def get_arq_feedback_cells(self) -> int:
+        """
+        Number of symbols of the sliding window feedback pattern: the cumulative ACK, and then the bitmap. The feedback
+        always uses the NUM_BITS constellation, whatever the data modulation
+        """
+        return 1 + int(np.ceil((Constants.ARQ_WINDOW_SIZE - 1) / NUM_BITS))
+
     def _align_clock(self):
-        curr_time = time.time()
+        curr_time = self.clock.time()
 
         # Delay clock towards a whole time to increase sleep relative precision
-        while curr_time - np.fix(curr_time) > 0.3:
-            curr_time = time.time()
+        if curr_time - np.fix(curr_time) > 0.3:
+            self.clock.sleep(math.ceil(curr_time) - curr_time)
+            curr_time = self.clock.time()
 
         # Align clock on whole time
         to_sleep = math.floor(curr_time + 1.0) - curr_time
         logging.info(curr_time)
-        time.sleep(to_sleep)
+        self.clock.sleep(to_sleep)
+
+    def start_clock_recovery(self, transition_time):
+        """
+        Starts tracking the transmitter clock from the captured frames, the transition with index 0 happening at the
+        given time. The clock is then updated at each tick.
+        
+        :param transition_time: 
+        :return: 
+        """
+        self.clock_recovery = ClockRecovery(transition_time - self.tick_count * self.symbol_period, self.symbol_period)
+        self.clock_recovery.update(self.cap.readHSVFramesSince(-1), self.cap.is_frame_valid)
+
+    def _recover_clock(self):
+        with self.instrumentation.timer("clock_recovery"):
+            self.clock_recovery.update(self.cap.readHSVFramesSince(self.clock_recovery.last_sequence_number),
+                                       self.cap.is_frame_valid)
+
+        # Ticks happen SAMPLING_OFFSET after the transition with the same index
+        self.symbol_period = self.clock_recovery.period
+        self.clock_start = self.clock_recovery.get_transition_time(0) + State_Machine.SAMPLING_OFFSET
 
     def sleep_until_next_tick(self):
+        if self.clock_recovery is not None:
+            State_Machine._recover_clock(self)
+
         self.tick_count = self.tick_count + 1
         self.log_count = self.log_count + 1
 
-        current_time = time.time()
-        sleep_amount = (self.tick_count * State_Machine.TRANSMISSION_RATE + self.clock_start) - current_time
+        current_time = self.clock.time()
+        sleep_amount = (self.tick_count * self.symbol_period + self.clock_start) - current_time
 
         if self.log_count > State_Machine.TRANSMISSION_RATE:
             self.log_count = 0
@@ -302,6 +642,10 @@ class State_Machine(object):
 
         if sleep_amount < 0:
             logging.warning("Skipping sleep time !")
+            self.instrumentation.count("skipped_ticks_total")
+            self.instrumentation.observe("tick_lateness_seconds", -sleep_amount)
             return
 
-        time.sleep(sleep_amount)
+        self.clock.sleep(sleep_amount)
+        # Wake up lateness, due to the sleep precision and the scheduler
+        self.instrumentation.observe("tick_lateness_seconds", self.clock.time() - current_time - sleep_amount)
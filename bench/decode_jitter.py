@@ -0,0 +1,93 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from bench.micro import get_synthetic_frame
+from cv.FrameRingBuffer import FrameRingBuffer
+from cv.SymbolClassifier import SymbolClassifier
+from rcvr.decode_process import DecodeProcess
+from utils.Symbols import SYMBOLS
+
+
+def _run_capture(frame, frame_buffer, frame_period, stop_event, latenesses):
+    """Capture loop writing a frame into the ring buffer every frame period, and recording how late it wakes up"""
+    next_time = time.perf_counter()
+    while not stop_event.is_set():
+        next_time += frame_period
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        latenesses.append(time.perf_counter() - next_time)
+        np.copyto(frame_buffer.get_write_slot(), frame)
+        frame_buffer.publish(time.time())
+
+
+def run(frame, rows, cols, frames_per_tick, fps, duration, use_process) -> dict:
+    """
+    Runs a capture thread at the given frame rate while the main thread decodes a grid tick every frames_per_tick
+    frames, in the same process or in the decode process
+
+    :return: percentiles of the capture lateness (in ms), and the number of decoded ticks per second
+    """
+    frame_buffer = FrameRingBuffer(4 * frames_per_tick, frame.shape)
+    stop_event = threading.Event()
+    latenesses = []
+    classifier = SymbolClassifier(SYMBOLS)
+    decode_process = DecodeProcess(frame.shape, rows * cols, 4 * frames_per_tick, 8) if use_process else None
+
+    capture_thread = threading.Thread(target=_run_capture,
+                                      args=(frame, frame_buffer, 1.0 / fps, stop_event, latenesses))
+    capture_thread.start()
+
+    tick_period = frames_per_tick / fps
+    start_time = time.perf_counter()
+    tick_count = 0
+    while time.perf_counter() - start_time < duration:
+        time.sleep(max(0.0, start_time + (tick_count + 1) * tick_period - time.perf_counter()))
+        frames = [f for s, t, f in frame_buffer.read_since(frame_buffer.last_sequence_number - frames_per_tick)]
+        if len(frames) == 0:
+            continue
+        if decode_process is not None:
+            decode_process.submit(tick_count, frames, SYMBOLS, rows, cols)
+            # The result of the previous tick is collected while the current one is decoded
+            if tick_count > 0:
+                decode_process.get_result(tick_count - 1)
+        else:
+            classifier.classify_hues(classifier.compute_grid_hues(frames, rows, cols))
+        tick_count += 1
+
+    stop_event.set()
+    capture_thread.join()
+    if decode_process is not None:
+        decode_process.get_result(tick_count - 1)
+        decode_process.close()
+
+    latenesses = 1000.0 * np.array(latenesses)
+    return {'p50': np.percentile(latenesses, 50), 'p99': np.percentile(latenesses, 99), 'max': latenesses.max(),
+            'ticks_per_second': tick_count / (time.perf_counter() - start_time)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the capture timing jitter caused by the symbol decoding, "
+                                                 "with the decoding in the capture process and in a decode process")
+    parser.add_argument('--size', default='1920x1080', help="frame size, as WIDTHxHEIGHT")
+    parser.add_argument('--grid', default='4x4', help="grid size, as ROWSxCOLS")
+    parser.add_argument('--frames-per-tick', type=int, default=4, help="number of frames integrated per tick")
+    parser.add_argument('--fps', type=float, default=60.0, help="capture frame rate")
+    parser.add_argument('--duration', type=float, default=5.0, help="duration of each run, in seconds")
+    args = parser.parse_args()
+
+    width, height = [int(v) for v in args.size.split('x')]
+    rows, cols = [int(v) for v in args.grid.split('x')]
+    frame = get_synthetic_frame(width, height)
+    for use_process in (False, True):
+        result = run(frame, rows, cols, args.frames_per_tick, args.fps, args.duration, use_process)
+        print(("decode process" if use_process else "in process    ") + ": capture lateness p50 " +
+              str(round(result['p50'], 2)) + " ms, p99 " + str(round(result['p99'], 2)) + " ms, max " +
+              str(round(result['max'], 2)) + " ms, " + str(round(result['ticks_per_second'], 1)) + " ticks/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import json
+import timeit
+import tracemalloc
+import types
+
+import cv2
+import numpy as np
+
+from State_Machine import State_Machine
+from cv.ImageProcessing import compute_grid_cyclic_hue_means, compute_score, crop, getMask, \
+    get_rectifying_homography, warp
+from cv.ScreenDetector import detect_screen, refine_corners
+from cv.SymbolClassifier import SymbolClassifier
+from cv.SymbolRenderer import SymbolRenderer
+from utils import Constants
+from utils.Symbols import SYMBOLS
+
+DEFAULT_SIZES = ['640x480', '1920x1080']
+
+
+def get_synthetic_frame(width, height, hue=80, noise=4.0, seed=0) -> np.ndarray:
+    """HSV frame of a screen showing the given hue, with gaussian noise on all the channels"""
+    rng = np.random.default_rng(seed)
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:, :, 0] = np.round(hue + rng.normal(0.0, noise, (height, width))) % 180
+    frame[:, :, 1:] = np.clip(np.round(230 + rng.normal(0.0, noise, (height, width, 2))), 0, 255)
+    return frame
+
+
+def get_hsv_grid_frame(color_matrix, height, width):
+    """
+    Builds an HSV frame tiled with a grid of hues, with one cell per entry of the color matrix. Reference of the cell
+    layout of SymbolRenderer, which replaced it in the display backends
+
+    :param color_matrix: 2D array of hues, of shape (rows, cols)
+    :param height: height of the frame
+    :param width: width of the frame
+    :return:
+    """
+    rows, cols = np.shape(color_matrix)
+    cell_height = height // rows
+    cell_width = width // cols
+
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    for r in range(0, rows):
+        for c in range(0, cols):
+            frame[r * cell_height: (r + 1) * cell_height, c * cell_width: (c + 1) * cell_width, :] = \
+                [color_matrix[r][c], 255, 255]
+
+    return frame
+
+
+def _find_contours(frame, min_hsv, max_hsv):
+    """One iteration of the full resolution screen detection, before the coarse level search"""
+    canny_frame = cv2.Canny(getMask(frame, min_hsv, max_hsv), 50, 150, apertureSize=3)
+    contoured_frame, contours, hierarchy = cv2.findContours(canny_frame, mode=cv2.RETR_EXTERNAL,
+                                                            method=cv2.CHAIN_APPROX_SIMPLE)
+    return [cv2.approxPolyDP(cnt, 3, True) for cnt in contours]
+
+
+def _get_benchmarks(frame):
+    """
+    Hot path functions run on each captured frame, grouped by the computation they perform. The first function
+    of each group is the baseline, the next ones are variants computing the same result.
+
+    :return: list of (group, name, function without arguments)
+    """
+    height, width = frame.shape[:2]
+    reference_frame = np.full(frame.shape, [SYMBOLS[4], 255, 255], dtype=np.uint8)
+    min_hsv = np.array([SYMBOLS[4] - 10, 100, 100], dtype=np.uint8)
+    max_hsv = np.array([SYMBOLS[4] + 10, 255, 255], dtype=np.uint8)
+    boundaries = (width // 4, 3 * width // 4, height // 4, 3 * height // 4)
+    corners = np.float32([[width // 4, height // 4], [3 * width // 4, height // 4],
+                          [3 * width // 4, 3 * height // 4], [width // 4, 3 * height // 4]])
+    homography = get_rectifying_homography(corners, Constants.RECTIFIED_WIDTH, Constants.RECTIFIED_HEIGHT)
+    # Screen in the middle of the frame, on a black background
+    levels = Constants.SCREEN_DETECTION_PYRAMID_LEVELS
+    screen_frame = np.zeros_like(frame)
+    screen_frame[height // 4:3 * height // 4, width // 4:3 * width // 4] = crop(frame, boundaries)[:-1, :-1]
+    classifier = SymbolClassifier(SYMBOLS)
+    renderer = SymbolRenderer(width, height)
+    symbol_indices = np.arange(Constants.GRID_ROWS * Constants.GRID_COLS).reshape(Constants.GRID_ROWS,
+                                                                                  Constants.GRID_COLS) % len(SYMBOLS)
+
+    # State machine methods are run on a stub holding the frame source
+    state_machine = types.SimpleNamespace(cap=types.SimpleNamespace(readHSVFrame=lambda: (True, frame)),
+                                          capture_count=0)
+
+    return [
+        ('mask', 'getMask', lambda: getMask(frame, min_hsv, max_hsv)),
+        ('score', 'compute_score', lambda: compute_score(frame, reference_frame)),
+        ('frame score', 'State_Machine.compute_cyclic_hue_frame_score',
+         lambda: State_Machine.compute_cyclic_hue_frame_score(state_machine, frame[:, :, 0], np.float64(SYMBOLS[4]))),
+        ('hue mean', 'State_Machine.compute_cyclic_hue_mean_to_reference',
+         lambda: State_Machine.compute_cyclic_hue_mean_to_reference(state_machine, frame, int(SYMBOLS[4]))),
+        ('hue mean', 'SymbolClassifier.compute_hue_mean', lambda: classifier.compute_hue_mean(frame)),
+        ('hue mean', 'compute_grid_cyclic_hue_means (1x1)', lambda: compute_grid_cyclic_hue_means(frame, 1, 1)),
+        ('value mean', 'State_Machine._get_mean', lambda: State_Machine._get_mean(state_machine, 2)),
+        ('screen extraction', 'crop', lambda: crop(frame, boundaries)),
+        ('screen extraction', 'warp', lambda: warp(frame, homography, Constants.RECTIFIED_WIDTH,
+                                                  Constants.RECTIFIED_HEIGHT)),
+        ('screen detection', 'getMask + Canny + findContours', lambda: _find_contours(screen_frame, min_hsv, max_hsv)),
+        ('screen detection', 'detect_screen + refine_corners', lambda: refine_corners(
+            screen_frame, detect_screen(screen_frame, min_hsv, max_hsv, levels, 0, width * height, 0), min_hsv,
+            max_hsv, 2 ** (levels + 1))),
+        ('grid rendering', 'get_hsv_grid_frame + cvtColor', lambda: cv2.cvtColor(
+            get_hsv_grid_frame(SYMBOLS[symbol_indices], height, width), cv2.COLOR_HSV2BGR)),
+        ('grid rendering', 'SymbolRenderer.render_symbol_grid',
+         lambda: renderer.render_symbol_grid(symbol_indices, SYMBOLS)),
+    ]
+
+
+def time_call(function, repeat=5) -> float:
+    """Best time of a call, in seconds, over repeat runs of about 0.2 s each"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def measure_allocations(function) -> int:
+    """Peak memory allocated during a call, in bytes (numpy and OpenCV output arrays are traced)"""
+    function()
+    tracemalloc.start()
+    try:
+        start_size = tracemalloc.get_traced_memory()[0]
+        function()
+        return tracemalloc.get_traced_memory()[1] - start_size
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(sizes, repeat=5, name_filter=None) -> list:
+    """
+    :param sizes: list of (width, height) frame sizes
+    :param repeat: number of timing runs per function
+    :param name_filter: optional substring of the group or function names to run
+    :return: list of result dictionaries
+    """
+    results = []
+    for width, height in sizes:
+        frame = get_synthetic_frame(width, height)
+        pixel_count = width * height
+        baselines = {}
+
+        for group, name, function in _get_benchmarks(frame):
+            if name_filter is not None and name_filter not in group and name_filter not in name:
+                continue
+
+            call_time = time_call(function, repeat)
+            baselines.setdefault(group, call_time)
+            results.append({
+                'size': str(width) + 'x' + str(height),
+                'group': group,
+                'name': name,
+                'time_per_call': call_time,
+                'ns_per_pixel': 1e9 * call_time / pixel_count,
+                'calls_per_second': 1.0 / call_time,
+                'allocated_bytes': measure_allocations(function),
+                'speedup': baselines[group] / call_time,
+            })
+
+    return results
+
+
+def print_results(results):
+    print("%-10s %-18s %-52s %12s %10s %12s %14s %8s" % ('size', 'group', 'function', 'us/call', 'ns/pixel',
+                                                         'calls/s/core', 'allocated (kB)', 'speedup'))
+    for r in results:
+        print("%-10s %-18s %-52s %12.1f %10.3f %12.1f %14.1f %7.2fx" % (
+            r['size'], r['group'], r['name'], 1e6 * r['time_per_call'], r['ns_per_pixel'], r['calls_per_second'],
+            r['allocated_bytes'] / 1024.0, r['speedup']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the per-frame processing functions on synthetic frames")
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help="frame sizes, as WIDTHxHEIGHT")
+    parser.add_argument('--repeat', type=int, default=5, help="number of timing runs per function")
+    parser.add_argument('--filter', default=None, help="only run the groups or functions containing this string")
+    parser.add_argument('--json', default=None, help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Debug mode writes every frame read by _get_mean to disk
+    Constants.DEBUG = False
+
+    sizes = [tuple(int(x) for x in size.split('x')) for size in args.sizes]
+    results = run_benchmarks(sizes, args.repeat, args.filter)
+    print_results(results)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
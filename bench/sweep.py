@@ -0,0 +1,166 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import time
+
+# Only the constants may be imported here: the other modules read them at import time, so each sweep point is run
+# in a fresh process that sets the constants before importing the simulation
+from utils import Constants
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FILE = os.path.join(ROOT_DIRECTORY, "data", "dummyText1.txt")
+
+RESULT_FIELDS = ['num_bits', 'transmission_rate', 'rs_codeword_size', 'rs_message_size', 'rs_interleaving_depth',
+                 'grid', 'severity', 'seed', 'adaptive', 'arq_window_size', 'arq_sequence_modulus', 'selected_num_bits',
+                 'selected_symbol_period', 'success', 'symbol_error_rate', 'packet_error_rate', 'goodput',
+                 'cpu_time_per_symbol', 'retransmission_count', 'corrected_error_count', 'received_size', 'file_size',
+                 'data_time', 'session_time', 'wall_time', 'commit']
+
+
+def _configure_constants(point):
+    Constants.NUM_BITS = point['num_bits']
+    Constants.ADAPTIVE_MODULATION = point['adaptive']
+    Constants.RS_codeword_size = point['rs_codeword_size']
+    Constants.RS_message_size = point['rs_message_size']
+    Constants.RS_INTERLEAVING_DEPTH = point['rs_interleaving_depth']
+    Constants.RS_packet_size = Constants.RS_codeword_size * Constants.RS_INTERLEAVING_DEPTH
+    Constants.RS_packet_message_size = Constants.RS_message_size * Constants.RS_INTERLEAVING_DEPTH
+    Constants.num_symbols_per_data_packet = -(-8 * Constants.RS_packet_size // Constants.NUM_BITS)
+
+    Constants.GRID_MODE = point['grid'] is not None
+    if Constants.GRID_MODE:
+        Constants.GRID_ROWS, Constants.GRID_COLS = point['grid']
+
+    # Sequence numbers are sent as one symbol, and the window must be at most half of their range. The effective
+    # values are recorded in the results, as they differ between the points
+    Constants.ARQ_SEQUENCE_MODULUS = min(Constants.ARQ_SEQUENCE_MODULUS, 2 ** Constants.NUM_BITS)
+    Constants.ARQ_WINDOW_SIZE = max(1, min(Constants.ARQ_WINDOW_SIZE, Constants.ARQ_SEQUENCE_MODULUS // 2))
+
+
+def run_point(point) -> dict:
+    """
+    Runs a headless simulation for one point of the sweep. Must run in a fresh process.
+
+    :param point: dictionary of the swept parameters
+    :return: the point, with the statistics of the simulation
+    """
+    _configure_constants(point)
+
+    from State_Machine import State_Machine
+    from utils import simulation_handler
+
+    logging.getLogger().setLevel(logging.ERROR)
+    State_Machine.TRANSMISSION_RATE = point['transmission_rate']
+
+    channels = None
+    if point['severity'] is not None:
+        channels = (simulation_handler.get_random_channel(2 * point['seed'], point['severity']),
+                    simulation_handler.get_random_channel(2 * point['seed'] + 1, point['severity']))
+
+    output_file, output_file_name = tempfile.mkstemp(suffix=".txt")
+    os.close(output_file)
+    try:
+        stats = simulation_handler.run_simulation(point['file'], output_file_name, max_duration=point['max_duration'],
+                                                  channels=channels)
+    finally:
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+
+    result = dict(point)
+    result['arq_window_size'] = Constants.ARQ_WINDOW_SIZE
+    result['arq_sequence_modulus'] = Constants.ARQ_SEQUENCE_MODULUS
+    # With adaptive modulation, the swept number of bits is only used by the ACK feedback
+    result['selected_num_bits'] = stats.pop('num_bits')
+    result['selected_symbol_period'] = stats.pop('symbol_period')
+    result.update(stats)
+    # Goodput in bytes per second
+    result['goodput'] = stats['goodput'] / 8.0
+    return result
+
+
+def get_points(args):
+    points = []
+    for num_bits, rate, rs, grid, severity, seed, adaptive in itertools.product(args.num_bits, args.rates, args.rs,
+                                                                                args.grids, args.severities,
+                                                                                args.seeds, args.adaptive):
+        n, k, depth = [int(x) for x in rs.split(',')]
+        points.append({
+            'num_bits': num_bits,
+            'transmission_rate': rate,
+            'rs_codeword_size': n,
+            'rs_message_size': k,
+            'rs_interleaving_depth': depth,
+            'grid': None if grid == 'none' else tuple(int(x) for x in grid.split('x')),
+            'severity': None if severity < 0 else severity,
+            'seed': seed,
+            'adaptive': bool(adaptive),
+            'file': args.file,
+            'max_duration': args.max_duration,
+        })
+    return points
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIRECTORY,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results, output_prefix):
+    with open(output_prefix + ".json", "w") as f:
+        json.dump(results, f, indent=2, default=str)
+
+    with open(output_prefix + ".csv", "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            row = dict(result)
+            row['grid'] = 'none' if result['grid'] is None else 'x'.join(str(x) for x in result['grid'])
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweeps the transmission parameters over headless simulations")
+    parser.add_argument('--num-bits', type=int, nargs='+', default=[Constants.NUM_BITS])
+    parser.add_argument('--rates', type=float, nargs='+', default=[0.1], help="symbol periods, in seconds")
+    parser.add_argument('--rs', nargs='+', default=["12,8,1"], help="RS parameters, as n,k,interleaving depth")
+    parser.add_argument('--grids', nargs='+', default=['none'], help="grid sizes, as ROWSxCOLS, or none")
+    parser.add_argument('--severities', type=float, nargs='+', default=[-1.0],
+                        help="channel impairment levels, a negative level meaning the ideal camera")
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--adaptive', type=int, nargs='+', default=[0], choices=[0, 1],
+                        help="1 to select the modulation from the calibration, 0 to use the swept one")
+    parser.add_argument('--file', default=DEFAULT_FILE, help="file to transmit")
+    parser.add_argument('--max-duration', type=float, default=600.0, help="simulated time limit per point")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default="sweep_" + time.strftime("%Y%m%d_%H%M%S"),
+                        help="prefix of the JSON and CSV result files")
+    args = parser.parse_args()
+
+    points = get_points(args)
+    commit = get_commit()
+    print("Running " + str(len(points)) + " points on " + str(args.processes) + " processes")
+
+    # Each point gets its own interpreter, so that its constants are set before any other import
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.processes, maxtasksperchild=1) as pool:
+        results = []
+        for result in pool.imap(run_point, points):
+            result['commit'] = commit
+            results.append(result)
+            print(", ".join(field + "=" + str(result.get(field)) for field in RESULT_FIELDS[:18]))
+
+    write_results(results, args.output)
+    print("Wrote " + args.output + ".json and " + args.output + ".csv")
+
+
+if __name__ == '__main__':
+    main()
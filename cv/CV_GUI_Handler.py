@@ -1,3 +1,4 @@
+import collections
 import threading
 import time
 
@@ -5,6 +6,8 @@ import cv2
 import numpy as np
 import scipy.misc as scm
 
+from cv.Fiducials import FiducialLayout
+from cv.SymbolRenderer import SymbolRenderer
 from utils import Constants
 
 WIDTH = 800
@@ -15,120 +18,277 @@ NO_FRAME = np.full((HEIGHT, WIDTH, 3), [0, 0, 0], dtype=np.uint8)
 
 
 class OpenCvHandler:
-    class __CV_Handler:
-        def __init__(self):
-            pass
-
-        def __str__(self):
-            return "OpenCV handler singleton" + repr(self)
-
-    instance = None
+    """
+    Display backend of one link, showing its frames in its own window (and in a secondary window in simulation mode).
+    Several handlers can be instantiated, e.g. one per screen, but the HighGUI windows must all be driven from the same
+    thread, so that a single window thread shows the new frames of all the handlers.
+
+    New frames are handed over to the window thread through a condition variable, and shown as soon as they are
+    submitted. The time at which each frame was presented is recorded, and the BGR frames of the colors and the grid
+    patterns are rendered once and kept in a cache. The symbol grids of the data, which seldom repeat, are rendered
+    into reusable buffers instead.
+
+    All the colors and symbols are drawn in the data area of the fiducial layout, which is the whole screen unless the
+    finder patterns are enabled.
+    """
+    handlers = []
+    # Protects the handler list and the frames handed over to the window thread, which waits on it for new frames
+    condition = threading.Condition()
+    waiting_thread = None
+
+    def __init__(self, window_name=MAIN_WINDOW, secondary_window_name=SECONDARY_WINDOW, width=WIDTH, height=HEIGHT,
+                 fullscreen=True, position=None):
+        """
+        :param window_name: name of the window showing the frames
+        :param secondary_window_name: name of the window showing the secondary frames, in simulation mode
+        :param width: width of the displayed frames
+        :param height: height of the displayed frames
+        :param fullscreen: show the window in full screen, on the screen where it is opened
+        :param position: optional (x, y) desktop position where the window is opened, to select its screen
+        """
+        self.window_name = window_name
+        self.secondary_window_name = secondary_window_name
+        self.width = width
+        self.height = height
+        self.fullscreen = fullscreen
+        self.position = position
+        self.new_frame = np.full((height, width, 3), (255, 255, 255), dtype=np.uint8)
+        self.scnd_new_frame = np.full((height, width, 3), (255, 255, 255), dtype=np.uint8)
+        self.layout = FiducialLayout(width, height, Constants.FIDUCIAL_MARKERS, Constants.FIDUCIAL_SIZE)
+        self.no_frame = self.layout.new_frame()
+        self.refresh = True
+        self.refresh_scnd = True
+        self.windows_created = False
+        self.killed = False
+
+        # Identifier of the last submitted frame, of the frame shown by the window thread and not presented yet, and
+        # presentation time of the last frames
+        self.frame_id = 0
+        self.shown_frame_id = None
+        self.presentation_times = collections.OrderedDict()
+        self.dropped_frame_count = 0
+        # Rendered BGR frames, by color or grid pattern, the least recently used ones being evicted first
+        self.frame_cache = collections.OrderedDict()
+        # The symbol grids are rendered into the data area of reusable frames, used in turn
+        self.renderer = SymbolRenderer(self.layout.data_width, self.layout.data_height, 0)
+        self.render_frames = [self.layout.new_frame() for i in range(0, Constants.DISPLAY_RENDER_BUFFERS)]
+        self.render_frame_index = 0
+
+        with OpenCvHandler.condition:
+            OpenCvHandler.handlers.append(self)
+            if OpenCvHandler.waiting_thread is None:
+                OpenCvHandler.waiting_thread = threading.Thread(target=OpenCvHandler.wait_key_func, daemon=True)
+                OpenCvHandler.waiting_thread.start()
 
     def kill(self):
-        cv2.destroyAllWindows()
+        """Closes the windows of this handler, from the window thread"""
+        with OpenCvHandler.condition:
+            self.killed = True
+            OpenCvHandler.condition.notify()
 
-    def wait_key_func(self):
-        print("Initializing main window")
-        cv2.namedWindow(MAIN_WINDOW, cv2.WND_PROP_FULLSCREEN)
-        cv2.setWindowProperty(MAIN_WINDOW, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-        if Constants.SIMULATE:
-            cv2.namedWindow(SECONDARY_WINDOW, cv2.WINDOW_GUI_EXPANDED | cv2.WINDOW_KEEPRATIO)
+    @staticmethod
+    def wait_key_func():
         cv2.startWindowThread()
         while True:
-            if self.refresh:
-                cv2.imshow(MAIN_WINDOW, self.instance.new_frame)
-                self.instance.refresh = False
-            if self.refresh_scnd and Constants.SIMULATE:
-                cv2.imshow(SECONDARY_WINDOW, self.instance.scnd_new_frame)
-                self.instance.refresh_scnd = False
-            if (cv2.waitKey(1) & 0xFF) == 27:
+            with OpenCvHandler.condition:
+                # The loop also wakes up periodically, as HighGUI events are only processed by waitKey
+                OpenCvHandler.condition.wait_for(lambda: any(handler.refresh or handler.refresh_scnd or handler.killed
+                                                             for handler in OpenCvHandler.handlers),
+                                                 Constants.DISPLAY_EVENT_PERIOD)
+                handlers = list(OpenCvHandler.handlers)
+
+            for handler in handlers:
+                handler._show_frames()
+            key = cv2.waitKey(1)
+
+            # The frames are drawn by waitKey
+            presentation_time = time.time()
+            for handler in handlers:
+                handler._record_presentation(presentation_time)
+            if (key & 0xFF) == 27:
                 break
         print("Escape key pressed - terminating the GUI")
         cv2.destroyAllWindows()
 
-    def __init__(self):
-        if not OpenCvHandler.instance:
-            OpenCvHandler.instance = OpenCvHandler.__CV_Handler
-            self.instance.new_frame = np.full((HEIGHT, WIDTH, 3), (255, 255, 255), dtype=np.uint8)
-            self.instance.scnd_new_frame = np.full((HEIGHT, WIDTH, 3), (255, 255, 255), dtype=np.uint8)
-            self.instance.refresh = True
-            self.instance.refresh_scnd = True
-            self.instance.waiting_thread = threading.Thread(target=self.wait_key_func)
-            self.instance.waiting_thread.setDaemon(True)
-            self.instance.waiting_thread.start()
+    def _show_frames(self):
+        """Creates, refreshes or destroys the windows of this handler. Only called from the window thread"""
+        if self.killed:
+            with OpenCvHandler.condition:
+                OpenCvHandler.handlers.remove(self)
+            if self.windows_created:
+                cv2.destroyWindow(self.window_name)
+                if Constants.SIMULATE:
+                    cv2.destroyWindow(self.secondary_window_name)
+            return
+
+        if not self.windows_created:
+            print("Initializing window " + self.window_name)
+            cv2.namedWindow(self.window_name, cv2.WND_PROP_FULLSCREEN if self.fullscreen else cv2.WINDOW_NORMAL)
+            if self.position is not None:
+                cv2.moveWindow(self.window_name, self.position[0], self.position[1])
+            if self.fullscreen:
+                cv2.setWindowProperty(self.window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+            if Constants.SIMULATE:
+                cv2.namedWindow(self.secondary_window_name, cv2.WINDOW_GUI_EXPANDED | cv2.WINDOW_KEEPRATIO)
+            self.windows_created = True
+
+        with OpenCvHandler.condition:
+            frame = self.new_frame if self.refresh else None
+            scnd_frame = self.scnd_new_frame if self.refresh_scnd and Constants.SIMULATE else None
+            self.shown_frame_id = self.frame_id if self.refresh else None
+            self.refresh = False
+            self.refresh_scnd = False
+
+        if frame is not None:
+            cv2.imshow(self.window_name, frame)
+        if scnd_frame is not None:
+            cv2.imshow(self.secondary_window_name, scnd_frame)
+
+    def _record_presentation(self, presentation_time):
+        if self.shown_frame_id is None:
+            return
+        with OpenCvHandler.condition:
+            self.presentation_times[self.shown_frame_id] = presentation_time
+            while len(self.presentation_times) > Constants.DISPLAY_PRESENTATION_LOG_SIZE:
+                self.presentation_times.popitem(last=False)
+        self.shown_frame_id = None
+
+    def get_presentation_time(self, frame_id):
+        """
+        :param frame_id: identifier returned when the frame was submitted
+        :return: the time at which the frame was presented, or None if it was not presented (yet), or was dropped
+        """
+        with OpenCvHandler.condition:
+            return self.presentation_times.get(frame_id)
+
+    def get_display_name(self) -> str:
+        """Name of the display, in the keys of the calibration profiles"""
+        return "display " + str(self.width) + "x" + str(self.height)
 
     def join_waiting_thread_handler(self):
-        self.instance.waiting_thread.join()
+        OpenCvHandler.waiting_thread.join()
 
-    def __getattr__(self, name):
-        return getattr(self.instance, name)
+    def send_new_frame(self, new_frame) -> int:
+        """
+        Hands a BGR frame over to the window thread, replacing the previous frame if it was not shown yet
 
-    def send_new_frame(self, new_frame):
-        if self.instance.refresh:
-            print('A frame was dropped!')
-        else:
-            self.instance.refresh = True
-        self.instance.new_frame = new_frame
+        :return: identifier of the frame, to get its presentation time
+        """
+        with OpenCvHandler.condition:
+            if self.refresh:
+                self.dropped_frame_count += 1
+            self.refresh = True
+            self.new_frame = new_frame
+            self.frame_id += 1
+            OpenCvHandler.condition.notify()
+            return self.frame_id
 
     def send_scnd_new_frame(self, new_frame):
-        if self.instance.refresh_scnd:
-            print('A frame was dropped!')
+        with OpenCvHandler.condition:
+            self.refresh_scnd = True
+            self.scnd_new_frame = new_frame
+            OpenCvHandler.condition.notify()
+
+    def _get_cached_frame(self, key, render_function) -> np.ndarray:
+        """Cached BGR frame, rendered by render_function the first time. Cached frames must not be modified"""
+        frame = self.frame_cache.get(key)
+        if frame is None:
+            frame = render_function()
+            self.frame_cache[key] = frame
+            while len(self.frame_cache) > Constants.DISPLAY_FRAME_CACHE_SIZE:
+                self.frame_cache.popitem(last=False)
         else:
-            self.instance.refresh_scnd = True
-        self.instance.scnd_new_frame = new_frame
+            self.frame_cache.move_to_end(key)
+        return frame
 
-    def display_bgr_color(self, bgr_col):
-        """Displays the given color on the whole screen"""
-        color_frame = np.full((HEIGHT, WIDTH, 3), bgr_col, dtype=np.uint8)
-        self.send_new_frame(color_frame)
+    def prerender_hsv_colors(self, hsv_cols):
+        """Renders the frames of the given colors ahead of their display, e.g. the symbols of the constellation"""
+        for hsv_col in hsv_cols:
+            self._get_cached_frame(('color', int(hsv_col)), lambda: self._render_hsv_color(hsv_col))
 
-    def display_hsv_color(self, hsv_col):
-        """Converts the given color from HSV to BGR, and displays it"""
+    def _get_render_frame(self) -> np.ndarray:
+        """Next reusable frame, whose data area is rendered again"""
+        frame = self.render_frames[self.render_frame_index]
+        self.render_frame_index = (self.render_frame_index + 1) % len(self.render_frames)
+        return frame
+
+    def _render_hsv_color(self, hsv_col) -> np.ndarray:
         converted_color = cv2.cvtColor(np.array([[[hsv_col, 255, 255]]], dtype=np.uint8), cv2.COLOR_HSV2BGR)
-        color_frame = np.full((HEIGHT, WIDTH, 3), converted_color, dtype=np.uint8)
-        self.send_new_frame(color_frame)
+        color_frame = self.layout.new_frame()
+        self.layout.get_data_view(color_frame)[:] = converted_color
+        return color_frame
+
+    def display_bgr_color(self, bgr_col) -> int:
+        """Displays the given color on the whole screen"""
+        color_frame = self.layout.new_frame()
+        self.layout.get_data_view(color_frame)[:] = bgr_col
+        return self.send_new_frame(color_frame)
+
+    def display_hsv_color(self, hsv_col) -> int:
+        """Displays the given color on the whole screen, from its cached BGR frame"""
+        return self.send_new_frame(self._get_cached_frame(('color', int(hsv_col)),
+                                                          lambda: self._render_hsv_color(hsv_col)))
 
-    def black_out(self):
-        self.send_new_frame(NO_FRAME)
+    def black_out(self) -> int:
+        return self.send_new_frame(self.no_frame)
 
     def display_hsv_frame(self, hsvframe, use_interpolation=False):
         frame = hsvframe
 
         if use_interpolation:
-            frame = scm.imresize(frame, (WIDTH, HEIGHT), interp='bilinear')
+            frame = scm.imresize(frame, (self.width, self.height), interp='bilinear')
 
         frame = cv2.cvtColor(frame, cv2.COLOR_HSV2BGR)
-        self.send_new_frame(frame)
+        return self.send_new_frame(frame)
 
     def display_frame(self, frame):
-        resized_frame = scm.imresize(frame, (WIDTH, HEIGHT), interp='bilinear')
-        self.send_new_frame(resized_frame)
+        resized_frame = scm.imresize(frame, (self.width, self.height), interp='bilinear')
+        return self.send_new_frame(resized_frame)
+
+    def display_hsv_grid(self, color_matrix) -> int:
+        """Displays a grid of hues, each cell of the screen showing the corresponding color matrix entry"""
+        color_matrix = np.uint8(color_matrix)
+        key = ('grid', color_matrix.shape, color_matrix.tobytes())
+        return self.send_new_frame(self._get_cached_frame(key, lambda: self._render_hue_grid(color_matrix)))
+
+    def _render_hue_grid(self, color_matrix) -> np.ndarray:
+        # Cached frames get their own memory, instead of one of the reusable frames
+        grid_frame = self.layout.new_frame()
+        self.renderer.render_hue_grid(color_matrix, self.layout.get_data_view(grid_frame))
+        return grid_frame
+
+    def display_symbol_grid(self, symbol_indices, hues) -> int:
+        """
+        Displays a grid of symbols without caching it, e.g. the data symbols of a tick
+
+        :param symbol_indices: 2D array of symbol indices, of shape (rows, cols)
+        :param hues: hue of each symbol
+        :return: identifier of the frame
+        """
+        grid_frame = self._get_render_frame()
+        self.renderer.render_symbol_grid(symbol_indices, hues, self.layout.get_data_view(grid_frame))
+        return self.send_new_frame(grid_frame)
 
     def display_binary_pattern(self, color_vector):
-        self._display_isoquadrant_frame(self._get_binary_quadrant(color_vector[0], color_vector[1]))
+        return self._display_isoquadrant_frame(self._get_binary_quadrant(color_vector[0], color_vector[1]))
 
     def display_quaternary_pattern(self, color_matrix):
-        self._display_isoquadrant_frame(self._get_quaternary_quadrant(color_matrix))
+        return self._display_isoquadrant_frame(self._get_quaternary_quadrant(color_matrix))
 
     def display_octonary_pattern(self, color_matrices_vector,
                                  top_left, top_right, bottom_left, bottom_right):
 
         quadrant1 = self._get_quaternary_quadrant(color_matrices_vector[0])
         quadrant2 = self._get_quaternary_quadrant(color_matrices_vector[1])
-        self._display_biquadrant_frame(quadrant1, quadrant2,
-                                       top_left, top_right,
-                                       bottom_left, bottom_right)
+        return self._display_biquadrant_frame(quadrant1, quadrant2,
+                                              top_left, top_right,
+                                              bottom_left, bottom_right)
 
     def _display_isoquadrant_frame(self, quadrant):
-        frame = np.empty((HEIGHT, WIDTH, 3), dtype=np.uint8)
-
-        # sets up the quadrants
-        frame[0: HEIGHT / 2, 0: WIDTH / 2, :] = quadrant
-        frame[0: HEIGHT / 2, WIDTH / 2: WIDTH] = quadrant
-        frame[HEIGHT / 2: HEIGHT, 0: WIDTH / 2, :] = quadrant
-        frame[HEIGHT / 2: HEIGHT, WIDTH / 2: WIDTH, :] = quadrant
-
-        self.display_hsv_frame(frame)
+        """Displays the same quadrant (a matrix of hues) in the four quadrants of the screen"""
+        pattern_frame = self._get_render_frame()
+        self.renderer.render_hue_grid(np.tile(quadrant, (2, 2)), self.layout.get_data_view(pattern_frame))
+        return self.send_new_frame(pattern_frame)
 
     def _display_biquadrant_frame(self, quadrant1, quadrant2, top_left, top_right, bottom_left, bottom_right):
         """
@@ -138,58 +298,61 @@ class OpenCvHandler:
         1 - OOXX    3 - OOOO    5 - OOXX    if on the same column:     
             OOXX        XXXX        XXOO        - from top to bottom
         """
-        frame = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+        rows, cols = np.shape(quadrant1)
+        # HSV grid of the whole screen, whose empty quadrants stay black
+        hsv_grid = np.zeros((2 * rows, 2 * cols, 3), dtype=np.uint8)
+
+        def set_quadrant(row, col, quadrant):
+            hsv_grid[row * rows:(row + 1) * rows, col * cols:(col + 1) * cols, 0] = quadrant
+            hsv_grid[row * rows:(row + 1) * rows, col * cols:(col + 1) * cols, 1:] = 255
 
         if top_left and bottom_left:
-            frame[0: HEIGHT / 2, 0: WIDTH / 2, :] = quadrant1  # top left quadrant
-            frame[HEIGHT / 2: HEIGHT, 0: WIDTH / 2, :] = quadrant2  # bottom left quadrant
+            set_quadrant(0, 0, quadrant1)  # top left quadrant
+            set_quadrant(1, 0, quadrant2)  # bottom left quadrant
 
         elif top_right and bottom_right:
-            frame[0: HEIGHT / 2, WIDTH / 2: WIDTH] = quadrant1  # top right quadrant
-            frame[HEIGHT / 2: HEIGHT, WIDTH / 2: WIDTH, :] = quadrant2  # bottom right quadrant
+            set_quadrant(0, 1, quadrant1)  # top right quadrant
+            set_quadrant(1, 1, quadrant2)  # bottom right quadrant
 
         elif top_left and top_right:
-            frame[0: HEIGHT / 2, 0: WIDTH / 2, :] = quadrant1  # top left quadrant
-            frame[0: HEIGHT / 2, WIDTH / 2: WIDTH] = quadrant2  # top right quadrant
+            set_quadrant(0, 0, quadrant1)  # top left quadrant
+            set_quadrant(0, 1, quadrant2)  # top right quadrant
 
         elif bottom_left and bottom_right:
-            frame[HEIGHT / 2: HEIGHT, 0: WIDTH / 2, :] = quadrant1  # bottom left quadrant
-            frame[HEIGHT / 2: HEIGHT, WIDTH / 2: WIDTH, :] = quadrant2  # bottom right quadrant
+            set_quadrant(1, 0, quadrant1)  # bottom left quadrant
+            set_quadrant(1, 1, quadrant2)  # bottom right quadrant
 
         elif top_left and bottom_right:
-            frame[0: HEIGHT / 2, 0: WIDTH / 2, :] = quadrant1  # top left quadrant
-            frame[HEIGHT / 2: HEIGHT, WIDTH / 2: WIDTH, :] = quadrant2  # bottom right quadrant
+            set_quadrant(0, 0, quadrant1)  # top left quadrant
+            set_quadrant(1, 1, quadrant2)  # bottom right quadrant
 
         elif bottom_left and top_right:
-            frame[0: HEIGHT / 2, WIDTH / 2: WIDTH] = quadrant2  # top right quadrant
-            frame[HEIGHT / 2: HEIGHT, 0: WIDTH / 2, :] = quadrant1  # bottom left quadrant
+            set_quadrant(0, 1, quadrant2)  # top right quadrant
+            set_quadrant(1, 0, quadrant1)  # bottom left quadrant
 
-        self.display_hsv_frame(frame)
+        pattern_frame = self._get_render_frame()
+        self.renderer.render_hsv_grid(hsv_grid, self.layout.get_data_view(pattern_frame))
+        return self.send_new_frame(pattern_frame)
 
     def _get_binary_quadrant(self, hsv_col1, hsv_col2):
-        col1_subquadrant = np.full((HEIGHT / 2, WIDTH / 4, 3), [hsv_col1, 255, 255], dtype=np.uint8)
-        col2_subquadrant = np.full((HEIGHT / 2, WIDTH / 4, 3), [hsv_col2, 255, 255], dtype=np.uint8)
+        """Quadrant split into a left and a right half, as a matrix of hues"""
+        return np.array([[hsv_col1, hsv_col2]])
 
-        quadrant = np.empty((HEIGHT / 2, WIDTH / 2, 3), dtype=np.uint8)
-        quadrant[:, 0:WIDTH / 4, :] = col1_subquadrant
-        quadrant[:, WIDTH / 4:WIDTH / 2, :] = col2_subquadrant
+    def _get_quaternary_quadrant(self, color_matrix):
+        return np.asarray(color_matrix)
 
-        return quadrant
 
-    def _get_quaternary_quadrant(self, color_matrix):
-        col1_subquadrant = np.full((HEIGHT / 4, WIDTH / 4, 3), [color_matrix[0, 0], 255, 255], dtype=np.uint8)
-        col2_subquadrant = np.full((HEIGHT / 4, WIDTH / 4, 3), [color_matrix[0, 1], 255, 255], dtype=np.uint8)
-        col3_subquadrant = np.full((HEIGHT / 4, WIDTH / 4, 3), [color_matrix[1, 0], 255, 255], dtype=np.uint8)
-        col4_subquadrant = np.full((HEIGHT / 4, WIDTH / 4, 3), [color_matrix[1, 1], 255, 255], dtype=np.uint8)
+class NullDisplayHandler:
+    """Display backend that discards all the frames, for headless simulations"""
 
-        quadrant = np.empty((HEIGHT / 2, WIDTH / 2, 3), dtype=np.uint8)
+    def kill(self):
+        pass
 
-        quadrant[0: HEIGHT / 4, 0: WIDTH / 4, :] = col1_subquadrant
-        quadrant[0: HEIGHT / 4, WIDTH / 4: WIDTH] = col2_subquadrant
-        quadrant[HEIGHT / 4: HEIGHT, 0: WIDTH / 4, :] = col3_subquadrant
-        quadrant[HEIGHT / 4: HEIGHT, WIDTH / 4: WIDTH, :] = col4_subquadrant
+    def send_new_frame(self, new_frame):
+        pass
 
-        return quadrant
+    def send_scnd_new_frame(self, new_frame):
+        pass
 
 
 if __name__ == '__main__':
@@ -1,80 +1,233 @@
+import logging
 import threading
 import time
 
 import cv2
 import numpy as np
-from typing import Tuple
+from typing import List, Tuple
 
-from cv.ImageProcessing import crop
+from cv.FrameRingBuffer import FrameRingBuffer
+from cv.ImageProcessing import crop, get_rectifying_homography, warp
+from cv.ScreenDetector import ScreenTracker
+from utils import Constants
+
+
+# Capture properties restored from the calibration profiles, so that the camera sees the same colors
+EXPOSURE_PROPERTIES = ['CAP_PROP_AUTO_EXPOSURE', 'CAP_PROP_EXPOSURE', 'CAP_PROP_GAIN', 'CAP_PROP_AUTO_WB',
+                       'CAP_PROP_WB_TEMPERATURE']
 
 
 class CV_Video_Capture_Handler:
+    """
+    Continuously captures the frames of one camera into a ring buffer of timestamped HSV frames, from its own thread.
+    One handler is instantiated per camera, so that several links can run in the same process.
+
+    Once the screen corners are set, the capture thread also tracks them in the camera frames, and updates the
+    rectifying homography when the camera moves.
+    """
     WIDTH = 640
     HEIGHT = 480
 
-    class __CV_Video_Capture_Handler:
-        def __init__(self):
-            pass
-
-        def __str__(self):
-            return "OpenCV video capture handler singleton" + repr(self)
-
-    instance = None
-
-    def __init__(self):
-        if not CV_Video_Capture_Handler.instance:
-            CV_Video_Capture_Handler.instance = CV_Video_Capture_Handler.__CV_Video_Capture_Handler
-            self.videocapture = cv2.VideoCapture(0)
-            self.videocapture.set(cv2.CAP_PROP_FRAME_WIDTH, CV_Video_Capture_Handler.WIDTH)
-            self.videocapture.set(cv2.CAP_PROP_FRAME_HEIGHT, CV_Video_Capture_Handler.HEIGHT)
-            self.videocapture.set(cv2.CAP_PROP_FPS, 60.0)
-            self.video_lock = threading.Lock()
-            self.width = self.videocapture.get(cv2.CAP_PROP_FRAME_WIDTH)
-            self.height = self.videocapture.get(cv2.CAP_PROP_FRAME_HEIGHT)
-            self.fps = self.videocapture.get(cv2.CAP_PROP_FPS)
-            self.polled_frame = None
-            self.screen_boundaries = (0, CV_Video_Capture_Handler.WIDTH, 0, CV_Video_Capture_Handler.HEIGHT)
-            self.process = threading.Thread(target=self._frame_continuous_poll)
-            self.process.setDaemon(True)
-            self.process.start()
-            time.sleep(0.5)
-            print("Video width: %f" % self.width)
-            print("Video height: %f" % self.height)
-
-    def __getattr__(self, name):
-        return getattr(self.instance, name)
+    def __init__(self, device_index=0, width=WIDTH, height=HEIGHT, fps=60.0):
+        """
+        :param device_index: index of the camera, as given to cv2.VideoCapture
+        :param width: requested capture width
+        :param height: requested capture height
+        :param fps: requested capture frame rate
+        """
+        self.device_index = device_index
+        self.videocapture = cv2.VideoCapture(device_index)
+        self.videocapture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.videocapture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.videocapture.set(cv2.CAP_PROP_FPS, fps)
+        self.video_lock = threading.Lock()
+        self.width = self.videocapture.get(cv2.CAP_PROP_FRAME_WIDTH)
+        self.height = self.videocapture.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        self.fps = self.videocapture.get(cv2.CAP_PROP_FPS)
+        self.frame_buffer = None
+        self.screen_boundaries = (0, int(self.width), 0, int(self.height))
+        self.homography = None
+        # Tracked screen corners and their tracker, which is created from the first frame after the corners are set
+        self.screen_corners = None
+        self.screen_tracker = None
+        self.tracked_frame_count = 0
+        self.screen_correction_count = 0
+        self.screen_lost_count = 0
+        self.rectified_frame = np.empty((Constants.RECTIFIED_HEIGHT, Constants.RECTIFIED_WIDTH, 3), np.uint8)
+        self.process = threading.Thread(target=self._frame_continuous_poll, daemon=True)
+        self.process.start()
+        time.sleep(0.5)
+        print("Video " + str(device_index) + " width: %f" % self.width)
+        print("Video " + str(device_index) + " height: %f" % self.height)
 
     def _frame_continuous_poll(self):
         while True:
             ret, frame = self.videocapture.read()
+            capture_time = time.time()
+            if not ret:
+                # The camera may not deliver frames yet
+                time.sleep(0.01)
+                continue
             bounds = None
 
             self.video_lock.acquire()
             bounds = self.screen_boundaries
+            homography = self.homography
             self.video_lock.release()
 
-            cropped_frame = crop(frame, bounds)
-            cropped_frame = cv2.cvtColor(cropped_frame, cv2.COLOR_BGR2HSV)
+            if homography is not None and Constants.SCREEN_TRACKING:
+                homography = self._track_screen(frame, homography)
+
+            if homography is not None:
+                warp(frame, homography, Constants.RECTIFIED_WIDTH, Constants.RECTIFIED_HEIGHT,
+                     dst=self.rectified_frame)
+                cropped_frame = self.rectified_frame
+            else:
+                cropped_frame = crop(frame, bounds)
+
+            # HSV frames are converted directly into the ring buffer, which is reallocated whenever the frame size
+            # changes (readers of the previous buffer keep valid views)
+            frame_buffer = self.frame_buffer
+            if frame_buffer is None or frame_buffer.shape != cropped_frame.shape:
+                frame_buffer = FrameRingBuffer(Constants.FRAME_BUFFER_SIZE, cropped_frame.shape)
+
+            cv2.cvtColor(cropped_frame, cv2.COLOR_BGR2HSV, dst=frame_buffer.get_write_slot())
+            frame_buffer.publish(capture_time)
+            self.frame_buffer = frame_buffer
+
+    def _track_screen(self, frame, homography) -> np.ndarray:
+        """
+        Tracks the screen corners in a camera frame, every SCREEN_TRACKING_PERIOD frames
+
+        :param frame: BGR camera frame
+        :param homography: current rectifying homography
+        :return: the homography with which the frame is rectified
+        """
+        self.video_lock.acquire()
+        corners = self.screen_corners
+        tracker = self.screen_tracker
+        self.video_lock.release()
 
+        if tracker is None:
+            tracker = ScreenTracker(frame, corners, Constants.SCREEN_TRACKING_TEMPLATE_SIZE,
+                                    Constants.SCREEN_TRACKING_SEARCH_RADIUS, Constants.SCREEN_TRACKING_MIN_SCORE)
             self.video_lock.acquire()
-            self.polled_frame = cropped_frame
+            if self.homography is homography:
+                self.screen_tracker = tracker
             self.video_lock.release()
+            return homography
 
-    def _get_polled_frame(self):
-        retval = None
+        self.tracked_frame_count += 1
+        if self.tracked_frame_count % Constants.SCREEN_TRACKING_PERIOD != 0:
+            return homography
+
+        tracked_corners = tracker.update(frame)
+        if tracked_corners is None:
+            self.screen_lost_count += 1
+            return homography
+        if np.abs(tracked_corners - corners).max() < Constants.SCREEN_TRACKING_MIN_SHIFT:
+            return homography
+
+        new_homography = get_rectifying_homography(tracked_corners, Constants.RECTIFIED_WIDTH,
+                                                   Constants.RECTIFIED_HEIGHT)
         self.video_lock.acquire()
-        retval = self.polled_frame.copy()
+        # The corners may have been set again in the meantime
+        if self.homography is homography:
+            self.homography = new_homography
+            self.screen_corners = tracked_corners
+            homography = new_homography
+            self.screen_correction_count += 1
         self.video_lock.release()
+        logging.info("Screen corners tracked to " + str(np.round(tracked_corners, 1).tolist()))
+        return homography
 
-        return retval
+    def _get_polled_frame(self) -> Tuple[bool, np.ndarray]:
+        frame_buffer = self.frame_buffer
+        timestamped_frame = frame_buffer.read_latest() if frame_buffer is not None else None
+        if timestamped_frame is None:
+            return False, None
+        return True, timestamped_frame[2]
 
     def set_screen_boundaries(self, bounds):
         self.video_lock.acquire()
         self.screen_boundaries = bounds
         self.video_lock.release()
 
+    def set_screen_corners(self, corners):
+        """
+        Captured frames are then rectified into a RECTIFIED_WIDTH x RECTIFIED_HEIGHT frame
+        
+        :param corners: screen corners, ordered as [top left, top right, bottom right, bottom left]
+        :return: 
+        """
+        homography = get_rectifying_homography(corners, Constants.RECTIFIED_WIDTH, Constants.RECTIFIED_HEIGHT)
+        self.video_lock.acquire()
+        self.homography = homography
+        self.screen_corners = np.float32(corners)
+        self.screen_tracker = None
+        self.video_lock.release()
+
     def readHSVFrame(self) -> Tuple[bool, np.ndarray]:
-        return True, self._get_polled_frame()
+        """Returns a read-only view of the latest captured frame, (False, None) if no frame was captured yet"""
+        return self._get_polled_frame()
+
+    def readHSVFrameAt(self, timestamp) -> Tuple[bool, np.ndarray]:
+        """
+        Returns a read-only view of the captured frame whose timestamp is the closest to the given one, (False, None)
+        if no frame was captured yet
+        """
+        frame_buffer = self.frame_buffer
+        timestamped_frame = frame_buffer.read_closest(timestamp) if frame_buffer is not None else None
+        if timestamped_frame is None:
+            return False, None
+        return True, timestamped_frame[2]
+
+    def readHSVFramesBetween(self, start_time, end_time) -> List[np.ndarray]:
+        """Returns read-only views of all the frames captured within [start_time, end_time]"""
+        frame_buffer = self.frame_buffer
+        if frame_buffer is None:
+            return []
+        return [frame for sequence_number, timestamp, frame in frame_buffer.read_between(start_time, end_time)]
+
+    def readHSVFramesSince(self, sequence_number) -> List[Tuple[int, float, np.ndarray]]:
+        """Returns (sequence number, timestamp, read-only view) of all the available frames newer than the given one"""
+        frame_buffer = self.frame_buffer
+        if frame_buffer is None:
+            return []
+        return frame_buffer.read_since(sequence_number)
+
+    def readHSVFrameBySequence(self, sequence_number) -> Tuple[bool, np.ndarray]:
+        """Returns a read-only view of the given captured frame, if it has not been overwritten yet"""
+        frame_buffer = self.frame_buffer
+        timestamped_frame = frame_buffer.read(sequence_number) if frame_buffer is not None else None
+        if timestamped_frame is None:
+            return False, None
+        return True, timestamped_frame[2]
+
+    def is_frame_valid(self, sequence_number) -> bool:
+        """Whether the view of the given captured frame was not overwritten, to be checked after using it"""
+        frame_buffer = self.frame_buffer
+        return frame_buffer is not None and frame_buffer.is_valid(sequence_number)
+
+    def get_frame_buffer(self) -> FrameRingBuffer:
+        """Ring buffer of the latest timestamped HSV frames"""
+        return self.frame_buffer
+
+    def get_camera_name(self) -> str:
+        """Name of the camera and of its capture size, in the keys of the calibration profiles"""
+        return "camera " + str(self.device_index) + " " + str(int(self.width)) + "x" + str(int(self.height))
+
+    def get_exposure_settings(self) -> dict:
+        """Current exposure and white balance properties of the camera, by property name"""
+        with self.video_lock:
+            return {name: self.videocapture.get(getattr(cv2, name)) for name in EXPOSURE_PROPERTIES}
+
+    def set_exposure_settings(self, settings):
+        """Restores exposure and white balance properties, the automatic modes first (backends ignore the others)"""
+        with self.video_lock:
+            for name in EXPOSURE_PROPERTIES:
+                if name in settings and not self.videocapture.set(getattr(cv2, name), settings[name]):
+                    logging.warning("Camera " + str(self.device_index) + " does not support setting " + name)
 
 # Commented, because we only have HSV frame now
 #   def readFrame(self):
@@ -0,0 +1,159 @@
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from cv.ImageProcessing import order_corners
+
+# A finder pattern is made of a black ring, a white ring and a black core, with widths of 1, 1 and 3 modules
+FINDER_MODULES = 7
+# Expected areas of the hole of the outer ring and of the core, relative to the area of the pattern (25 / 49 and
+# 9 / 49 modules), with the tolerated ranges
+HOLE_AREA_RANGE = (0.3, 0.75)
+CORE_AREA_RANGE = (0.08, 0.35)
+# Largest ratio between the areas of the four patterns of a screen
+MAX_AREA_RATIO = 4.0
+# The dark pixels are those darker than the mean of their THRESHOLD_BLOCK_SIZE neighbourhood by THRESHOLD_OFFSET. The
+# insides of larger uniform areas are not dark, but their edges still give the same nested contours
+THRESHOLD_BLOCK_SIZE = 11
+THRESHOLD_OFFSET = 5
+
+
+class FiducialLayout:
+    """
+    Layout of the frames displayed on a screen. With fiducials, the data are displayed in a central data area, between
+    two white bands on the left and on the right of the screen, which carry a finder pattern in each corner of the
+    screen. Without fiducials, the data area is the whole screen.
+
+    Both sides of a link use the same layout, so that the receiver knows where the data area lies relative to the
+    finder patterns it localizes.
+    """
+
+    def __init__(self, width, height, enabled, size=0.2):
+        """
+        :param width: width of the screen frames
+        :param height: height of the screen frames
+        :param enabled: draw the finder patterns around the data area
+        :param size: side of the finder patterns, relative to the height of the screen
+        """
+        self.width = width
+        self.height = height
+        self.enabled = enabled
+        if enabled:
+            # Each pattern is surrounded by a white quiet zone of one module
+            self.module = max(1, int(round(size * height / FINDER_MODULES)))
+            self.marker_size = FINDER_MODULES * self.module
+            band_width = self.marker_size + 2 * self.module
+            self.data_area = (band_width, self.module, width - band_width, height - self.module)
+        else:
+            self.module = self.marker_size = 0
+            self.data_area = (0, 0, width, height)
+
+        x0, y0, x1, y1 = self.data_area
+        self.data_width = x1 - x0
+        self.data_height = y1 - y0
+        self.template = self._draw_template()
+
+    def _get_marker_origins(self) -> list:
+        """Top left pixel of each finder pattern, as [top left, top right, bottom right, bottom left]"""
+        near = self.module
+        far_x = self.width - self.module - self.marker_size
+        far_y = self.height - self.module - self.marker_size
+        return [(near, near), (far_x, near), (far_x, far_y), (near, far_y)]
+
+    def _draw_template(self) -> np.ndarray:
+        frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        if not self.enabled:
+            return frame
+
+        frame[:] = 255
+        x0, y0, x1, y1 = self.data_area
+        frame[y0:y1, x0:x1] = 0
+        m = self.module
+        for x, y in self._get_marker_origins():
+            frame[y:y + 7 * m, x:x + 7 * m] = 0
+            frame[y + m:y + 6 * m, x + m:x + 6 * m] = 255
+            frame[y + 2 * m:y + 5 * m, x + 2 * m:x + 5 * m] = 0
+        return frame
+
+    def get_marker_centers(self) -> np.ndarray:
+        """Centers of the finder patterns, ordered as [top left, top right, bottom right, bottom left]"""
+        return np.float32([(x + (self.marker_size - 1) / 2.0, y + (self.marker_size - 1) / 2.0)
+                           for x, y in self._get_marker_origins()])
+
+    def get_data_corners(self) -> np.ndarray:
+        """Outer corners of the data area, where (0, 0) is the center of the top left pixel"""
+        x0, y0, x1, y1 = self.data_area
+        return np.float32([[x0 - 0.5, y0 - 0.5], [x1 - 0.5, y0 - 0.5], [x1 - 0.5, y1 - 0.5], [x0 - 0.5, y1 - 0.5]])
+
+    def new_frame(self) -> np.ndarray:
+        """New BGR frame with the finder patterns, whose data area is black"""
+        return self.template.copy()
+
+    def get_data_view(self, frame) -> np.ndarray:
+        """View on the data area of a frame, in which the data are drawn"""
+        x0, y0, x1, y1 = self.data_area
+        return frame[y0:y1, x0:x1]
+
+
+def find_finder_patterns(frame, min_area) -> Optional[np.ndarray]:
+    """
+    Localizes the four finder patterns of a screen in a single frame. The frame is binarized on its value channel,
+    against the local mean rather than a global threshold, so that the patterns are found whatever the colors of the
+    data area and the brightness of the background. The patterns are the dark contours containing a hole which itself
+    contains a dark core, of the expected relative areas.
+
+    :param frame: HSV camera frame
+    :param min_area: smallest area of a pattern, in pixels
+    :return: centers of the patterns, ordered as [top left, top right, bottom right, bottom left], or None if the four
+    patterns were not found
+    """
+    dark = cv2.adaptiveThreshold(frame[:, :, 2], 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV,
+                                 THRESHOLD_BLOCK_SIZE, THRESHOLD_OFFSET)
+    contoured_frame, contours, hierarchy = cv2.findContours(dark, mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None:
+        return None
+
+    candidates = []
+    for i, contour in enumerate(contours):
+        hole = hierarchy[0][i][2]
+        core = hierarchy[0][hole][2] if hole >= 0 else -1
+        if core < 0:
+            continue
+        area = cv2.contourArea(contour)
+        if area < min_area:
+            continue
+        if not (HOLE_AREA_RANGE[0] < cv2.contourArea(contours[hole]) / area < HOLE_AREA_RANGE[1] and
+                CORE_AREA_RANGE[0] < cv2.contourArea(contours[core]) / area < CORE_AREA_RANGE[1]):
+            continue
+
+        moments = cv2.moments(contour)
+        candidates.append((area, (moments['m10'] / moments['m00'], moments['m01'] / moments['m00'])))
+
+    if len(candidates) < 4:
+        return None
+    candidates = sorted(candidates, reverse=True)[:4]
+    if candidates[0][0] > MAX_AREA_RATIO * candidates[3][0]:
+        return None
+
+    centers = order_corners([center for area, center in candidates])
+    if not cv2.isContourConvex(centers.reshape(4, 1, 2)):
+        return None
+    return centers
+
+
+def locate_data_area(frame, layout, min_area) -> Optional[np.ndarray]:
+    """
+    Maps the data area of the layout into a camera frame, through the homography given by the finder patterns
+
+    :param frame: HSV camera frame
+    :param layout: FiducialLayout of the filmed screen
+    :param min_area: smallest area of a finder pattern, in pixels
+    :return: outer corners of the data area in the frame, ordered as [top left, top right, bottom right, bottom left],
+    or None if the finder patterns were not found
+    """
+    centers = find_finder_patterns(frame, min_area)
+    if centers is None:
+        return None
+    homography = cv2.getPerspectiveTransform(layout.get_marker_centers(), centers)
+    return cv2.perspectiveTransform(layout.get_data_corners().reshape(4, 1, 2), homography).reshape(4, 2)
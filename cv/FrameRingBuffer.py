@@ -0,0 +1,78 @@
+import numpy as np
+from typing import List, Optional, Tuple
+
+
+class FrameRingBuffer:
+    """
+    Preallocated ring buffer of timestamped frames, written by a single capture thread.
+
+    Readers get read-only views of the buffer slots, without copies and without holding any lock. A view stays valid
+    until size - 1 newer frames have been captured, which can be checked afterwards with is_valid. The oldest frame
+    is the next one to be overwritten, so readers must either check is_valid after using a view, or only read frames
+    captured well within the buffer duration and use them before it elapses (see Constants.FRAME_BUFFER_SIZE).
+    """
+
+    def __init__(self, size, shape):
+        self.size = size
+        self.shape = shape
+        self.frames = np.zeros((size,) + tuple(shape), dtype=np.uint8)
+        self.timestamps = np.full(size, -np.inf)
+        self.sequence_numbers = np.full(size, -1, dtype=np.int64)
+        self.last_sequence_number = -1
+
+    def get_write_slot(self) -> np.ndarray:
+        """Returns the slot in which the next frame has to be written, before calling publish"""
+        slot = (self.last_sequence_number + 1) % self.size
+        # The slot is invalidated while it is being written
+        self.sequence_numbers[slot] = -1
+        return self.frames[slot]
+
+    def publish(self, timestamp):
+        """Makes the frame written in the current write slot available to the readers"""
+        sequence_number = self.last_sequence_number + 1
+        slot = sequence_number % self.size
+        self.timestamps[slot] = timestamp
+        self.sequence_numbers[slot] = sequence_number
+        self.last_sequence_number = sequence_number
+
+    def is_valid(self, sequence_number) -> bool:
+        """Whether the frame with the given sequence number has not been overwritten yet"""
+        return sequence_number >= 0 and self.sequence_numbers[sequence_number % self.size] == sequence_number
+
+    def read(self, sequence_number) -> Optional[Tuple[int, float, np.ndarray]]:
+        """
+        :param sequence_number:
+        :return: (sequence number, timestamp, read-only frame view), or None if the frame is not available
+        """
+        if not self.is_valid(sequence_number):
+            return None
+
+        slot = sequence_number % self.size
+        frame = self.frames[slot].view()
+        frame.flags.writeable = False
+        return sequence_number, self.timestamps[slot], frame
+
+    def read_latest(self) -> Optional[Tuple[int, float, np.ndarray]]:
+        return self.read(self.last_sequence_number)
+
+    def read_closest(self, timestamp) -> Optional[Tuple[int, float, np.ndarray]]:
+        """Reads the available frame whose capture timestamp is the closest to the given timestamp"""
+        valid = self.sequence_numbers >= 0
+        if not valid.any():
+            return None
+
+        distances = np.where(valid, np.abs(self.timestamps - timestamp), np.inf)
+        return self.read(int(self.sequence_numbers[distances.argmin()]))
+
+    def read_between(self, start_time, end_time) -> List[Tuple[int, float, np.ndarray]]:
+        """Reads all the available frames captured within [start_time, end_time], ordered by sequence number"""
+        selected = (self.sequence_numbers >= 0) & (self.timestamps >= start_time) & (self.timestamps <= end_time)
+        frames = [self.read(int(s)) for s in np.sort(self.sequence_numbers[selected])]
+        return [frame for frame in frames if frame is not None]
+
+    def read_since(self, sequence_number) -> List[Tuple[int, float, np.ndarray]]:
+        """Reads all the available frames newer than the given sequence number, ordered by sequence number"""
+        last = self.last_sequence_number
+        first = max(sequence_number + 1, last - self.size + 1)
+        frames = [self.read(s) for s in range(first, last + 1)]
+        return [frame for frame in frames if frame is not None]
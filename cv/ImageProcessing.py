@@ -3,6 +3,11 @@ import numpy as np
 
 ERODE_KERNEL_SIZE = 5
 
+# OpenCV hues lie in [0, 180), so that a hue h corresponds to the angle h * 2pi / 180 on the color wheel.
+# The tables are indexed by the uint8 hue value, to avoid computing trigonometric functions on each pixel.
+HUE_COS = np.cos(np.arange(256) * 2.0 * np.pi / 180.0)
+HUE_SIN = np.sin(np.arange(256) * 2.0 * np.pi / 180.0)
+
 
 def u8clamp(x) -> np.uint8:
     return np.uint8(max(0, min(255, x)))
@@ -50,11 +55,90 @@ def compute_cyclic_score(value: np.float64, reference_value: np.float64) -> int:
     diff = adjusted_value - np.float64(90)
     return diff * diff
 
-def superimpose(big_frame, small_frame):
-    row, col, depth = small_frame.shape
-    big_frame[0:row, 0:col, :] = small_frame
 
-    return big_frame
+def compute_grid_hue_vectors(frame, rows, cols, margin=0.0):
+    """
+    Computes the mean hue unit vector of every cell of a rows x cols grid in a single pass over the frame. Unlike
+    hue means, the vectors of several frames can be averaged.
+    
+    :param frame: HSV frame
+    :param rows: number of rows of the grid
+    :param cols: number of columns of the grid
+    :param margin: proportion of each cell that is ignored (split between both borders), to avoid inter-cell bleeding
+    :return: (cos mean, sin mean), both arrays of shape (rows, cols)
+    """
+    cell_height = frame.shape[0] // rows
+    cell_width = frame.shape[1] // cols
+    border_y = int(cell_height * margin / 2.0)
+    border_x = int(cell_width * margin / 2.0)
+
+    cells = frame[:rows * cell_height, :cols * cell_width, 0].reshape(rows, cell_height, cols, cell_width)
+    cells = cells[:, border_y:cell_height - border_y, :, border_x:cell_width - border_x]
+
+    return HUE_COS[cells].mean(axis=(1, 3)), HUE_SIN[cells].mean(axis=(1, 3))
+
+
+def compute_grid_cyclic_hue_means(frame, rows, cols, margin=0.0):
+    """
+    Computes the circular hue mean of every cell of a rows x cols grid in a single pass over the frame
+    
+    :return: array of shape (rows, cols) with the hue mean of each cell, in [0, 180)
+    """
+    cos_mean, sin_mean = compute_grid_hue_vectors(frame, rows, cols, margin)
+    return hue_vector_to_hue(cos_mean, sin_mean)
+
+
+def hue_vector_to_hue(cos_mean, sin_mean):
+    """Converts (averaged) hue unit vectors back to hues in [0, 180)"""
+    return (np.arctan2(sin_mean, cos_mean) * 180.0 / (2.0 * np.pi)) % 180.0
+
+
+def get_quadrilateral(contour) -> np.ndarray:
+    """
+    Approximates a contour by its 4 corners, falling back on its minimum area rectangle when the polygonal
+    approximation does not give a quadrilateral
+    
+    :param contour: 
+    :return: float32 array of shape (4, 2), with (x, y) corners
+    """
+    perimeter = cv2.arcLength(contour, True)
+    for epsilon in (0.02, 0.05, 0.1):
+        approx = cv2.approxPolyDP(contour, epsilon * perimeter, True)
+        if len(approx) == 4:
+            return np.float32(approx[:, 0, :])
+
+    return np.float32(cv2.boxPoints(cv2.minAreaRect(contour)))
+
+
+def order_corners(corners) -> np.ndarray:
+    """Orders 4 (x, y) corners as [top left, top right, bottom right, bottom left]"""
+    corners = np.float32(corners).reshape(4, 2)
+    coord_sum = corners.sum(axis=1)
+    coord_diff = corners[:, 1] - corners[:, 0]
+
+    return np.float32([corners[coord_sum.argmin()], corners[coord_diff.argmin()],
+                       corners[coord_sum.argmax()], corners[coord_diff.argmax()]])
+
+
+def get_rectifying_homography(corners, width, height) -> np.ndarray:
+    """
+    Computes the homography mapping the screen quadrilateral onto a canonical width x height rectangle
+    
+    :param corners: outer screen corners, ordered as [top left, top right, bottom right, bottom left], where (0, 0)
+    is the center of the top left pixel
+    :param width: 
+    :param height: 
+    :return: 3x3 homography matrix
+    """
+    # The outer corners are mapped onto the outer corners of the rectangle, so that its border pixels are inside the
+    # screen
+    rectangle = np.float32([[-0.5, -0.5], [width - 0.5, -0.5], [width - 0.5, height - 0.5], [-0.5, height - 0.5]])
+    return cv2.getPerspectiveTransform(np.float32(corners), rectangle)
+
+
+def warp(frame, homography, width, height, dst=None):
+    """Warps the frame with the given homography into a width x height frame, optionally written to dst"""
+    return cv2.warpPerspective(frame, homography, (width, height), dst=dst, flags=cv2.INTER_LINEAR)
 
 
 def crop(frame, boundaries):
@@ -62,7 +146,3 @@ def crop(frame, boundaries):
     the default boundaries should then be [0, WIDTH, 0, HEIGHT]
     """
     return frame[boundaries[2]:boundaries[3] + 1, boundaries[0]:boundaries[1] + 1, :]
-
-if __name__ == '__main__':
-    print(np.float64(180.1) % np.float64(180))
-    print(compute_cyclic_score(np.uint8(170), np.uint8(0)))
@@ -0,0 +1,190 @@
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from cv.ImageProcessing import get_quadrilateral, order_corners, smooth_step, u8clamp
+
+OPEN_KERNEL = np.ones((3, 3), np.uint8)
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 20, 0.01)
+
+
+def get_detection_range(color_target, iteration, max_iteration):
+    """
+    HSV range of the screen color, which widens (in hue first) with the iteration, from the exact target color at
+    iteration 0 to the widest range at max_iteration
+
+    :return: (min hsv, max hsv)
+    """
+    max_delta_hue = 20
+    max_delta_saturation = 130
+    max_delta_value = 130
+
+    hue_delta_coeff = smooth_step(2.0 * iteration, 0, max_iteration)
+    delta_coeff = smooth_step(iteration, 0, max_iteration)
+
+    min_hsv = np.array([u8clamp(color_target - hue_delta_coeff * max_delta_hue),
+                        u8clamp(255 - delta_coeff * max_delta_saturation),
+                        u8clamp(255 - delta_coeff * max_delta_value)])
+    max_hsv = np.array([u8clamp(color_target + hue_delta_coeff * max_delta_hue), 255, 255], dtype=np.uint8)
+    return min_hsv, max_hsv
+
+
+def detect_screen(frame, min_hsv, max_hsv, levels, min_area, max_area, border) -> Optional[np.ndarray]:
+    """
+    Finds the screen quadrilateral on a coarse level of the frame. The levels are built by decimation rather than by
+    blurring, as averaging hues around the hue wrap-around would create colors that are not on the screen.
+
+    :param frame: full resolution HSV frame
+    :param min_hsv: lower bound of the screen color
+    :param max_hsv: upper bound of the screen color
+    :param levels: number of times the frame is decimated by 2
+    :param min_area: smallest screen area, in full resolution pixels
+    :param max_area: largest screen area, in full resolution pixels
+    :param border: width of the frame border in which the screen cannot lie, in full resolution pixels
+    :return: coarse screen corners at full resolution, ordered as [top left, top right, bottom right, bottom left],
+    or None if no screen was found
+    """
+    scale = 2 ** levels
+    coarse_frame = np.ascontiguousarray(frame[::scale, ::scale])
+    mask = cv2.morphologyEx(cv2.inRange(coarse_frame, min_hsv, max_hsv), cv2.MORPH_OPEN, OPEN_KERNEL)
+    contoured_frame, contours, hierarchy = cv2.findContours(mask, mode=cv2.RETR_EXTERNAL,
+                                                            method=cv2.CHAIN_APPROX_SIMPLE)
+    if not 10 > len(contours) > 0:
+        return None
+
+    height, width = mask.shape
+    border = border / scale
+    best_quadrilateral = None
+    best_area = 0
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if x < border or y < border or x + w > width - border or y + h > height - border:
+            continue
+
+        area = cv2.contourArea(contour) * scale * scale
+        quadrilateral = get_quadrilateral(contour)
+        if max_area > area > max(min_area, best_area) and cv2.isContourConvex(quadrilateral):
+            best_area = area
+            best_quadrilateral = quadrilateral
+
+    if best_quadrilateral is None:
+        return None
+    # Coarse pixel i covers the full resolution pixels [i * scale, (i + 1) * scale)
+    return order_corners(best_quadrilateral * scale + (scale - 1) / 2.0)
+
+
+def refine_corners(frame, corners, min_hsv, max_hsv, window) -> np.ndarray:
+    """
+    Refines the screen corners at full resolution, only looking at a small patch around each of them. The corners
+    are located with sub-pixel accuracy on the edges of the thresholded screen
+
+    :param frame: full resolution HSV frame
+    :param corners: coarse screen corners
+    :param min_hsv: lower bound of the screen color
+    :param max_hsv: upper bound of the screen color
+    :param window: half size of the corner search window, larger than the error of the coarse corners
+    :return: outer screen corners, where (0, 0) is the center of the top left pixel
+    """
+    height, width = frame.shape[:2]
+    refined_corners = np.float32(corners).copy()
+    half_size = 2 * window + 2
+
+    for i, (x, y) in enumerate(np.float32(corners)):
+        x0 = int(max(0, round(x) - half_size))
+        y0 = int(max(0, round(y) - half_size))
+        x1 = int(min(width, round(x) + half_size + 1))
+        y1 = int(min(height, round(y) + half_size + 1))
+        if x1 - x0 < 2 * window + 3 or y1 - y0 < 2 * window + 3:
+            continue
+
+        mask = cv2.morphologyEx(cv2.inRange(frame[y0:y1, x0:x1], min_hsv, max_hsv), cv2.MORPH_OPEN, OPEN_KERNEL)
+        patch = cv2.GaussianBlur(mask, (5, 5), 0)
+        corner = np.float32([[[x - x0, y - y0]]])
+        cv2.cornerSubPix(patch, corner, (window, window), (-1, -1), SUBPIX_CRITERIA)
+        refined_corners[i] = corner[0, 0] + (x0, y0)
+
+    return refined_corners
+
+
+def _get_peak_offset(before, peak, after) -> float:
+    """Sub-pixel offset of a peak, from the parabola through the scores around it"""
+    curvature = before - 2.0 * peak + after
+    if curvature >= 0.0:
+        return 0.0
+    return float(np.clip(0.5 * (before - after) / curvature, -0.5, 0.5))
+
+
+class ScreenTracker:
+    """
+    Tracks the screen corners in the camera frames after the screen detection, so that small camera motions are
+    followed without detecting the screen again.
+
+    A template is taken around each corner in the value channel of the frame in which the screen was detected. Screen
+    colors are displayed at full value, so that the templates do not depend on the displayed symbols. Each template is
+    then searched for around the last position of its corner with a normalized correlation, which is insensitive to
+    the exposure changes. The templates are never updated, so that the tracked positions do not drift.
+    """
+
+    def __init__(self, frame, corners, template_size, search_radius, min_score):
+        """
+        :param frame: BGR camera frame in which the corners were detected
+        :param corners: screen corners in this frame
+        :param template_size: half size of the corner templates
+        :param search_radius: largest motion of a corner between two updates, in pixels
+        :param min_score: lowest correlation score for which a corner is considered found
+        """
+        self.template_size = template_size
+        self.search_radius = search_radius
+        self.min_score = min_score
+        self.corners = np.float32(corners).copy()
+
+        # Templates are centered on the pixel closest to their corner, and the offset of the corner is kept
+        self.centers = np.round(self.corners).astype(np.int64)
+        self.offsets = self.corners - self.centers
+        self.templates = []
+        for x, y in self.centers:
+            template = _get_value_patch(frame, x, y, template_size)
+            if template is None or template.std() == 0:
+                self.templates = None
+                break
+            self.templates.append(template)
+
+    def update(self, frame) -> Optional[np.ndarray]:
+        """
+        :param frame: BGR camera frame
+        :return: the corners in this frame, or None if a corner was not found (the last corners are then kept)
+        """
+        if self.templates is None:
+            return None
+
+        corners = np.empty_like(self.corners)
+        for i, template in enumerate(self.templates):
+            x, y = np.round(self.corners[i] - self.offsets[i]).astype(np.int64)
+            region = _get_value_patch(frame, x, y, self.template_size + self.search_radius)
+            if region is None:
+                return None
+
+            scores = cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED)
+            min_score, max_score, min_location, (peak_x, peak_y) = cv2.minMaxLoc(scores)
+            if max_score < self.min_score:
+                return None
+
+            dx = dy = 0.0
+            if 0 < peak_x < scores.shape[1] - 1:
+                dx = _get_peak_offset(scores[peak_y, peak_x - 1], max_score, scores[peak_y, peak_x + 1])
+            if 0 < peak_y < scores.shape[0] - 1:
+                dy = _get_peak_offset(scores[peak_y - 1, peak_x], max_score, scores[peak_y + 1, peak_x])
+            # The peak is at the top left corner of the matched template, relative to the top left of the region
+            corners[i] = (x - self.search_radius + peak_x + dx + self.offsets[i][0],
+                          y - self.search_radius + peak_y + dy + self.offsets[i][1])
+
+        self.corners = corners
+        return corners
+
+
+def _get_value_patch(frame, x, y, half_size) -> Optional[np.ndarray]:
+    """Value channel (maximum of the BGR channels) of the square patch centered on (x, y), None if it is not inside"""
+    if x - half_size < 0 or y - half_size < 0 or x + half_size >= frame.shape[1] or y + half_size >= frame.shape[0]:
+        return None
+    return frame[y - half_size:y + half_size + 1, x - half_size:x + half_size + 1].max(axis=2)
@@ -0,0 +1,102 @@
+import cv2
+import numpy as np
+from typing import Tuple
+
+from cv.ImageProcessing import HUE_COS, HUE_SIN, compute_grid_hue_vectors, hue_vector_to_hue
+
+
+class SymbolClassifier:
+    """
+    Classifies frames against a set of reference hues. The circular hue mean of a frame is computed once, from its
+    hue histogram, and is then compared to all the references at once.
+    """
+
+    def __init__(self, references):
+        """
+        :param references: 1D array of reference hues. It is not copied, so that calibration updates of the
+        references (e.g. of SYMBOLS) are taken into account
+        """
+        self.references = references
+
+    def compute_hue_mean(self, frame) -> np.float64:
+        """Circular hue mean of an HSV frame, in [0, 180)"""
+        histogram = cv2.calcHist([frame], [0], None, [180], [0, 180]).ravel()
+        return self.compute_histogram_hue_mean(histogram)
+
+    def compute_frames_hue_mean(self, frames) -> np.float64:
+        """Circular hue mean of several HSV frames, from their accumulated hue histogram"""
+        histogram = np.zeros(180, dtype=np.float32)
+        for frame in frames:
+            histogram += cv2.calcHist([frame], [0], None, [180], [0, 180]).ravel()
+        return self.compute_histogram_hue_mean(histogram)
+
+    def compute_histogram_hue_mean(self, histogram) -> np.float64:
+        """Circular hue mean of a (possibly accumulated) 180 bins hue histogram, in [0, 180)"""
+        cos_sum = np.dot(histogram, HUE_COS[:180])
+        sin_sum = np.dot(histogram, HUE_SIN[:180])
+        return np.float64(hue_vector_to_hue(cos_sum, sin_sum))
+
+    def compute_distances(self, hues) -> np.ndarray:
+        """
+        Cyclic distance of each hue to each reference
+
+        :param hues: array of hues, of any shape
+        :return: array of shape hues.shape + (number of references,)
+        """
+        diff = np.asarray(hues, dtype=np.float64)[..., np.newaxis] - np.asarray(self.references, dtype=np.float64)
+        return np.abs((diff + 90.0) % 180.0 - 90.0)
+
+    def classify_hues(self, hues) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the closest reference of each hue
+
+        :param hues: array of hues, of any shape
+        :return: the reference indices, and the confidence margins, i.e. the distance difference between the second
+        closest and the closest references
+        """
+        distances = self.compute_distances(hues)
+        closest = np.partition(distances, 1, axis=-1)
+
+        return distances.argmin(axis=-1), closest[..., 1] - closest[..., 0]
+
+    def classify(self, frame) -> Tuple[int, np.float64]:
+        """
+        Classifies a whole HSV frame as a single symbol
+
+        :param frame:
+        :return: the reference index and its confidence margin
+        """
+        return self.classify_frames([frame])
+
+    def classify_frames(self, frames) -> Tuple[int, np.float64]:
+        """
+        Classifies several HSV frames of the same symbol period as a single symbol, from their aggregated hues
+
+        :param frames:
+        :return: the reference index and its confidence margin
+        """
+        indices, margins = self.classify_hues(self.compute_frames_hue_mean(frames))
+        return int(indices), np.float64(margins)
+
+    def classify_grid(self, frames, rows, cols, margin=0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Classifies each cell of a grid, from the hues aggregated over several HSV frames of the same symbol period
+
+        :param frames:
+        :param rows: number of rows of the grid
+        :param cols: number of columns of the grid
+        :param margin: proportion of each cell that is ignored, to avoid inter-cell bleeding
+        :return: the reference indices and confidence margins of the cells, row by row
+        """
+        return self.classify_hues(self.compute_grid_hues(frames, rows, cols, margin))
+
+    def compute_grid_hues(self, frames, rows, cols, margin=0.0) -> np.ndarray:
+        """Circular hue mean of each cell of a grid over several HSV frames, row by row"""
+        cos_sum = np.zeros((rows, cols))
+        sin_sum = np.zeros((rows, cols))
+        for frame in frames:
+            cos_mean, sin_mean = compute_grid_hue_vectors(frame, rows, cols, margin)
+            cos_sum += cos_mean
+            sin_sum += sin_mean
+
+        return hue_vector_to_hue(cos_sum, sin_sum).ravel()
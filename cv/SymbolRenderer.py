@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+
+
+class SymbolRenderer:
+    """
+    Renders grids of symbols into full resolution BGR frames. The colors of the cells are looked up in a small palette
+    (or converted from HSV on the grid itself), and the grid is then upscaled with a nearest neighbour lookup: one
+    line of pixels is built per grid row, and broadcast over the rows of its cells. Rendering a frame is thus mostly a
+    memory copy, whatever the size of the grid.
+
+    The cells have the layout that the receiver reads: cells of (height // rows) x (width // cols) pixels from the top
+    left corner, the remaining pixels being black.
+
+    The frames are rendered into a ring of reusable output buffers, so that a frame stays valid until buffer_count
+    other frames have been rendered, or into the given frames, e.g. views on the data area of larger frames.
+    """
+
+    def __init__(self, width, height, buffer_count=3):
+        """
+        :param width: width of the rendered frames
+        :param height: height of the rendered frames
+        :param buffer_count: number of output buffers, i.e. of rendered frames that can be in use at the same time,
+        0 if the frames are always rendered into given frames
+        """
+        self.width = width
+        self.height = height
+        self.buffers = [np.zeros((height, width, 3), dtype=np.uint8) for i in range(0, buffer_count)]
+        self.buffer_index = 0
+        # Column of the grid of each pixel column, by grid shape, and BGR palette of the last hue constellation
+        self.layouts = {}
+        self.palette_key = None
+        self.palette = None
+
+    def _get_column_map(self, rows, cols) -> np.ndarray:
+        """Grid column of each pixel column, cols (the extra black column of the grid) for the remaining pixels"""
+        column_map = self.layouts.get((rows, cols))
+        if column_map is None:
+            cell_width = self.width // cols
+            column_map = np.full(self.width, cols, dtype=np.intp)
+            column_map[:cols * cell_width] = np.arange(cols).repeat(cell_width)
+            self.layouts[(rows, cols)] = column_map
+        return column_map
+
+    def _get_palette(self, hues) -> np.ndarray:
+        """BGR colors of the given hues, converted once per constellation"""
+        hues = np.uint8(hues)
+        if self.palette_key != hues.tobytes():
+            hsv_colors = np.full((1, len(hues), 3), 255, dtype=np.uint8)
+            hsv_colors[0, :, 0] = hues
+            self.palette = cv2.cvtColor(hsv_colors, cv2.COLOR_HSV2BGR)[0]
+            self.palette_key = hues.tobytes()
+        return self.palette
+
+    def _get_output(self, out) -> np.ndarray:
+        if out is not None:
+            return out
+        out = self.buffers[self.buffer_index]
+        self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+        return out
+
+    def render_bgr_grid(self, bgr_grid, out=None) -> np.ndarray:
+        """
+        Upscales a grid of BGR colors to a full frame
+
+        :param bgr_grid: array of shape (rows, cols, 3), with one color per cell
+        :param out: frame to render into, the next output buffer when None
+        :return: the rendered frame
+        """
+        out = self._get_output(out)
+        rows, cols = bgr_grid.shape[:2]
+        cell_height = self.height // rows
+
+        # The extra black column fills the pixels on the right of the last cells. Unlike fancy indexing, take returns
+        # contiguous lines, which are broadcast as plain memory copies
+        padded_grid = np.zeros((rows, cols + 1, 3), dtype=np.uint8)
+        padded_grid[:, :cols] = bgr_grid
+        lines = padded_grid.take(self._get_column_map(rows, cols), axis=1)
+        for r in range(0, rows):
+            out[r * cell_height:(r + 1) * cell_height] = lines[r]
+        out[rows * cell_height:] = 0
+        return out
+
+    def render_symbol_grid(self, symbol_indices, hues, out=None) -> np.ndarray:
+        """
+        Renders a grid of symbols with a palette lookup
+
+        :param symbol_indices: 2D array of symbol indices, of shape (rows, cols)
+        :param hues: hue of each symbol
+        :param out: frame to render into, the next output buffer when None
+        :return: the rendered frame
+        """
+        return self.render_bgr_grid(self._get_palette(hues)[symbol_indices], out)
+
+    def render_hue_grid(self, color_matrix, out=None) -> np.ndarray:
+        """Renders a grid of hues, of shape (rows, cols), at full saturation and value"""
+        hsv_grid = np.full(np.shape(color_matrix) + (3,), 255, dtype=np.uint8)
+        hsv_grid[..., 0] = color_matrix
+        return self.render_hsv_grid(hsv_grid, out)
+
+    def render_hsv_grid(self, hsv_grid, out=None) -> np.ndarray:
+        """Renders a grid of HSV colors, of shape (rows, cols, 3), e.g. with black cells"""
+        return self.render_bgr_grid(cv2.cvtColor(np.uint8(hsv_grid), cv2.COLOR_HSV2BGR), out)
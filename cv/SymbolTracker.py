@@ -0,0 +1,57 @@
+import math
+
+import numpy as np
+
+from cv.ImageProcessing import hue_vector_to_hue
+
+
+class SymbolTracker:
+    """
+    Tracks the hue centroid and spread of each symbol online, from the hues measured for symbols whose value is known
+    (confirmed by the RS decoder, or pilot symbols), so that the classification follows slow changes of the channel
+    such as the ambient light, without recalibrating.
+
+    Centroids are exponentially weighted moving averages of the hue unit vectors, and spreads are exponentially
+    weighted RMS deviations from the centroids.
+    """
+
+    def __init__(self, hues, rate=0.1, spreads=None):
+        """
+        :param hues: calibrated hue of each symbol
+        :param rate: weight of each new measurement in the moving averages
+        :param spreads: spread of each symbol from a previous session (0 if it was not measured), which the first
+        measurements of this session quickly replace
+        """
+        self.rate = rate
+        # The centroids are updated in place, so that they can be used as the references of a SymbolClassifier
+        self.centroids = np.array(hues, dtype=np.float64)
+        angles = self.centroids * 2.0 * np.pi / 180.0
+        self.cos_means = np.cos(angles)
+        self.sin_means = np.sin(angles)
+        self.spreads = np.zeros(len(self.centroids)) if spreads is None else np.array(spreads, dtype=np.float64)
+        self.counts = np.int64(self.spreads > 0)
+
+    def update(self, symbol_indices, hues):
+        """
+        :param symbol_indices: known symbol indices
+        :param hues: hue measured for each of these symbols
+        :return:
+        """
+        for index, hue in zip(symbol_indices, hues):
+            deviation = (hue - self.centroids[index] + 90.0) % 180.0 - 90.0
+
+            # The first deviations are averaged uniformly, until the moving average takes over
+            self.counts[index] += 1
+            spread_rate = max(self.rate, 1.0 / self.counts[index])
+            self.spreads[index] = math.sqrt((1.0 - spread_rate) * self.spreads[index] ** 2 +
+                                            spread_rate * deviation ** 2)
+
+            angle = hue * 2.0 * np.pi / 180.0
+            self.cos_means[index] += self.rate * (math.cos(angle) - self.cos_means[index])
+            self.sin_means[index] += self.rate * (math.sin(angle) - self.sin_means[index])
+            self.centroids[index] = hue_vector_to_hue(self.cos_means[index], self.sin_means[index])
+
+    def get_spreads(self, symbol_indices, default_spread) -> np.ndarray:
+        """Tracked spread of the given symbols, or the default spread for the symbols that were not measured yet"""
+        symbol_indices = np.asarray(symbol_indices, dtype=np.intp)
+        return np.where(self.counts[symbol_indices] > 0, self.spreads[symbol_indices], default_spread)
@@ -0,0 +1,122 @@
+import logging
+
+import numpy as np
+
+# Only one pixel out of SUBSAMPLING in each direction is used to measure frame-to-frame changes
+SUBSAMPLING = 4
+
+
+class ClockRecovery:
+    """
+    Tracks the transmitter symbol clock from the stream of captured frames.
+
+    Symbol transitions are detected from the frame-to-frame hue (and value) change, and a delay-locked loop updates
+    the estimated phase and period of the symbol clock with the timing error of each detected transition.
+    Transitions are indexed from the clock reference: transition n happens at time reference_time + n * period.
+    """
+
+    def __init__(self, reference_time, period, phase_gain=0.3, period_gain=0.05, change_threshold=10.0,
+                 dark_value=40):
+        """
+        :param reference_time: time of the transition with index 0
+        :param period: nominal symbol period
+        :param phase_gain: proportion of the timing error corrected on the phase
+        :param period_gain: proportion of the timing error (per elapsed symbol) corrected on the period
+        :param change_threshold: mean frame-to-frame change above which a transition is detected
+        :param dark_value: value below which the hue of a pixel is noise, and only its value change is measured
+        """
+        self.reference_index = 0
+        self.reference_time = reference_time
+        self.period = period
+        self.nominal_period = period
+        self.phase_gain = phase_gain
+        self.period_gain = period_gain
+        self.change_threshold = change_threshold
+        self.dark_value = dark_value
+
+        self.last_sequence_number = -1
+        self.previous_frame = None
+        self.previous_timestamp = None
+        # Consecutive frame pairs above the threshold belong to the same transition (e.g. when a frame was exposed
+        # during the transition), whose time is the change-weighted mean of the pairs times
+        self.burst_weight = 0.0
+        self.burst_time = 0.0
+        self.transition_count = 0
+
+    def get_transition_time(self, index):
+        """Estimated time of the transition with the given index"""
+        return self.reference_time + (index - self.reference_index) * self.period
+
+    def set_period(self, index, period):
+        """
+        Changes the symbol period from the transition with the given index on, e.g. after a modulation change
+
+        :param index: index of the first transition at the new period
+        :param period: new nominal symbol period
+        :return:
+        """
+        self.reference_time = self.get_transition_time(index)
+        self.reference_index = index
+        self.period = period
+        self.nominal_period = period
+
+    def update(self, timestamped_frames, is_valid=None):
+        """
+        Processes newly captured frames
+
+        :param timestamped_frames: list of (sequence number, timestamp, HSV frame), ordered by sequence number
+        :param is_valid: optional function telling whether the frame with the given sequence number was not
+        overwritten, for frames that are views of a ring buffer (the oldest one may be overwritten while it is read)
+        :return:
+        """
+        for sequence_number, timestamp, frame in timestamped_frames:
+            if sequence_number <= self.last_sequence_number:
+                continue
+            self.last_sequence_number = sequence_number
+
+            subsampled_frame = np.int16(frame[::SUBSAMPLING, ::SUBSAMPLING, :])
+            if is_valid is not None and not is_valid(sequence_number):
+                continue
+            if self.previous_frame is not None and self.previous_frame.shape == subsampled_frame.shape:
+                change = self._compute_change(self.previous_frame, subsampled_frame)
+                pair_time = (self.previous_timestamp + timestamp) / 2.0
+
+                if change > self.change_threshold:
+                    self.burst_weight += change
+                    self.burst_time += change * pair_time
+                elif self.burst_weight > 0:
+                    self._on_transition(self.burst_time / self.burst_weight)
+                    self.burst_weight = 0.0
+                    self.burst_time = 0.0
+
+            self.previous_frame = subsampled_frame
+            self.previous_timestamp = timestamp
+
+    def _compute_change(self, previous_frame, frame) -> np.float64:
+        hue_diff = np.abs(frame[:, :, 0] - previous_frame[:, :, 0])
+        hue_diff = np.minimum(hue_diff, 180 - hue_diff)
+        # Otherwise, a black screen would be seen as a continuous transition
+        hue_diff[(frame[:, :, 2] < self.dark_value) | (previous_frame[:, :, 2] < self.dark_value)] = 0
+        # Value changes are scaled to the hue range, so that black outs are detected as transitions too
+        value_diff = np.abs(frame[:, :, 2] - previous_frame[:, :, 2]) * (90.0 / 255.0)
+        return max(hue_diff.mean(), value_diff.mean())
+
+    def _on_transition(self, transition_time):
+        index = self.reference_index + int(np.round((transition_time - self.reference_time) / self.period))
+        if index <= self.reference_index:
+            return
+
+        error = transition_time - self.get_transition_time(index)
+        if abs(error) > 0.4 * self.period:
+            # Too far from any expected transition to be trusted
+            return
+
+        elapsed_symbols = index - self.reference_index
+        self.reference_time = self.get_transition_time(index) + self.phase_gain * error
+        self.reference_index = index
+        self.period += self.period_gain * error / elapsed_symbols
+        # The period can only drift slightly from the nominal transmitter rate
+        self.period = np.clip(self.period, 0.9 * self.nominal_period, 1.1 * self.nominal_period)
+        self.transition_count += 1
+
+        logging.debug("Transition " + str(index) + " timing error: " + str(error) + " period: " + str(self.period))
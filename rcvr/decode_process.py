@@ -0,0 +1,196 @@
+import collections
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from cv.SymbolClassifier import SymbolClassifier
+from utils.SharedRing import SharedRing
+
+# Largest constellation that can be classified (6 bits per symbol)
+MAX_REFERENCES = 64
+# Period at which both processes poll their ring when it is empty
+POLL_PERIOD = 0.0002
+# Tick of the request that terminates the worker
+STOP_TICK = -1
+
+REQUEST_DTYPE = np.dtype([('tick', np.int64), ('first_frame', np.int64), ('frame_count', np.int64),
+                          ('rows', np.int32), ('cols', np.int32), ('margin', np.float64),
+                          ('reference_count', np.int32), ('references', np.float64, MAX_REFERENCES)])
+
+
+def get_result_dtype(cell_count) -> np.dtype:
+    # The shapes are tuples, as numpy makes a scalar field of a subarray of size 1
+    return np.dtype([('tick', np.int64), ('decode_time', np.float64), ('indices', np.int64, (cell_count,)),
+                     ('margins', np.float64, (cell_count,)), ('hues', np.float64, (cell_count,))])
+
+
+def _run_worker(frame_memory_name, frame_shape, slot_count, request_ring_name, result_ring_name, queue_size,
+                cell_count):
+    """Decoding loop of the worker process, which attaches to the shared memory blocks of the DecodeProcess"""
+    frame_memory = shared_memory.SharedMemory(name=frame_memory_name)
+    frames = np.ndarray((slot_count,) + tuple(frame_shape), dtype=np.uint8, buffer=frame_memory.buf)
+    requests = SharedRing(REQUEST_DTYPE, queue_size, request_ring_name)
+    results = SharedRing(get_result_dtype(cell_count), queue_size, result_ring_name)
+    classifier = SymbolClassifier(None)
+
+    while True:
+        request = requests.peek()
+        if request is None:
+            time.sleep(POLL_PERIOD)
+            continue
+        if request['tick'] == STOP_TICK:
+            break
+
+        start_time = time.perf_counter()
+        slots = (request['first_frame'] + np.arange(request['frame_count'])) % slot_count
+        tick_frames = [frames[slot] for slot in slots]
+        classifier.references = request['references'][:request['reference_count']].copy()
+        if request['rows'] > 0:
+            hues = classifier.compute_grid_hues(tick_frames, int(request['rows']), int(request['cols']),
+                                                float(request['margin']))
+        else:
+            hues = np.array([classifier.compute_frames_hue_mean(tick_frames)])
+        indices, margins = classifier.classify_hues(hues)
+
+        result = results.get_write_slot()
+        while result is None:
+            time.sleep(POLL_PERIOD)
+            result = results.get_write_slot()
+        result['tick'] = request['tick']
+        result['indices'] = indices
+        result['margins'] = margins
+        result['hues'] = hues
+        result['decode_time'] = time.perf_counter() - start_time
+        results.publish()
+        requests.release()
+
+    del frames
+    requests.close()
+    results.close()
+    frame_memory.close()
+
+
+class DecodeProcess:
+    """
+    Symbol decoding stage running in a separate process, so that the hue computations do not compete for the GIL
+    with the capture, display and state machine threads.
+
+    The frames of each tick are copied into a ring of frame slots in shared memory, and the tick is submitted through
+    a lock-free request ring. The worker classifies the tick and sends the detected symbols back through a result
+    ring. The ticks are decoded in submission order, so that the frame slots are freed in order too.
+    """
+
+    def __init__(self, frame_shape, cell_count, slot_count, queue_size):
+        """
+        :param frame_shape: shape of the HSV frames
+        :param cell_count: number of symbols per tick, i.e. of grid cells
+        :param slot_count: number of frames that can be submitted and not decoded yet
+        :param queue_size: number of ticks that can be submitted and not decoded yet
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.slot_count = slot_count
+        self.frame_memory = shared_memory.SharedMemory(create=True, size=slot_count * int(np.prod(frame_shape)))
+        self.frames = np.ndarray((slot_count,) + self.frame_shape, dtype=np.uint8, buffer=self.frame_memory.buf)
+        self.requests = SharedRing(REQUEST_DTYPE, queue_size)
+        self.results = SharedRing(get_result_dtype(cell_count), queue_size)
+
+        # Total number of frames written to the slots and freed by the decoded ticks, and the number of frames of
+        # each submitted tick that was not decoded yet
+        self.written_frame_count = 0
+        self.freed_frame_count = 0
+        self.pending_frame_counts = collections.deque()
+        self.decoded_ticks = {}
+
+        # The worker is spawned, as forking a process running capture and GUI threads is unsafe
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=_run_worker, args=(
+            self.frame_memory.name, self.frame_shape, slot_count, self.requests.name, self.results.name, queue_size,
+            cell_count))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, tick, frames, references, rows=0, cols=0, margin=0.0):
+        """
+        Submits the frames of a tick for decoding, waiting for free slots if needed
+
+        :param tick: identifier of the tick, with which its result is retrieved
+        :param frames: HSV frames of the tick, of the frame shape of the stage
+        :param references: hues of the symbols
+        :param rows: number of rows of the grid, 0 to classify the whole frame as a single symbol
+        :param cols: number of columns of the grid
+        :param margin: proportion of each cell that is ignored
+        :return:
+        """
+        # Only the last frames are kept if there are more frames than slots
+        frames = frames[-self.slot_count:]
+        request = self.requests.get_write_slot()
+        while request is None or self.written_frame_count + len(frames) - self.freed_frame_count > self.slot_count:
+            self._wait_for_results()
+            request = self.requests.get_write_slot()
+
+        first_frame = self.written_frame_count
+        for frame in frames:
+            self.frames[self.written_frame_count % self.slot_count] = frame
+            self.written_frame_count += 1
+
+        request['tick'] = tick
+        request['first_frame'] = first_frame
+        request['frame_count'] = len(frames)
+        request['rows'] = rows
+        request['cols'] = cols
+        request['margin'] = margin
+        request['reference_count'] = len(references)
+        request['references'][:len(references)] = references
+        self.requests.publish()
+        self.pending_frame_counts.append(len(frames))
+
+    def get_result(self, tick):
+        """
+        Waits for the result of a submitted tick
+
+        :return: (hues, symbol indices, classification margins, decoding time) of the tick
+        """
+        while tick not in self.decoded_ticks:
+            self._wait_for_results()
+        return self.decoded_ticks.pop(tick)
+
+    def _wait_for_results(self):
+        if not self._read_results():
+            if not self.process.is_alive():
+                raise RuntimeError("The decode process terminated")
+            time.sleep(POLL_PERIOD)
+
+    def _read_results(self) -> bool:
+        """Reads the available results, and frees the frame slots of their ticks"""
+        read = False
+        result = self.results.peek()
+        while result is not None:
+            self.decoded_ticks[int(result['tick'])] = (result['hues'].copy(), result['indices'].copy(),
+                                                       result['margins'].copy(), float(result['decode_time']))
+            self.results.release()
+            self.freed_frame_count += self.pending_frame_counts.popleft()
+            read = True
+            result = self.results.peek()
+        return read
+
+    def close(self):
+        """Stops the worker and frees the shared memory"""
+        request = self.requests.get_write_slot()
+        while request is None and self.process.is_alive():
+            self._wait_for_results()
+            request = self.requests.get_write_slot()
+        if request is not None:
+            request['tick'] = STOP_TICK
+            self.requests.publish()
+
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.frames = None
+        self.requests.close()
+        self.results.close()
+        self.frame_memory.close()
+        self.frame_memory.unlink()
@@ -1,13 +1,21 @@
 import collections
+import platform
 import sys
 from enum import Enum
 
-import unireedsolomon
 from unireedsolomon import RSCodecError
 
 from State_Machine import *
 from cv.ImageProcessing import *
+from cv.SymbolClassifier import SymbolClassifier
+from cv.SymbolTracker import SymbolTracker
+from rcvr.decode_process import DecodeProcess
 from utils import Constants
+from utils.Modulation import encode_choice, get_candidates, get_evenly_spaced_hues, get_hue_statistics, \
+    predict_seen_hues, select_modulation
+from utils.ReedSolomonCodec import ReedSolomonCodec
+from utils.SharedRing import is_store_ordered
+from utils.SymbolCodec import bytes_to_symbols, get_byte_confidences, symbols_to_bytes
 from utils.Symbols import *
 
 logging.basicConfig(format='%(module)15s # %(levelname)s: %(message)s', level=logging.INFO)
@@ -19,6 +27,7 @@ class State(Enum):
     STAND_BY = 'Stand by'
     SYNC_CLOCK = 'Sync clock'
     CALIBRATE = 'Calibrate colors'
+    NEGOTIATE = 'Negotiate modulation'
     FIND_SCREEN = 'Find screen'
     RECEIVE = 'Receive'
     CHECK = 'Check'
@@ -34,27 +43,66 @@ class Receiver(State_Machine):
     DUMMY_MASK[200:300, 200:400] = np.uint8(1)
     DUMMY_MASK = np.dstack([DUMMY_MASK] * 3)
 
-    def __init__(self):
-        State_Machine.__init__(self)
+    # Period at which the screen is polled while waiting for the transmitter to black out (above the camera frame rate)
+    SYNC_POLL_PERIOD = 1.0 / 120.0
+
+    def __init__(self, output_file_name="../decoded.txt", cap=None, cv_handler=None, name=None):
+        """
+        :param output_file_name: file written with the received data
+        :param cap: capture backend of the link
+        :param cv_handler: display backend of the link
+        :param name: name of the receiver in the instrumentation
+        """
+        State_Machine.__init__(self, cap, cv_handler, name)
 
         self.state = State.SCREEN_DETECTION
+        self.output_file_name = output_file_name
         self.data_packet = np.array
         self.decoded_packet_count = 0
         self.decoded_sequence = collections.deque()
+        # Number of bytes of the file, carried by the first packet
+        self.file_size = None
         self.bitCount = 0
         self.screen_mask = None
-        self.rs_coder = unireedsolomon.RSCoder(Constants.RS_codeword_size, Constants.RS_message_size)
-
-        if Constants.SIMULATE:
+        self.rs_codec = ReedSolomonCodec()
+        # Per packet slot: the number of bytes corrected by the RS decoder (None if decoding failed), and the
+        # detected symbols
+        self.corrected_error_counts = []
+        self.received_symbol_log = []
+        self.classifier = SymbolClassifier(self.symbols)
+        self.tracker = None
+        # Hues measured for each symbol of the current packet, and the confidence of each symbol
+        self.packet_hues = None
+        self.packet_confidences = None
+        # Candidate index of the selected modulation, and the estimated symbol error rate of each candidate
+        self.modulation_choice = None
+        self.modulation_estimates = None
+        # Whether a warm start from the calibration profile is offered, and the last hue of the transmitter screen
+        # before it blacked out, which tells whether it accepted it
+        self.warm_start = False
+        self.peer_hue = None
+
+        # Sliding window state, indexed by absolute sequence numbers
+        self.next_expected_seq = 0
+        self.receive_buffer = {}
+
+        self.decode_process = None
+        self.submitted_tick_count = 0
+        if Constants.DECODE_PROCESS and not is_store_ordered():
+            # The decode process would only be started with the first data packet
+            raise RuntimeError("DECODE_PROCESS is only supported on x86 machines, not on " + platform.machine())
+
+        if Constants.SIMULATE and self.cap is None:
             simulation_handler = Constants.SIMULATION_HANDLER
             self.cv_handler = simulation_handler.rcvr
             self.cap = simulation_handler.rcvr
 
         print('Initialized rcvr at state ' + str(self.state))
-        time.sleep(1)
+        self.clock.sleep(1)
 
     def run(self):
         while True:
+            State_Machine.record_state_time(self)
             if self.state == State.IDLE:
                 self.do_idle()
             elif self.state == State.SCREEN_DETECTION:
@@ -63,6 +111,8 @@ class Receiver(State_Machine):
                 self.do_sync()
             elif self.state == State.CALIBRATE:
                 self.do_calibrate()
+            elif self.state == State.NEGOTIATE:
+                self.do_negotiate()
             elif self.state == State.RECEIVE:
                 self.do_receive()
             elif self.state == State.CHECK:
@@ -86,10 +136,16 @@ class Receiver(State_Machine):
         :return: 
         """
         self.cv_handler.display_hsv_color(S_NO_ACK)
-        State_Machine.compute_screen_boundaries(self, S_ACK)
-        self.cap.set_screen_boundaries(self.screen_boundaries)
-
-        self.cv_handler.display_hsv_color(S_ACK)
+        State_Machine.load_calibration_profile(self)
+        # The modulation of the profile is sent to the transmitter as a candidate index during the warm start
+        if self.profile is not None and \
+                (not Constants.ADAPTIVE_MODULATION or State_Machine.get_profile_choice(self) is not None):
+            self.warm_start = State_Machine.restore_screen(self, S_ACK)
+        if not self.warm_start:
+            State_Machine.compute_screen_boundaries(self, S_ACK)
+        State_Machine.set_capture_screen(self)
+
+        self.cv_handler.display_hsv_color(S_WARM_ACK if self.warm_start else S_ACK)
         self.state = State.SYNC_CLOCK
         logging.info("Receiver finished the Screen detection phase")
         return
@@ -114,108 +170,348 @@ class Receiver(State_Machine):
         value_mean = self.get_value_mean()
         # logging.info("value mean: " + str(value_mean))
         if value_mean < 80:
-            current_time = time.time()
+            current_time = self.clock.time()
             self.clock_start = current_time + State_Machine.SAMPLING_OFFSET
-
-            self.state = State.CALIBRATE
-            self.cv_handler.black_out()
+            if Constants.CLOCK_RECOVERY:
+                State_Machine.start_clock_recovery(self, current_time)
+
+            # The transmitter accepts the warm start by showing the warm start ACK back before blacking out
+            warm_start = self.warm_start and compute_cyclic_score(self.peer_hue, np.float64(S_WARM_ACK)) < \
+                compute_cyclic_score(self.peer_hue, np.float64(S_ACK))
+            if not warm_start:
+                self.cv_handler.black_out()
             logging.info("Clock start is: " + str(self.clock_start) + " Time is " + str(current_time))
-            logging.info("Receiver finished the synchronization phase")
             State_Machine.sleep_until_next_tick(self)
 
+            if warm_start and self._check_profile_modulation():
+                self._restore_calibration()
+                self.state = State.RECEIVE
+            else:
+                self.state = State.CALIBRATE
+            logging.info("Receiver finished the synchronization phase")
+        else:
+            if self.warm_start:
+                self.peer_hue = State_Machine.get_cyclic_hue_mean_to_reference(self, S_WARM_ACK)
+            self.clock.sleep(Receiver.SYNC_POLL_PERIOD)
+
+    def _check_profile_modulation(self) -> bool:
+        """
+        Warm start: sends the index of the modulation of the receiver profile as in the negotiation, and reads whether
+        the transmitter confirms that its profile has the same modulation. Both sides otherwise fall back to the
+        calibration.
+
+        :return: whether the warm start goes on with the modulation of the profiles
+        """
+        if not Constants.ADAPTIVE_MODULATION:
+            return True
+
+        if self.profile.ack_hues is not None:
+            self.ack_hues[:] = self.profile.ack_hues
+        State_Machine.send_choice_bits(self, encode_choice(State_Machine.get_profile_choice(self)))
+        matches = State_Machine.read_confirmation(self)
+        if not matches:
+            logging.warning("The transmitter profile has another modulation, falling back to the calibration")
+        return matches
+
+    def _restore_calibration(self):
+        """Warm start: switches to the modulation and the symbol calibration of the profile, skipping the calibration"""
+        if Constants.ADAPTIVE_MODULATION:
+            State_Machine.set_modulation(self, self.profile.num_bits, self.profile.symbol_period)
+        self.symbols = np.uint8(np.round(self.profile.symbols) % 180)
+        self.classifier = SymbolClassifier(self.symbols)
+        logging.info("Warm start with symbols " + str(self.symbols) + " and spreads " +
+                     str(np.round(self.profile.spreads, 2)))
+
+        self._start_tracking(self.profile.spreads)
+        if Constants.SLIDING_WINDOW:
+            self._display_window_feedback()
+        else:
+            self.cv_handler.black_out()
+
+    def _save_calibration_profile(self):
+        """Stores the calibrated symbols, or their tracked centroids and spreads, and the ACK hues seen by the camera"""
+        if self.tracker is not None:
+            State_Machine.save_calibration_profile(self, self.tracker.centroids,
+                                                   self.tracker.get_spreads(np.arange(len(self.symbols)), 0.0),
+                                                   ack_hues=self.ack_hues.tolist())
+        else:
+            State_Machine.save_calibration_profile(self, self.symbols, ack_hues=self.ack_hues.tolist())
+
     def do_calibrate(self):
 
-        for i in range(0, NUM_SYMBOLS):
+        if Constants.ADAPTIVE_MODULATION:
+            self._probe_channel()
+            self.state = State.NEGOTIATE
+            return
+
+        for i in range(0, len(self.symbols)):
             hue_mean = 0.0
 
             for x in range(0, 3):
                 # hue_mean += State_Machine.get_hue_mean(self)
-                hue_mean += State_Machine.get_cyclic_hue_mean_to_reference(self, SYMBOLS[i])
+                hue_mean += State_Machine.get_cyclic_hue_mean_to_reference(self, self.symbols[i])
 
                 State_Machine.sleep_until_next_tick(self)
 
             hue_mean = np.round(hue_mean / 3.0)
             logging.info("hue mean : " + str(hue_mean))
-            SYMBOLS[i] = np.round(hue_mean)
+            self.symbols[i] = np.round(hue_mean)
 
-        for i in range(0, NUM_SYMBOLS):
-            logging.info("symbol " + str(i) + " : " + str(SYMBOLS[i]))
+        for i in range(0, len(self.symbols)):
+            logging.info("symbol " + str(i) + " : " + str(self.symbols[i]))
+
+        self._start_tracking()
+        self._save_calibration_profile()
+        if Constants.SLIDING_WINDOW:
+            self._display_window_feedback()
 
         self.state = State.RECEIVE
 
+    def _probe_channel(self):
+        """
+        Measures the hue offset and noise of the link on the probe hues shown by the transmitter, and selects the
+        modulation with the highest bit rate that meets the target symbol error rate
+
+        :return:
+        """
+        probe_hues = get_evenly_spaced_hues(Constants.MODULATION_PROBE_COUNT)
+        samples = []
+        frame_count = 0
+
+        for i in range(0, len(probe_hues)):
+            probe_samples = []
+            for x in range(0, Constants.MODULATION_PROBE_TICKS):
+                frames = State_Machine.read_symbol_frames(self)
+                frame_count += len(frames)
+                probe_samples.extend(self._get_frame_hues(frame) for frame in frames)
+                State_Machine.sleep_until_next_tick(self)
+            samples.append(probe_samples)
+
+        seen_hues, hue_stds = get_hue_statistics(probe_hues, samples)
+        frames_per_tick = frame_count / float(len(probe_hues) * Constants.MODULATION_PROBE_TICKS)
+        logging.info("Probe hues seen as " + str(np.round(seen_hues, 1)) + " with deviations " +
+                     str(np.round(hue_stds, 2)) + ", " + str(frames_per_tick) + " frames per tick")
+
+        # The ACK hues of the negotiation are seen as the probe hues around them
+        self.ack_hues[:] = predict_seen_hues(probe_hues, seen_hues, hue_stds, [S_NO_ACK, S_ACK])[0]
+        self.modulation_choice, self.modulation_estimates = select_modulation(probe_hues, seen_hues, hue_stds,
+                                                                              frames_per_tick, self.symbol_period)
+        logging.info("Selected modulation " + str(get_candidates()[self.modulation_choice]) + " with estimated " +
+                     "symbol error rate " + str(self.modulation_estimates[self.modulation_choice]))
+
+    def _get_frame_hues(self, frame):
+        """Hue of a frame, or of each of its grid cells in grid mode"""
+        if Constants.GRID_MODE:
+            return compute_grid_cyclic_hue_means(frame, Constants.GRID_ROWS, Constants.GRID_COLS,
+                                                 Constants.GRID_CELL_MARGIN).ravel()
+        return np.array([self.classifier.compute_hue_mean(frame)])
+
+    def do_negotiate(self):
+        """
+        Sends the index of the selected modulation to the transmitter, one bit per MODULATION_CHOICE_TICKS ticks
+        (ACK for 1, NO ACK for 0), and reads the bits echoed by the transmitter. It then confirms the choice with
+        repeated ACKs if the echo matches, or sends repeated NO ACKs and negotiates again. Once confirmed, switches to
+        that modulation and calibrates its constellation
+
+        :return:
+        """
+        bits = encode_choice(self.modulation_choice)
+        while True:
+            State_Machine.send_choice_bits(self, bits)
+            echoed_bits = State_Machine.read_choice_bits(self, len(bits))
+            confirmed = echoed_bits == bits
+            State_Machine.send_confirmation(self, confirmed)
+            if confirmed:
+                break
+            logging.warning("Modulation choice " + str(bits) + " echoed back as " + str(echoed_bits) +
+                            ", negotiating again")
+
+        num_bits, symbol_period = get_candidates()[self.modulation_choice]
+        State_Machine.set_modulation(self, num_bits, symbol_period)
+        self.classifier = SymbolClassifier(self.symbols)
+
+        # The transmitter shows each symbol of the new constellation in turn
+        for i in range(0, len(self.symbols)):
+            frames = []
+            for x in range(0, Constants.MODULATION_TRAINING_TICKS):
+                # The frames are kept over several ticks, longer than the capture ring buffer keeps them
+                if Constants.MULTI_FRAME_INTEGRATION:
+                    frames.extend(frame.copy() for frame in State_Machine.read_symbol_frames(self))
+                else:
+                    frames.append(State_Machine.read_symbol_frame(self)[1].copy())
+                State_Machine.sleep_until_next_tick(self)
+            self.symbols[i] = np.round(self.classifier.compute_frames_hue_mean(frames)) % 180
+
+        logging.info("Calibrated symbols: " + str(self.symbols))
+
+        self._start_tracking()
+        self._save_calibration_profile()
+        if Constants.SLIDING_WINDOW:
+            self._display_window_feedback()
+
+        self.state = State.RECEIVE
+
+    def _start_tracking(self, spreads=None):
+        """
+        From now on, the calibrated symbols are tracked, and classified against the tracked centroids
+
+        :param spreads: spreads of the symbols in a previous session, if any
+        """
+        if Constants.SYMBOL_TRACKING:
+            self.tracker = SymbolTracker(self.symbols, Constants.TRACKING_RATE, spreads)
+            self.classifier = SymbolClassifier(self.tracker.centroids)
+
     def do_receive(self):
 
         logging.info("Decoding packet number " + str(self.decoded_packet_count))
 
-        processed_b = 0
-        num_unset_bits = 8
-        byte_idx = 0
-        self.data_packet = np.empty(12, np.uint8)
-        self.cv_handler.display_hsv_color(140)
+        num_ticks = State_Machine.get_ticks_per_packet(self)
+        symbol_indices = []
+        hues = []
+        confidences = []
 
-        for i in range(0, Constants.num_symbols_per_data_packet):
+        tick_results = []
+        for i in range(0, num_ticks):
             # hue_mean = State_Machine.get_hue_mean(self)
             # logging.info("hue mean : " + str(hue_mean))
 
-            ret, frame = self.cap.readHSVFrame()
+            if Constants.MULTI_FRAME_INTEGRATION:
+                frames = State_Machine.read_symbol_frames(self)
+            else:
+                ret, frame = State_Machine.read_symbol_frame(self)
+                frames = [frame]
 
-            detected_symbol = np.array(
-                [np.abs(self.compute_cyclic_hue_mean_to_reference(frame, ref) - ref) for ref in SYMBOLS]).argmin()
+            if Constants.DECODE_PROCESS:
+                # The tick is decoded while waiting for the next one
+                self._submit_tick(self.submitted_tick_count + i, frames)
+            else:
+                tick_results.append(self._decode_tick(frames))
 
-            logging.info("detected symbol: " + str(detected_symbol))
+            if not i == num_ticks - 1:
+                State_Machine.sleep_until_next_tick(self)
 
-            if i == 31:
-                self.cv_handler.display_hsv_color(60)
-            if i == 30:
-                self.cv_handler.display_hsv_color(90)
-            if i == 29:
-                self.cv_handler.display_hsv_color(160)
+        if Constants.DECODE_PROCESS:
+            tick_results = [self._get_tick_result(self.submitted_tick_count + i) for i in range(0, num_ticks)]
+            self.submitted_tick_count += num_ticks
+
+        for tick_hues, detected_symbols, margins in tick_results:
+            logging.info("detected symbols: " + str(detected_symbols) + " with margins " + str(np.round(margins)))
+            symbol_indices.extend(detected_symbols)
+            hues.extend(tick_hues)
+            confidences.extend(self._get_confidences(detected_symbols, margins))
+
+        num_symbols = State_Machine.get_symbols_per_packet(self)
+        self.packet_hues = hues[:num_symbols]
+        self.packet_confidences = confidences[:num_symbols]
+        self.received_symbol_log.append(symbol_indices[:num_symbols])
+        self.data_packet = symbols_to_bytes(symbol_indices[:num_symbols], self.rs_codec.packet_size, self.num_bits)
+        self.state = State.VALIDATE_DATA
 
-            if i == 28:
-                self.cv_handler.display_hsv_color(30)
-            if i == 29:
-                self.cv_handler.display_hsv_color(55)
-            if i == 30:
-                self.cv_handler.display_hsv_color(0)
+    def _decode_tick(self, frames):
+        """
+        Classifies the frames of a tick
 
-            if num_unset_bits >= NUM_BITS:
-                processed_b |= detected_symbol << num_unset_bits - NUM_BITS
-                num_unset_bits -= NUM_BITS
-            else:
-                bit_shift = NUM_BITS - num_unset_bits
-                processed_b |= detected_symbol >> bit_shift
-                self.data_packet[byte_idx] = processed_b
-                byte_idx += 1
-                processed_b = (detected_symbol & (2 ** bit_shift - 1)) << 8 - bit_shift
-                num_unset_bits = 8 - (NUM_BITS - num_unset_bits)
-
-            if not i == Constants.num_symbols_per_data_packet - 1:
-                State_Machine.sleep_until_next_tick(self)
+        :return: the hues, the detected symbols and the classification margins of the symbols of the tick
+        """
+        decode_start = time.perf_counter()
+        if Constants.GRID_MODE:
+            # All the cells are decoded at once, row by row
+            tick_hues = self.classifier.compute_grid_hues(frames, Constants.GRID_ROWS, Constants.GRID_COLS,
+                                                          Constants.GRID_CELL_MARGIN)
+        else:
+            tick_hues = np.array([self.classifier.compute_frames_hue_mean(frames)])
+        detected_symbols, margins = self.classifier.classify_hues(tick_hues)
+        self.instrumentation.observe("symbol_decode_seconds",
+                                     (time.perf_counter() - decode_start) / len(detected_symbols))
+        return tick_hues, detected_symbols, margins
+
+    def _submit_tick(self, tick, frames):
+        """Submits the frames of a tick to the decode process, which is (re)started for the shape of the frames"""
+        if self.decode_process is None or self.decode_process.frame_shape != np.shape(frames[0]):
+            if self.decode_process is not None:
+                self.decode_process.close()
+            cell_count = Constants.GRID_ROWS * Constants.GRID_COLS if Constants.GRID_MODE else 1
+            self.decode_process = DecodeProcess(np.shape(frames[0]), cell_count, Constants.DECODE_FRAME_SLOTS,
+                                                Constants.DECODE_QUEUE_SIZE)
+
+        if Constants.GRID_MODE:
+            self.decode_process.submit(tick, frames, self.classifier.references, Constants.GRID_ROWS,
+                                       Constants.GRID_COLS, Constants.GRID_CELL_MARGIN)
+        else:
+            self.decode_process.submit(tick, frames, self.classifier.references)
 
-        self.data_packet[byte_idx] = processed_b
-        self.state = State.VALIDATE_DATA
+    def _get_tick_result(self, tick):
+        tick_hues, detected_symbols, margins, decode_time = self.decode_process.get_result(tick)
+        self.instrumentation.observe("symbol_decode_seconds", decode_time / len(detected_symbols))
+        return tick_hues, detected_symbols, margins
+
+    def _get_confidences(self, symbol_indices, margins):
+        """
+        Confidence of each detected symbol: the distance of its hue to the decision boundary with the second closest
+        symbol (half the margin), in units of the spread of the symbol
+
+        :param symbol_indices:
+        :param margins: classification margins, i.e. the distance differences between the second closest and the
+        closest symbols
+        :return: array of confidences
+        """
+        if self.tracker is not None:
+            spreads = np.maximum(self.tracker.get_spreads(symbol_indices, Constants.SOFT_DECISION_DEFAULT_SPREAD),
+                                 Constants.SOFT_DECISION_MIN_SPREAD)
+        else:
+            spreads = Constants.SOFT_DECISION_DEFAULT_SPREAD
+        return np.asarray(margins, dtype=np.float64) / 2.0 / spreads
+
+    def _decode_packet(self):
+        """
+        RS decodes the current packet. In soft decision mode, the codewords that cannot be decoded are decoded again
+        with their least confident bytes as erasures.
+
+        :return: the decoded message and the number of corrected bytes
+        :raise RSCodecError: when the packet cannot be decoded
+        """
+        if Constants.SOFT_DECISION:
+            byte_confidences = get_byte_confidences(self.packet_confidences, self.rs_codec.packet_size, self.num_bits)
+            return self.rs_codec.decode_soft(self.data_packet, byte_confidences, Constants.ERASURE_THRESHOLD,
+                                             self.rs_codec.n - self.rs_codec.k - Constants.ERASURE_RESERVE)
+
+        return self.rs_codec.decode(self.data_packet)
 
     def do_check(self):
         pass
 
     def do_validate_data(self):
-        global msg
+        msg = None
+        if State_Machine.is_pilot_slot(self, len(self.received_symbol_log) - 1):
+            self._validate_pilot()
+            return
+
         try:
-            msg, ecc = self.rs_coder.decode(self.data_packet, return_string=False)
-            data_is_valid = all(b < 128 for b in msg)
+            with self.instrumentation.timer("rs_decode"):
+                msg, corrected_count = self._decode_packet()
+            data_is_valid = True
+            self.corrected_error_counts.append(corrected_count)
+            if self.tracker is not None:
+                # The corrected packet gives the symbols that were actually sent
+                self.tracker.update(bytes_to_symbols(self.rs_codec.encode(msg), self.num_bits), self.packet_hues)
+            if corrected_count > 0:
+                logging.info("RS decoder corrected " + str(corrected_count) + " bytes")
         except RSCodecError:
             data_is_valid = False
+            self.corrected_error_counts.append(None)
+            self.instrumentation.count("rs_decode_failures_total")
+
+        if Constants.SLIDING_WINDOW:
+            self._validate_window_data(msg if data_is_valid else None)
+            return
 
         if data_is_valid:
             self.decoded_packet_count = self.decoded_packet_count + 1
             self.cv_handler.display_hsv_color(S_ACK)
-            for b in msg:
-                if b == Constants.END_OF_FILE_MARKER:
-                    self.state = State.WRITE_TO_FILE
-                    logging.info("Received end of file marker. Transmission terminated.")
-                    return
-                else:
-                    self.decoded_sequence.append(b)
+            if self._deliver_payload(msg):
+                self.state = State.WRITE_TO_FILE
+                logging.info("Received the whole file. Transmission terminated.")
+                return
             logging.info("Received message : " + ''.join([chr(b) for b in msg]))
             logging.info("Sent ACK to transmitter")
         else:
@@ -232,13 +528,90 @@ class Receiver(State_Machine):
         if self.decoded_packet_count % 5 == 0:
             logging.info("So far, received: " + ''.join([chr(b) for b in self.decoded_sequence]))
 
+    def _validate_pilot(self):
+        """The symbols of pilot slots are known, and only update the tracked centroids"""
+        self.corrected_error_counts.append(None)
+        self.tracker.update(State_Machine.get_pilot_symbols(self), self.packet_hues)
+        logging.info("Tracked centroids: " + str(np.round(self.tracker.centroids, 1)))
+
+        self._display_window_feedback()
+        State_Machine.sleep_until_next_tick(self)
+        self.state = State.RECEIVE
+
+    def _validate_window_data(self, msg):
+        """
+        Selective repeat: valid packets within the receive window are buffered and delivered in order, and the
+        feedback pattern is updated without pausing the transmission.
+
+        :param msg: the decoded RS message, or None if the packet could not be decoded
+        :return:
+        """
+        if msg is None:
+            logging.info("Could not decode packet")
+        else:
+            offset = (int(msg[0]) - self.next_expected_seq) % Constants.ARQ_SEQUENCE_MODULUS
+            if offset < Constants.ARQ_WINDOW_SIZE:
+                self.receive_buffer[self.next_expected_seq + offset] = msg[1:]
+                logging.info("Received packet " + str(self.next_expected_seq + offset))
+            else:
+                logging.info("Received duplicate packet with sequence number " + str(msg[0]))
+
+        end_of_file = False
+        while self.next_expected_seq in self.receive_buffer and not end_of_file:
+            end_of_file = self._deliver_payload(self.receive_buffer.pop(self.next_expected_seq))
+            self.next_expected_seq += 1
+            self.decoded_packet_count += 1
+
+        self._display_window_feedback()
+        State_Machine.sleep_until_next_tick(self)
+
+        if end_of_file:
+            logging.info("Received the whole file. Transmission terminated.")
+            # The final ACK is kept on screen until the transmitter has seen it
+            for i in range(0, (Constants.ARQ_TIMEOUT_PACKETS + 1) * State_Machine.get_ticks_per_packet(self)):
+                State_Machine.sleep_until_next_tick(self)
+            self.state = State.WRITE_TO_FILE
+        else:
+            self.state = State.RECEIVE
+
+    def _deliver_payload(self, payload) -> bool:
+        """
+        Appends the file bytes of a packet delivered in order. The first packet carries the number of bytes of the
+        file, and the zero padding of the last packet is dropped.
+
+        :return: True when the whole file was received
+        """
+        if self.file_size is None:
+            self.file_size = int.from_bytes(bytes(payload), 'big')
+            logging.info("Receiving a file of " + str(self.file_size) + " bytes")
+        else:
+            self.decoded_sequence.extend(payload[:self.file_size - len(self.decoded_sequence)])
+        return len(self.decoded_sequence) >= self.file_size
+
+    def _display_window_feedback(self):
+        """Displays the cumulative ACK, and then the bitmap of the packets received after it, one symbol per cell"""
+        bitmap = 0
+        for i in range(0, Constants.ARQ_WINDOW_SIZE - 1):
+            if self.next_expected_seq + 1 + i in self.receive_buffer:
+                bitmap |= 1 << i
+
+        cells = np.zeros(State_Machine.get_arq_feedback_cells(self), dtype=np.int64)
+        cells[0] = self.next_expected_seq % Constants.ARQ_SEQUENCE_MODULUS
+        for i in range(1, len(cells)):
+            cells[i] = (bitmap >> (i - 1) * NUM_BITS) & BIT_MASK
+
+        self.cv_handler.display_hsv_grid(SYMBOLS[cells].reshape(1, -1))
+
     def do_write_to_file(self):
 
-        with open("../decoded.txt", "wb") as f:
-            for byte in self.decoded_sequence:
-                f.write(byte)
+        with open(self.output_file_name, "wb") as f:
+            f.write(bytes(self.decoded_sequence))
 
         logging.info("Wrote file")
+        self._save_calibration_profile()
+        if self.decode_process is not None:
+            self.decode_process.close()
+        State_Machine.export_instrumentation(self)
         self.cv_handler.kill()
         sys.exit(0)
 
@@ -116,6 +116,8 @@ def main_contour():
         time.sleep(0.1)
 
         ret, frame = cap.readHSVFrame()
+        if not ret:
+            continue
 
         hue_delta_coeff = smooth_step(2.0 * iteration, min_iteration, max_iteration)
         delta_coeff = smooth_step(iteration, min_iteration, max_iteration)
@@ -224,6 +226,8 @@ def pass_through():
         last_frame_time = time.time()
         ret, frame = cap.readHSVFrame()
         frame_time = time.time()
+        if not ret:
+            continue
 
         frame_count = frame_count + 1
 
@@ -0,0 +1,102 @@
+import mmap
+import os
+
+# Number of packets whose symbol stream is computed ahead of the send loop
+DEFAULT_LOOKAHEAD = 8
+
+
+class Packetizer:
+    """
+    Splits a file (or a part of it) into fixed size packet payloads, handed out as zero-copy memoryview slices of the
+    memory-mapped file. The first payload is a header carrying the number of bytes sent, as a big-endian integer, so
+    that the receiver drops the zero padding of the last payload, and any byte value can be sent.
+
+    The symbol streams of the packets are computed lazily through the given encode function, for the requested
+    packet and the next lookahead packets, and are kept until the packet is released.
+    """
+
+    def __init__(self, file_name, payload_size, encode_function, lookahead=DEFAULT_LOOKAHEAD, offset=0, length=None):
+        """
+        :param file_name:
+        :param payload_size: number of file bytes per packet
+        :param encode_function: function (packet indices, payloads) -> symbol indices of each packet, so that the
+        packets are encoded in batches
+        :param lookahead: number of packets encoded ahead
+        :param offset: offset of the first byte to send
+        :param length: number of bytes to send, until the end of the file by default
+        """
+        self.payload_size = payload_size
+        self.encode_function = encode_function
+        self.lookahead = lookahead
+        file_size = os.path.getsize(file_name)
+        offset = min(offset, file_size)
+        self.file_size = file_size - offset if length is None else min(length, file_size - offset)
+        if self.file_size >= 256 ** payload_size:
+            raise ValueError("The header payload of " + str(payload_size) + " bytes cannot carry a size of " +
+                             str(self.file_size) + " bytes")
+
+        self.file = open(file_name, "rb")
+        if self.file_size > 0:
+            self.mapped_file = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.file_view = memoryview(self.mapped_file)
+            self.data = self.file_view[offset:offset + self.file_size]
+        else:
+            # Empty files cannot be memory-mapped
+            self.mapped_file = None
+            self.file_view = memoryview(b'')
+            self.data = self.file_view
+
+        self.header = memoryview(self.file_size.to_bytes(payload_size, 'big'))
+        # Only the last payload is copied, to zero pad the remaining bytes
+        self.full_payload_count = self.file_size // payload_size
+        last_payload = bytearray(payload_size)
+        remaining_bytes = self.data[self.full_payload_count * payload_size:]
+        last_payload[:len(remaining_bytes)] = remaining_bytes
+        self.last_payload = memoryview(last_payload)
+
+        # Header, full payloads, and the padded last payload if the size is not a multiple of the payload size
+        self.payload_count = 1 + self.full_payload_count + (1 if len(remaining_bytes) > 0 else 0)
+        self.next_packet_index = 0
+        self.encoded_packets = {}
+
+    def has_next(self) -> bool:
+        return self.next_packet_index < self.payload_count
+
+    def next_index(self) -> int:
+        """Index of the next packet that was not sent yet, which is then considered sent"""
+        index = self.next_packet_index
+        self.next_packet_index += 1
+        return index
+
+    def get_payload(self, index) -> memoryview:
+        if index == 0:
+            return self.header
+        if index > self.full_payload_count:
+            return self.last_payload
+        return self.data[(index - 1) * self.payload_size:index * self.payload_size]
+
+    def get_symbols(self, index):
+        """Symbol stream of the given packet, encoding the following packets too if they were not yet encoded"""
+        indices = [i for i in range(index, min(index + 1 + self.lookahead, self.payload_count))
+                   if i not in self.encoded_packets]
+        if len(indices) > 0:
+            symbols = self.encode_function(indices, [self.get_payload(i) for i in indices])
+            self.encoded_packets.update(zip(indices, symbols))
+
+        return self.encoded_packets[index]
+
+    def release(self, index):
+        """The packet was acknowledged, and will not be sent again"""
+        self.encoded_packets.pop(index, None)
+
+    def close(self):
+        self.encoded_packets.clear()
+        self.file.close()
+        try:
+            self.data.release()
+            self.file_view.release()
+            if self.mapped_file is not None:
+                self.mapped_file.close()
+        except BufferError:
+            # Payload views are still referenced, the file is unmapped once they are garbage collected
+            pass
@@ -2,10 +2,13 @@ import collections
 import sys
 from enum import Enum
 
-import unireedsolomon
-
 from State_Machine import *
+from cv.SymbolClassifier import SymbolClassifier
+from snd.packetizer import Packetizer
 from utils import Constants
+from utils.Modulation import decode_choice, get_candidates, get_choice_bit_count, get_evenly_spaced_hues
+from utils.ReedSolomonCodec import ReedSolomonCodec
+from utils.SymbolCodec import bytes_to_symbols
 from utils.Symbols import *
 
 logging.basicConfig(format='%(module)15s # %(levelname)s: %(message)s', level=logging.INFO)
@@ -17,33 +20,73 @@ class State(Enum):
     STAND_BY = 'Stand by'
     SYNC_CLOCK = 'Sync clock'
     CALIBRATE = 'Calibrate colors'
+    NEGOTIATE = 'Negotiate modulation'
     SEND = 'Send'
     RECEIVE = 'Receive'
     WAIT_FOR_ACK = 'Wait'
 
 
+def get_payload_size(rs_codec) -> int:
+    """Number of file bytes per packet, the first byte of each message being the sequence number with the window"""
+    return rs_codec.message_size - 1 if Constants.SLIDING_WINDOW else rs_codec.message_size
+
+
 class Transmitter(State_Machine):
-    def __init__(self, file_name):
-        State_Machine.__init__(self)
+    # Time during which the warm start ACK is shown back to the receiver before blacking out (above the camera delay)
+    WARM_ACK_HOLD = 0.2
+
+    def __init__(self, file_name, cap=None, cv_handler=None, name=None, offset=0, length=None):
+        """
+        :param file_name: file to transmit
+        :param cap: capture backend of the link
+        :param cv_handler: display backend of the link
+        :param name: name of the transmitter in the instrumentation
+        :param offset: offset of the part of the file to transmit (the stripe of this link)
+        :param length: length of the part of the file to transmit, until the end of the file by default
+        """
+        State_Machine.__init__(self, cap, cv_handler, name)
         self.state = State.SCREEN_DETECTION
-        self.byte_sequence = collections.deque()
         self.packet_count = 0
-        self.last_data_packet = None
+        self.current_packet_index = None
         self.receiver_ack = True
-        self.rs_coder = unireedsolomon.RSCoder(Constants.RS_codeword_size, Constants.RS_message_size)
-
-        if Constants.SIMULATE:
+        self.retransmission_count = 0
+        # Whether the screen was found at the corners of the calibration profile, allowing a warm start
+        self.profile_restored = False
+        self.rs_codec = ReedSolomonCodec()
+        # The receiver feedback is always sent with the NUM_BITS constellation, classified against its hues as seen
+        # by the camera, which are updated in place with the ACK hues
+        self.feedback_hues = SYMBOLS.astype(np.float64)
+        self.classifier = SymbolClassifier(self.feedback_hues)
+
+        # Sliding window state, indexed by absolute sequence numbers
+        self.next_seq = 0
+        self.window_base = 0
+        self.window = collections.OrderedDict()
+        self.selectively_acked = set()
+        # Feedback pattern of the previous read, only applied once read twice in a row
+        self.pending_feedback = None
+        self.last_sent_slot = {}
+        self.packet_slot = 0
+
+        # Symbols sent in each packet slot (None when the screen stayed black), used to measure symbol error rates
+        self.sent_symbol_log = []
+
+        if Constants.SIMULATE and self.cap is None:
             simulation_handler = Constants.SIMULATION_HANDLER
             self.cv_handler = simulation_handler.tmtr
             self.cap = simulation_handler.tmtr
 
         logging.info('Initialized snd at state ' + str(self.state))
 
-        self._load_file(file_name)
+        self.packetizer = Packetizer(file_name, get_payload_size(self.rs_codec), self._encode_packets, offset=offset,
+                                     length=length)
+        self.cv_handler.prerender_hsv_colors(np.concatenate((self.symbols, [S_ACK, S_NO_ACK])))
+        logging.info("Loaded file")
 
     def run(self):
 
         while True:
+            State_Machine.record_state_time(self)
             if self.state == State.IDLE:
                 self.do_idle()
             elif self.state == State.SCREEN_DETECTION:
@@ -52,11 +95,15 @@ class Transmitter(State_Machine):
                 self.do_sync()
             elif self.state == State.CALIBRATE:
                 self.do_calibrate()
+            elif self.state == State.NEGOTIATE:
+                self.do_negotiate()
             elif self.state == State.SEND:
-                if len(self.byte_sequence) > 0:
+                if self.packetizer.has_next() or len(self.window) > 0:
                     self.do_send()
                 else:
                     logging.info("Transmission finished")
+                    self.packetizer.close()
+                    State_Machine.export_instrumentation(self)
                     self.cv_handler.kill()
                     sys.exit(0)
             elif self.state == State.RECEIVE:
@@ -68,7 +115,7 @@ class Transmitter(State_Machine):
                 raise NotImplementedError('Undefined snd state')
 
     def do_idle(self):
-        time.sleep(1)
+        self.clock.sleep(1)
 
     def do_find_screen(self):
         """
@@ -80,13 +127,22 @@ class Transmitter(State_Machine):
         """
 
         self.cv_handler.display_hsv_color(S_NO_ACK)
-        State_Machine.compute_screen_boundaries(self, S_NO_ACK)
-        self.cap.set_screen_boundaries(self.screen_boundaries)
+        State_Machine.load_calibration_profile(self)
+        if self.profile is not None and self.profile.ack_hues is not None:
+            self.profile_restored = State_Machine.restore_screen(self, S_NO_ACK)
+
+        if self.profile_restored:
+            State_Machine.set_capture_screen(self)
+            self.ack_hues[:] = self.profile.ack_hues
+            self._calibrate_feedback_hues()
+        else:
+            State_Machine.compute_screen_boundaries(self, S_NO_ACK)
+            State_Machine.set_capture_screen(self)
 
-        time.sleep(0.2)
+            self.clock.sleep(0.2)
 
-        # Calibrate no acks
-        self._calibrate_noacks()
+            # Calibrate no acks
+            self._calibrate_noacks()
 
         self.cv_handler.display_hsv_color(S_ACK)
         self.state = State.SYNC_CLOCK
@@ -110,15 +166,27 @@ class Transmitter(State_Machine):
         while not self.receiver_ack:
 
             State_Machine._align_clock(self)
-            ack_score, no_ack_score = State_Machine.get_ack_scores(self)
-
-            logging.info("Ack score: " + str(ack_score) + " No ack score: " + str(no_ack_score))
-
-            if ack_score < no_ack_score:
-                logging.info("Got ack from receiver.")
-                self._calibrate_acks()
+            ack_score, no_ack_score, warm_ack_score = State_Machine.get_sync_scores(self)
+
+            logging.info("Ack score: " + str(ack_score) + " No ack score: " + str(no_ack_score) +
+                         " Warm ack score: " + str(warm_ack_score))
+
+            if min(ack_score, warm_ack_score) < no_ack_score:
+                # A warm start offered by the receiver is only accepted with a profile of the same screen
+                warm_start = self.profile_restored and warm_ack_score < ack_score
+                if warm_start:
+                    logging.info("Got warm start ack from receiver.")
+                    self.cv_handler.display_hsv_color(S_WARM_ACK)
+                    self.clock.sleep(Transmitter.WARM_ACK_HOLD)
+                elif warm_ack_score < ack_score:
+                    # The receiver falls back to the calibration when the warm start is not shown back, and the ACK
+                    # hue is then not the one seen
+                    logging.info("Declining the warm start of the receiver.")
+                else:
+                    logging.info("Got ack from receiver.")
+                    self._calibrate_acks()
 
-                curr_time = time.time()
+                curr_time = self.clock.time()
                 self.clock_start = curr_time
 
                 logging.info(
@@ -128,71 +196,287 @@ class Transmitter(State_Machine):
 
                 # Screen goes black, meaning that at next epoch second, receiver clock fires up and get in sync
                 self.cv_handler.black_out()
-                self.state = State.CALIBRATE
                 State_Machine.sleep_until_next_tick(self)
+                if warm_start and self._check_profile_modulation():
+                    self._restore_modulation()
+                    self.state = State.SEND
+                else:
+                    self.state = State.CALIBRATE
                 logging.info("Transmitter finished the synchronization phase")
             else:
                 logging.info("NO ACK")
 
+    def _check_profile_modulation(self) -> bool:
+        """
+        Warm start: reads the index of the modulation of the receiver profile, sent as in the negotiation, and
+        confirms it when it matches the modulation of the transmitter profile. Both sides otherwise fall back to the
+        calibration, as the profiles were not saved together.
+
+        :return: whether the warm start goes on with the modulation of the profiles
+        """
+        if not Constants.ADAPTIVE_MODULATION:
+            return True
+
+        receiver_choice = decode_choice(State_Machine.read_choice_bits(self, get_choice_bit_count()))
+        matches = receiver_choice == State_Machine.get_profile_choice(self)
+        State_Machine.send_confirmation(self, matches)
+        if not matches:
+            logging.warning("The receiver profile has the modulation choice " + str(receiver_choice) + ", not " +
+                            str(State_Machine.get_profile_choice(self)) + ", falling back to the calibration")
+        return matches
+
+    def _restore_modulation(self):
+        """Warm start: switches to the modulation of the calibration profile, skipping the calibration"""
+        if Constants.ADAPTIVE_MODULATION:
+            State_Machine.set_modulation(self, self.profile.num_bits, self.profile.symbol_period)
+            self.cv_handler.prerender_hsv_colors(self.symbols)
+        logging.info("Warm start with " + str(self.num_bits) + " bits per symbol, with a symbol period of " +
+                     str(self.symbol_period) + " s")
+
+    def _save_calibration_profile(self):
+        State_Machine.save_calibration_profile(self, self.symbols, ack_hues=self.ack_hues.tolist())
+
     def do_send(self):
-        data_packet = collections.deque()
+        if Constants.SLIDING_WINDOW:
+            self._do_send_window()
+            return
 
         if self.receiver_ack:
             self.receiver_ack = False
+            if self.current_packet_index is not None:
+                self.packetizer.release(self.current_packet_index)
+            self.current_packet_index = self.packetizer.next_index()
             self.packet_count = self.packet_count + 1
             logging.info("Transmitting data packet: " + str(self.packet_count))
-            for i in range(0, Constants.RS_message_size):
-                next_byte = self.byte_sequence.popleft() if len(self.byte_sequence) > 0 else bytes([0])
-                data_packet.append(next_byte[0])
         else:
             logging.warning("Retransmitting previous data packet")
-            data_packet = self.last_data_packet
+            self.retransmission_count += 1
 
-        self.last_data_packet = data_packet.copy()
-        self._send_packet(data_packet)
+        self._send_packet(self.packetizer.get_symbols(self.current_packet_index))
         self.state = State.WAIT_FOR_ACK
 
-    def _send_packet(self, data: collections.deque):
+    def _do_send_window(self):
         """
-        Send one byte starting from the least significant bit
-        
-        :param data: 
-        :return: 
+        Selective repeat: packets are streamed back to back, and the receiver feedback is read between packets.
+        Lost packets are retransmitted first, then new packets are sent while the window is not full. Otherwise,
+        the screen stays black for one packet duration, so that the receiver keeps its packet alignment.
+
+        :return:
+        """
+        self._read_window_feedback()
+        if State_Machine.is_pilot_slot(self, self.packet_slot):
+            logging.info("Transmitting pilot symbols")
+            self._send_packet(State_Machine.get_pilot_symbols(self), is_pilot=True)
+            self.packet_slot += 1
+            return
+
+        seq = self._select_window_packet()
+
+        if seq is None:
+            if len(self.window) == 0 and not self.packetizer.has_next():
+                return
+            logging.info("Window full, waiting for acknowledgements")
+            self.cv_handler.black_out()
+            self.sent_symbol_log.append(None)
+            for i in range(0, State_Machine.get_ticks_per_packet(self)):
+                State_Machine.sleep_until_next_tick(self)
+        else:
+            if seq in self.window:
+                logging.warning("Retransmitting data packet: " + str(seq))
+                self.retransmission_count += 1
+            else:
+                # Sequence numbers are the packet indices of the packetizer
+                self.window[seq] = self.packetizer.next_index()
+                self.next_seq += 1
+                self.packet_count += 1
+                logging.info("Transmitting data packet: " + str(seq))
+
+            self.last_sent_slot[seq] = self.packet_slot
+            self._send_packet(self.packetizer.get_symbols(self.window[seq]))
+
+        self.packet_slot += 1
+
+    def _select_window_packet(self):
+        """
+        :return: the sequence number of the next packet to send, or None if nothing can be sent
+        """
+        for seq in self.window:
+            if seq in self.selectively_acked:
+                continue
+
+            # A packet sent before an acknowledged packet should have been acknowledged too
+            nacked = any(self.last_sent_slot[acked_seq] > self.last_sent_slot[seq] for acked_seq in
+                         self.selectively_acked)
+            timed_out = self.packet_slot - self.last_sent_slot[seq] > Constants.ARQ_TIMEOUT_PACKETS
+            if nacked or timed_out:
+                return seq
+
+        if self.next_seq - self.window_base < Constants.ARQ_WINDOW_SIZE and self.packetizer.has_next():
+            return self.next_seq
+
+        return None
+
+    def _read_window_feedback(self):
+        """
+        Reads the receiver feedback pattern: its cumulative ACK, i.e. the next sequence number it expects, and the
+        bitmap of the packets it received after that one. The pattern is classified from the frames of the last tick,
+        and is only applied when the previous read gave the same pattern, as packets released on a misread ACK would
+        never be retransmitted.
+
+        :return:
+        """
+        with self.instrumentation.timer("frame_read"):
+            end_time = self.clock.time()
+            frames = self.cap.readHSVFramesBetween(end_time - self.symbol_period, end_time)
+            if len(frames) == 0:
+                frames = [State_Machine.read_frame(self)]
+        symbol_indices, margins = self.classifier.classify_grid(frames, 1, State_Machine.get_arq_feedback_cells(self),
+                                                                Constants.GRID_CELL_MARGIN)
+
+        feedback = tuple(int(index) for index in symbol_indices)
+        if feedback != self.pending_feedback:
+            self.pending_feedback = feedback
+            return
+
+        acked_count = (int(symbol_indices[0]) - self.window_base) % Constants.ARQ_SEQUENCE_MODULUS
+        if acked_count > self.next_seq - self.window_base:
+            # Cannot acknowledge packets that were not sent yet
+            return
+
+        for seq in range(self.window_base, self.window_base + acked_count):
+            self.packetizer.release(self.window.pop(seq))
+            del self.last_sent_slot[seq]
+            self.selectively_acked.discard(seq)
+        self.window_base += acked_count
+
+        bitmap = 0
+        for i in range(1, len(symbol_indices)):
+            bitmap |= int(symbol_indices[i]) << (i - 1) * NUM_BITS
+
+        for i in range(0, Constants.ARQ_WINDOW_SIZE - 1):
+            seq = self.window_base + 1 + i
+            if bitmap >> i & 1 and seq in self.window:
+                self.selectively_acked.add(seq)
+
+        if acked_count > 0:
+            logging.info("Got cumulative ACK up to packet " + str(self.window_base - 1))
+
+    def _encode_packets(self, packet_indices, payloads):
         """
+        RS encode the messages of a batch of packets, and split them into symbols
 
-        # A data packet contains 8 bytes, and the RS message is 12 bytes long
-        rs_encoded = self.rs_coder.encode(data, return_string=False)
-        rs_encoded_cnt = 0
+        :param packet_indices:
+        :param payloads: memoryviews of the packet bytes
+        :return: symbol indices of each packet
+        """
+        messages = np.zeros((len(payloads), self.rs_codec.message_size), dtype=np.uint8)
+        for i, (packet_index, payload) in enumerate(zip(packet_indices, payloads)):
+            if Constants.SLIDING_WINDOW:
+                messages[i, 0] = packet_index % Constants.ARQ_SEQUENCE_MODULUS
+                messages[i, 1:1 + len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+            else:
+                messages[i, :len(payload)] = np.frombuffer(payload, dtype=np.uint8)
 
-        num_bits_to_send = 0
-        processed_b = 0
+        with self.instrumentation.timer("rs_encode"):
+            packets = self.rs_codec.encode_batch(messages)
+        return [bytes_to_symbols(packet, self.num_bits) for packet in packets]
 
-        for i in range(0, Constants.num_symbols_per_data_packet):
-            if num_bits_to_send < NUM_BITS:
-                # We first shift the unsent bits to the left in order to leave 8 bits free, and we add the next
-                # data byte to the right of processed_b
+    def _send_packet(self, symbol_indices, is_pilot=False):
+        """
+        Send the symbols of one packet, one symbol (or one grid of symbols in grid mode) per tick
+        
+        :param symbol_indices: 
+        :param is_pilot: the symbols are pilot symbols, and not a packet
+        :return: 
+        """
+        self.sent_symbol_log.append(None if is_pilot else symbol_indices)
+        symbols_per_tick = State_Machine.get_symbols_per_tick(self)
 
-                # we only keep the num_bits_to_send digits, and we then shift processed_b to the left
-                processed_b &= 2 ** num_bits_to_send - 1
-                processed_b = (processed_b << 8) | int(rs_encoded[rs_encoded_cnt])
-                rs_encoded_cnt += 1
-                num_bits_to_send += 8
+        for i in range(0, len(symbol_indices), symbols_per_tick):
+            tick_indices = symbol_indices[i:i + symbols_per_tick]
 
-            symbol_index = (processed_b >> num_bits_to_send - NUM_BITS) & BIT_MASK
-            symbol_to_send = SYMBOLS[symbol_index]
-            num_bits_to_send -= NUM_BITS
+            if Constants.GRID_MODE:
+                frame_id = self.cv_handler.display_symbol_grid(self._get_symbol_grid(tick_indices), self.symbols)
+            else:
+                frame_id = self.cv_handler.display_hsv_color(self.symbols[tick_indices[0]])
 
-            self.cv_handler.display_hsv_color(symbol_to_send)
-            logging.info(str(symbol_index) + " at time " + str(time.time()))
+            logging.info(str(tick_indices) + " at time " + str(self.clock.time()))
+            tick_time = self.clock_start + self.tick_count * self.symbol_period
             State_Machine.sleep_until_next_tick(self)
+            self._record_presentation(frame_id, tick_time)
+
+    def _record_presentation(self, frame_id, tick_time):
+        """Records the delay between the start of a tick and the presentation of its symbols by the display"""
+        presentation_time = self.cv_handler.get_presentation_time(frame_id)
+        if presentation_time is None:
+            # The frame was replaced before it could be presented
+            self.instrumentation.count("display_missed_frames_total")
+        else:
+            self.instrumentation.observe("display_latency_seconds", presentation_time - tick_time)
+
+    def _get_symbol_grid(self, tick_indices):
+        """
+        Lay out the symbols of one tick on the grid, row by row. Unused cells of the last tick carry the symbol 0
+        
+        :param tick_indices: 
+        :return: matrix of symbol indices to display
+        """
+        grid_indices = np.zeros(Constants.GRID_ROWS * Constants.GRID_COLS, dtype=np.int64)
+        grid_indices[:len(tick_indices)] = tick_indices
+        return grid_indices.reshape(Constants.GRID_ROWS, Constants.GRID_COLS)
 
     def do_calibrate(self):
 
-        for i in range(0, NUM_SYMBOLS):
+        if Constants.ADAPTIVE_MODULATION:
+            # The receiver measures the link on evenly spaced probe hues
+            for hue in get_evenly_spaced_hues(Constants.MODULATION_PROBE_COUNT):
+                for x in range(0, Constants.MODULATION_PROBE_TICKS):
+                    self.cv_handler.display_hsv_color(hue)
+                    State_Machine.sleep_until_next_tick(self)
+
+            self.state = State.NEGOTIATE
+            return
+
+        for i in range(0, len(self.symbols)):
             for x in range(0, 3):
-                self.cv_handler.display_hsv_color(SYMBOLS[i])
+                self.cv_handler.display_hsv_color(self.symbols[i])
+                State_Machine.sleep_until_next_tick(self)
+
+        self._save_calibration_profile()
+        self.state = State.SEND
+
+    def do_negotiate(self):
+        """
+        Reads the index of the modulation selected by the receiver, one bit per MODULATION_CHOICE_TICKS ticks (ACK
+        for 1, NO ACK for 0), and echoes the bits back. The receiver then confirms that the echo matches its choice,
+        with a repeated bit read by majority, or the negotiation is repeated. Once confirmed, switches to that
+        modulation and shows each symbol of its constellation in turn, so that the receiver calibrates it
+
+        :return:
+        """
+        self.cv_handler.black_out()
+        candidates = get_candidates()
+
+        while True:
+            bits = State_Machine.read_choice_bits(self, get_choice_bit_count())
+            State_Machine.send_choice_bits(self, bits)
+            confirmed = State_Machine.read_confirmation(self)
+
+            choice = decode_choice(bits)
+            if confirmed and choice < len(candidates):
+                break
+            logging.warning("Modulation choice " + str(choice) + " was not confirmed, negotiating again")
+
+        num_bits, symbol_period = candidates[choice]
+        State_Machine.set_modulation(self, num_bits, symbol_period)
+        self.cv_handler.prerender_hsv_colors(self.symbols)
+
+        for i in range(0, len(self.symbols)):
+            self.cv_handler.display_hsv_color(self.symbols[i])
+            for x in range(0, Constants.MODULATION_TRAINING_TICKS):
                 State_Machine.sleep_until_next_tick(self)
 
+        self._save_calibration_profile()
         self.state = State.SEND
 
     def do_receive(self):
@@ -201,16 +485,16 @@ class Transmitter(State_Machine):
     def do_get_ack(self):
 
         self.cv_handler.black_out()
-        current_time = time.time();
+        current_time = self.clock.time()
         logging.info("ack wait time is: " + str(current_time))
 
         # wait several tick for receiver ack to account for camera delay
         self.sleep_until_next_tick()
         self.sleep_until_next_tick()
         self.sleep_until_next_tick()
-        time.sleep(State_Machine.TRANSMISSION_RATE / 2.0)
+        self.clock.sleep(self.symbol_period / 2.0)
 
-        current_time = time.time()
+        current_time = self.clock.time()
         logging.info("ack wait wakeup time is: " + str(current_time))
 
         ack_score, no_ack_score = State_Machine.get_ack_scores(self)
@@ -235,33 +519,29 @@ class Transmitter(State_Machine):
 
         for x in range(0, 3):
             hue_mean += State_Machine.get_hue_mean(self)
-            time.sleep(0.2)
+            self.clock.sleep(0.2)
 
         hue_mean = np.round(hue_mean / 3.0)
         logging.info("hue mean for no ack calibration was: " + str(hue_mean))
-        Constants.S_NO_ACK = np.round(hue_mean)
+        self.ack_hues[0] = hue_mean
 
     def _calibrate_acks(self):
         hue_mean = 0.0
 
         for x in range(0, 3):
             hue_mean += State_Machine.get_hue_mean(self)
-            time.sleep(0.2)
+            self.clock.sleep(0.2)
 
         hue_mean = np.round(hue_mean / 3.0)
         logging.info("hue mean for ack calibration was: " + str(hue_mean))
-        Constants.S_ACK = np.round(hue_mean)
-
-    def _load_file(self, file_name):
-
-        with open(file_name, "rb") as f:
-            byte = f.read(1)
-            while byte:
-                self.byte_sequence.append(byte)
-                byte = f.read(1)
-            self.byte_sequence.append(bytes([Constants.END_OF_FILE_MARKER]))
-
-        logging.info("Loaded file")
+        self.ack_hues[1] = hue_mean
+        self._calibrate_feedback_hues()
+
+    def _calibrate_feedback_hues(self):
+        """Shifts the hues of the feedback constellation by the mean hue shift of the ACK hues seen by the camera"""
+        shifts = (self.ack_hues - np.float64([S_NO_ACK, S_ACK]) + 90.0) % 180.0 - 90.0
+        self.feedback_hues[:] = (SYMBOLS + np.mean(shifts)) % 180.0
+        logging.info("feedback hues calibrated with a hue shift of " + str(np.mean(shifts)))
 
 
 def main():
@@ -0,0 +1,15 @@
+from utils.CalibrationProfile import CalibrationProfile, get_profile_key, load_profile, save_profile
+
+
+def test_save_and_load(tmp_path):
+    profile_file = str(tmp_path / "profiles.json")
+    stored = CalibrationProfile([[10.5, 20.0], [90.0, 21.0], [89.0, 80.0], [11.0, 79.5]], 2, 0.05,
+                                [10.2, 55.1, 99.8, 145.0], [0.8, 1.1, 0.0, 0.9], (16.0, 104.0),
+                                {'CAP_PROP_EXPOSURE': -6.0})
+    save_profile(profile_file, get_profile_key('receiver', 'camera 0 640x480', 'display 800x600'), stored)
+    save_profile(profile_file, get_profile_key('transmitter', 'camera 0 640x480', 'display 800x600'), stored)
+
+    loaded = load_profile(profile_file, get_profile_key('receiver', 'camera 0 640x480', 'display 800x600'))
+    assert loaded.to_dict() == stored.to_dict()
+    assert load_profile(profile_file, get_profile_key('receiver', 'camera 1 640x480', 'display 800x600')) is None
+    assert load_profile(profile_file + ".missing", 'receiver') is None
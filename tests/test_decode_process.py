@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from cv.SymbolClassifier import SymbolClassifier
+from rcvr.decode_process import DecodeProcess
+from utils.SharedRing import is_store_ordered
+
+
+@pytest.mark.skipif(not is_store_ordered(), reason="the decode process is only supported on x86 machines")
+def test_classification():
+    # The worker classifies the same ticks as the local classifier
+    rng = np.random.RandomState(0)
+    symbols = np.array([10, 55, 100, 145])
+    decode_process = DecodeProcess((12, 16, 3), 4, 8, 4)
+    try:
+        expected = []
+        for tick in range(0, 20):
+            tick_frames = []
+            for i in range(0, rng.randint(1, 4)):
+                frame = np.full((12, 16, 3), 255, dtype=np.uint8)
+                frame[..., 0] = rng.choice(symbols, (2, 2)).repeat(6, axis=0).repeat(8, axis=1)
+                tick_frames.append(frame)
+            expected.append(SymbolClassifier(symbols).classify_grid(tick_frames, 2, 2)[0])
+            decode_process.submit(tick, tick_frames, symbols, 2, 2)
+
+        for tick in range(0, 20):
+            hues, indices, margins, decode_time = decode_process.get_result(tick)
+            assert np.array_equal(indices, expected[tick])
+    finally:
+        decode_process.close()
+
+
+@pytest.mark.skipif(not is_store_ordered(), reason="the decode process is only supported on x86 machines")
+def test_whole_frame():
+    # Without a grid, each tick is classified as a single symbol, returned as an array of one symbol
+    symbols = np.array([10, 55, 100, 145])
+    decode_process = DecodeProcess((12, 16, 3), 1, 8, 4)
+    try:
+        frame = np.full((12, 16, 3), 255, dtype=np.uint8)
+        frame[..., 0] = 100
+        decode_process.submit(0, [frame], symbols)
+        hues, indices, margins, decode_time = decode_process.get_result(0)
+        assert np.array_equal(indices, [2]) and hues.shape == (1,)
+    finally:
+        decode_process.close()
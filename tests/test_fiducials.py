@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+
+from cv.Fiducials import FiducialLayout, locate_data_area
+
+SCREEN_CORNERS = np.float32([[-0.5, -0.5], [799.5, -0.5], [799.5, 599.5], [-0.5, 599.5]])
+
+
+def get_screen(layout):
+    """Screen with the finder patterns, showing a color on a colored background"""
+    screen = layout.new_frame()
+    layout.get_data_view(screen)[:] = (40, 220, 60)
+    return screen
+
+
+def film(screen, camera_corners, **kwargs):
+    """
+    :return: (HSV camera frame of the screen under a perspective, homography from the screen to the camera frame)
+    """
+    homography = cv2.getPerspectiveTransform(SCREEN_CORNERS, np.float32(camera_corners))
+    camera_frame = cv2.warpPerspective(screen, homography, (640, 480), flags=cv2.INTER_AREA, **kwargs)
+    return cv2.cvtColor(camera_frame, cv2.COLOR_BGR2HSV), homography
+
+
+def get_expected_corners(layout, homography):
+    return cv2.perspectiveTransform(layout.get_data_corners().reshape(4, 1, 2), homography).reshape(4, 2)
+
+
+def test_perspective():
+    layout = FiducialLayout(800, 600, True)
+    hsv_frame, homography = film(get_screen(layout), [[150.3, 110.6], [480.8, 121.2], [470.4, 370.5], [160.7, 352.1]],
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=(200, 40, 160))
+    data_corners = locate_data_area(hsv_frame, layout, 40)
+    assert np.linalg.norm(data_corners - get_expected_corners(layout, homography), axis=1).max() < 1.0
+
+
+def test_no_patterns():
+    layout = FiducialLayout(800, 600, True)
+    hsv_frame, homography = film(np.full_like(get_screen(layout), 200),
+                                 [[150.3, 110.6], [480.8, 121.2], [470.4, 370.5], [160.7, 352.1]])
+    assert locate_data_area(hsv_frame, layout, 40) is None
+
+
+def test_close_screen():
+    # Close to the camera, the insides of the pattern modules are not dark, but their edges still are
+    layout = FiducialLayout(800, 600, True)
+    hsv_frame, homography = film(get_screen(layout), [[10, 5], [630, 12], [625, 470], [15, 465]])
+    data_corners = locate_data_area(hsv_frame, layout, 40)
+    assert np.linalg.norm(data_corners - get_expected_corners(layout, homography), axis=1).max() < 1.0
+
+
+def test_without_fiducials():
+    # The data area is the whole screen
+    screen = get_screen(FiducialLayout(800, 600, True))
+    assert FiducialLayout(800, 600, False).get_data_view(screen).shape == screen.shape
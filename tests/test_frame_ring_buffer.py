@@ -0,0 +1,29 @@
+import numpy as np
+
+from cv.FrameRingBuffer import FrameRingBuffer
+
+
+def test_empty():
+    # Nothing can be read before the first frame is published
+    frame_buffer = FrameRingBuffer(4, (2, 2, 3))
+    assert frame_buffer.read_latest() is None
+    assert frame_buffer.read_closest(0.0) is None
+    assert frame_buffer.read_between(-1.0, 1.0) == []
+    assert frame_buffer.read_since(-1) == []
+
+
+def test_overwrite():
+    # A view read from the buffer is invalidated when its slot is written again
+    frame_buffer = FrameRingBuffer(4, (2, 2, 3))
+    for i in range(0, 4):
+        frame_buffer.get_write_slot()[:] = i
+        frame_buffer.publish(0.1 * i)
+    sequence_number, timestamp, frame = frame_buffer.read_since(-1)[0]
+    assert sequence_number == 0 and np.all(frame == 0)
+    assert frame_buffer.read_closest(0.21)[0] == 2
+
+    frame_buffer.get_write_slot()[:] = 4
+    assert not frame_buffer.is_valid(sequence_number)
+    frame_buffer.publish(0.4)
+    assert not frame_buffer.is_valid(sequence_number) and frame_buffer.is_valid(4)
+    assert [s for s, t, f in frame_buffer.read_since(-1)] == [1, 2, 3, 4]
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from cv.ImageProcessing import compute_cyclic_score, compute_grid_cyclic_hue_means, compute_grid_hue_vectors, \
+    hue_vector_to_hue
+
+
+@pytest.mark.parametrize('value, reference, expected', [(170, 0, 100.0), (10, 170, 400.0), (90, 90, 0.0),
+                                                        (0, 90, 8100.0), (180.1, 0, 0.01)])
+def test_cyclic_score(value, reference, expected):
+    # The score is the squared hue distance on the color wheel, also across the wrap-around at 180
+    assert compute_cyclic_score(np.float64(value), np.float64(reference)) == pytest.approx(expected)
+    assert compute_cyclic_score(np.uint8(value % 180), np.uint8(reference)) == pytest.approx(expected, abs=0.1)
+
+
+def test_grid_hue_means():
+    # Each cell is read from its own pixels only, and the mean is circular, e.g. 178 and 4 average to 1
+    hues = np.float64([[10.0, 55.0, 100.0], [145.0, 1.0, 170.0]])
+    frame = np.zeros((60, 90, 3), dtype=np.uint8)
+    frame[:, :, 1:] = 255
+    for row in range(0, 2):
+        for col in range(0, 3):
+            frame[30 * row:30 * (row + 1), 30 * col:30 * (col + 1), 0] = hues[row, col]
+    frame[30:60:2, 30:60, 0] = 178
+    frame[31:60:2, 30:60, 0] = 4
+
+    means = compute_grid_cyclic_hue_means(frame, 2, 3, margin=0.2)
+    assert np.allclose(means, hues, atol=1e-6)
+    # The mean unit vectors of several frames average to the mean hue of all of them
+    first_vectors = compute_grid_hue_vectors(frame, 2, 3)
+    frame[:, :, 0] = (np.uint16(frame[:, :, 0]) + 2) % 180
+    second_vectors = compute_grid_hue_vectors(frame, 2, 3)
+    averaged = hue_vector_to_hue((first_vectors[0] + second_vectors[0]) / 2, (first_vectors[1] + second_vectors[1]) / 2)
+    assert np.allclose(averaged, hues + 1.0, atol=1e-6)
+
+
+def test_grid_margin():
+    # The border of each cell, which may bleed into the neighboring cells, is ignored
+    frame = np.zeros((40, 40, 3), dtype=np.uint8)
+    frame[:, :, 0] = 120
+    frame[:, 18:22, 0] = 30
+    assert np.allclose(compute_grid_cyclic_hue_means(frame, 1, 2, margin=0.3), [[120.0, 120.0]])
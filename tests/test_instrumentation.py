@@ -0,0 +1,17 @@
+import time
+
+from utils.Instrumentation import Instrumentation, get_prometheus_text
+
+
+def test_metrics():
+    instrumentation = Instrumentation('test')
+    instrumentation.set_state('Receive')
+    for i in range(0, 3):
+        with instrumentation.timer('rs_decode'):
+            time.sleep(0.001)
+    instrumentation.observe('tick_lateness_seconds', 0.002)
+    instrumentation.close()
+
+    assert instrumentation.summaries[('rs_decode_seconds', ())].count == 3
+    assert len(instrumentation.get_chrome_trace_events()) == 5
+    assert 'pdc_rs_decode_seconds_count' in get_prometheus_text([instrumentation])
@@ -0,0 +1,28 @@
+from utils.VirtualClock import VirtualClock
+from utils.link_manager import LinkManager
+
+
+class _Waiter:
+    """State machine that waits for a peer until the clock is stopped"""
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def run(self):
+        while True:
+            self.clock.sleep(0.1)
+
+
+def _crash():
+    raise FileNotFoundError("missing.txt")
+
+
+def test_crash_aborts_links():
+    # The links are aborted as soon as one of their state machines crashes, long before the time limit
+    clock = VirtualClock()
+    manager = LinkManager(clock)
+    manager._add_state_machine("receiver0", lambda: _Waiter(clock))
+    manager._add_state_machine("transmitter0", _crash)
+    results = manager.run(600.0)
+    assert isinstance(results["transmitter0_error"], FileNotFoundError)
+    assert results["receiver0_end_time"] < 600.0
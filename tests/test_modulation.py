@@ -0,0 +1,31 @@
+import numpy as np
+
+from utils import Constants
+from utils.Modulation import _cyclic_difference, decode_choice, encode_choice, get_candidates, \
+    get_evenly_spaced_hues, get_hue_statistics, select_modulation
+
+
+def test_choice_round_trip():
+    for index in range(0, len(get_candidates())):
+        assert decode_choice(encode_choice(index)) == index
+
+
+def test_clean_channel(monkeypatch):
+    # The largest constellation at the fastest rate is selected when frames are integrated
+    monkeypatch.setattr(Constants, 'MULTI_FRAME_INTEGRATION', True)
+    probe_hues = get_evenly_spaced_hues(Constants.MODULATION_PROBE_COUNT)
+    index, estimates = select_modulation(probe_hues, probe_hues, np.full(len(probe_hues), 0.1), 4.0, 0.1)
+    assert get_candidates()[index] == (max(Constants.MODULATION_NUM_BITS), min(Constants.MODULATION_SYMBOL_PERIODS))
+
+
+def test_noisy_channel():
+    # Smaller constellations are selected with a hue shift and noise, and the rate is limited by the camera
+    probe_hues = get_evenly_spaced_hues(Constants.MODULATION_PROBE_COUNT)
+    rng = np.random.RandomState(0)
+    samples = [(hue + 5.0 + rng.normal(0.0, 3.0, 12)) % 180 for hue in probe_hues]
+    seen_hues, hue_stds = get_hue_statistics(probe_hues, samples)
+    assert np.all(np.abs(_cyclic_difference(seen_hues, probe_hues + 5.0)) < 3.0)
+
+    index, estimates = select_modulation(probe_hues, seen_hues, hue_stds, 1.0, 0.1)
+    assert get_candidates()[index][0] < max(Constants.MODULATION_NUM_BITS)
+    assert get_candidates()[index][1] == 0.1
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import unireedsolomon
+
+from utils.ReedSolomonCodec import ReedSolomonCodec
+
+
+@pytest.fixture
+def codec():
+    return ReedSolomonCodec(12, 8, 4)
+
+
+@pytest.fixture
+def messages(codec):
+    return np.random.RandomState(0).randint(0, 256, (16, codec.message_size)).astype(np.uint8)
+
+
+def test_encode_batch(codec, messages):
+    # The vectorized encoder gives the codewords of unireedsolomon
+    for message, packet in zip(messages, codec.encode_batch(messages)):
+        codewords = codec._deinterleave(packet[np.newaxis, :])[0]
+        for d in range(0, codec.depth):
+            expected = codec.rs_coder.encode(message[d * codec.k:(d + 1) * codec.k].tobytes(), return_string=False)
+            assert list(codewords[d]) == [int(b) for b in expected]
+        assert not np.any(codec.compute_syndromes(codewords))
+
+
+def test_decode_burst(codec, messages):
+    # A burst of 8 bytes is spread over the 4 codewords, each of which can correct 2 errors
+    for message, packet in zip(messages, codec.encode_batch(messages)):
+        corrupted = packet.copy()
+        corrupted[10:18] ^= 0xff
+        decoded, corrected_count = codec.decode(corrupted)
+        assert np.array_equal(decoded, message) and corrected_count == 8
+
+
+def test_decode_erasures(codec, messages):
+    # 4 erased bytes per codeword are corrected, twice as many as errors
+    for message, packet in zip(messages, codec.encode_batch(messages)):
+        corrupted = packet.copy()
+        corrupted[8:24] ^= 0x5a
+        decoded, corrected_count = codec.decode(corrupted, list(range(8, 24)))
+        assert np.array_equal(decoded, message) and corrected_count == 16
+
+
+def test_decode_soft(codec, messages):
+    # 3 errors per codeword are beyond the errors only decoding, but are corrected when the 2 least confident bytes
+    # of each codeword are erased
+    for message, packet in zip(messages, codec.encode_batch(messages)):
+        corrupted = packet.copy()
+        corrupted[8:20] ^= 0x5a
+        confidences = np.ones(codec.packet_size)
+        confidences[8:16] = 0.0
+        with pytest.raises(unireedsolomon.RSCodecError):
+            codec.decode(corrupted)
+        decoded, corrected_count = codec.decode_soft(corrupted, confidences, 0.5, 2)
+        assert np.array_equal(decoded, message) and corrected_count == 12
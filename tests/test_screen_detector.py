@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+import pytest
+
+from cv.ScreenDetector import ScreenTracker, detect_screen, get_detection_range, refine_corners
+
+SCREEN_CORNERS = np.float32([[150.3, 110.6], [480.8, 121.2], [470.4, 370.5], [160.7, 352.1]])
+
+
+def draw_screen(corners, bgr_color=(40, 220, 60), supersampling=8):
+    """Camera frame of a screen with the given outer corners on a textured background, drawn at a higher resolution
+    and downsampled, so that its edges are accurate to a fraction of a pixel"""
+    rng = np.random.RandomState(0)
+    background = np.uint8(cv2.GaussianBlur(rng.randint(0, 90, (480, 640, 3)).astype(np.uint8), (0, 0), 3) * 2)
+    frame = cv2.resize(background, (640 * supersampling, 480 * supersampling), interpolation=cv2.INTER_NEAREST)
+    cv2.fillConvexPoly(frame, np.int32(np.round((np.float32(corners) + 0.5) * supersampling - 0.5)), bgr_color)
+    return cv2.resize(frame, (640, 480), interpolation=cv2.INTER_AREA)
+
+
+@pytest.fixture
+def camera_frame():
+    return draw_screen(SCREEN_CORNERS)
+
+
+def detect(camera_frame):
+    # The screen is found on the coarse level at the widest range, and its corners refined to a fraction of a pixel
+    hsv_frame = cv2.cvtColor(camera_frame, cv2.COLOR_BGR2HSV)
+    min_hsv, max_hsv = get_detection_range(hsv_frame[240, 320, 0], 30, 30)
+    coarse_corners = detect_screen(hsv_frame, min_hsv, max_hsv, 2, 400, 300000, 20)
+    assert np.abs(coarse_corners - SCREEN_CORNERS).max() < 6
+    return refine_corners(hsv_frame, coarse_corners, min_hsv, max_hsv, 8)
+
+
+def test_detection(camera_frame):
+    assert np.linalg.norm(detect(camera_frame) - SCREEN_CORNERS, axis=1).max() < 1.0
+
+
+def test_tracking(camera_frame):
+    # The tracker follows a camera bump while the screen shows another color
+    refined = detect(camera_frame)
+    tracker = ScreenTracker(camera_frame, refined, 12, 10, 0.7)
+    shift = np.float32([4.4, -2.7])
+    bumped_frame = cv2.warpAffine(draw_screen(SCREEN_CORNERS, (200, 30, 180)), np.float32([[1, 0, 4.4], [0, 1, -2.7]]),
+                                  (640, 480), borderMode=cv2.BORDER_REFLECT)
+    assert np.linalg.norm(tracker.update(bumped_frame) - (refined + shift), axis=1).max() < 0.5
+    assert tracker.update(np.zeros_like(camera_frame)) is None
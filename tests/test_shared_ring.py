@@ -0,0 +1,78 @@
+import multiprocessing
+import time
+
+import numpy as np
+import pytest
+
+from utils.SharedRing import SharedRing, is_store_ordered
+
+# Records of the concurrency test: each field of a record is filled with the index of the record
+RECORD_DTYPE = np.dtype([('index', np.int64), ('payload', np.int64, 61), ('check', np.float64)])
+RECORD_COUNT = 5000
+store_ordered = pytest.mark.skipif(not is_store_ordered(), reason="the ring is only supported on x86 machines")
+
+
+def _produce(name):
+    ring = SharedRing(RECORD_DTYPE, 8, name)
+    try:
+        for i in range(0, RECORD_COUNT):
+            slot = ring.get_write_slot()
+            while slot is None:
+                time.sleep(0)
+                slot = ring.get_write_slot()
+            slot['index'] = i
+            slot['payload'] = i
+            slot['check'] = i
+            ring.publish()
+    finally:
+        ring.close()
+
+
+@store_ordered
+def test_publish_and_read():
+    ring = SharedRing([('value', np.int64), ('squares', np.float64, 3)], 5)
+    reader = SharedRing(ring.dtype, ring.capacity, ring.name)
+    try:
+        for i in range(0, 9):
+            slot = ring.get_write_slot()
+            slot['value'] = i
+            slot['squares'] = [i ** 2] * 3
+            ring.publish()
+            if i % 2 == 1:
+                # Two records are published for each one that is read
+                record = reader.peek()
+                assert record['value'] == i // 2 and record['squares'][2] == (i // 2) ** 2
+                reader.release()
+
+        assert len(ring) == 5 and ring.get_write_slot() is None
+    finally:
+        reader.close()
+        ring.close()
+
+
+@store_ordered
+def test_concurrent_records():
+    # Every record read while another process writes the ring is complete, and the records are read in order
+    ring = SharedRing(RECORD_DTYPE, 8)
+    producer = multiprocessing.get_context('spawn').Process(target=_produce, args=(ring.name,), daemon=True)
+    producer.start()
+    try:
+        for i in range(0, RECORD_COUNT):
+            record = ring.peek()
+            while record is None:
+                assert producer.is_alive() or ring.peek() is not None
+                time.sleep(0)
+                record = ring.peek()
+            record = record.copy()
+            ring.release()
+            assert record['index'] == i and np.all(record['payload'] == i) and record['check'] == i
+    finally:
+        producer.join(5.0)
+        ring.close()
+
+
+def test_weakly_ordered_machine(monkeypatch):
+    # The ring cannot be created where a counter could be seen before the record it publishes
+    monkeypatch.setattr("platform.machine", lambda: "aarch64")
+    with pytest.raises(RuntimeError):
+        SharedRing(RECORD_DTYPE, 8)
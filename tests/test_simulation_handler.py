@@ -0,0 +1,24 @@
+import numpy as np
+
+from utils import Constants
+from utils.simulation_handler import ChannelStage, run_simulation
+
+
+def test_noise_bank_grows():
+    # The noise bank is drawn again when a larger frame is captured, and has the shape of the frame
+    stage = ChannelStage()
+    rng = np.random.default_rng(0)
+    assert stage.get_noise((20, 30, 3), rng).shape == (20, 30, 3)
+    assert stage.get_noise((40, 30, 3), rng).shape == (40, 30, 3)
+    assert stage.get_noise((40, 90, 3), rng).shape == (40, 90, 3)
+    assert stage.get_noise((40, 90), rng).shape == (40, 90)
+
+
+def test_crash_aborts_simulation(monkeypatch, tmp_path):
+    # The receiver stops searching for the screen as soon as the transmitter crashes on its missing file
+    for name in ('DEBUG', 'SIMULATE', 'SIMULATION_HANDLER', 'CLOCK', 'INSTRUMENTATION'):
+        monkeypatch.setattr(Constants, name, getattr(Constants, name))
+    stats = run_simulation(str(tmp_path / "missing.txt"), str(tmp_path / "output.txt"), max_duration=600.0)
+    assert not stats['success']
+    assert stats['crashed'] == ['transmitter']
+    assert stats['session_time'] < 600.0
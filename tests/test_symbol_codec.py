@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from utils.SymbolCodec import MAX_NUM_BITS, bytes_to_symbols, get_byte_confidences, get_num_symbols, symbols_to_bytes
+
+
+@pytest.mark.parametrize('num_bits', range(1, MAX_NUM_BITS + 1))
+def test_round_trip(num_bits):
+    rng = np.random.RandomState(num_bits)
+    for length in list(range(0, 40)) + list(rng.randint(40, 300, 10)):
+        data = rng.randint(0, 256, length).astype(np.uint8)
+        symbols = bytes_to_symbols(data, num_bits)
+        assert len(symbols) == get_num_symbols(length, num_bits)
+        assert symbols.max(initial=0) < 2 ** num_bits
+        assert np.array_equal(symbols_to_bytes(symbols, length, num_bits), data)
+        assert np.array_equal(bytes_to_symbols(data.tobytes(), num_bits), symbols)
+
+
+@pytest.mark.parametrize('num_bits', range(1, MAX_NUM_BITS + 1))
+def test_symbols_round_trip(num_bits):
+    # Symbols carrying a whole number of bytes are given back by the byte conversion
+    rng = np.random.RandomState(num_bits)
+    for byte_count in range(0, 10):
+        length = 8 * byte_count // np.gcd(8, num_bits)
+        symbols = rng.randint(0, 2 ** num_bits, length).astype(np.uint8)
+        data = symbols_to_bytes(symbols, length * num_bits // 8, num_bits)
+        assert np.array_equal(bytes_to_symbols(data, num_bits), symbols)
+
+
+def test_bit_order():
+    # The first symbol carries the most significant bits of the first byte, and the last symbol is zero padded
+    assert list(bytes_to_symbols(b'\xb4', 2)) == [2, 3, 1, 0]
+    assert list(bytes_to_symbols(b'\xb4\x01', 3)) == [5, 5, 0, 0, 0, 4]
+    assert list(bytes_to_symbols(b'\xff', 6)) == [63, 48]
+
+
+def test_missing_symbols():
+    # Bytes that are not fully carried by the symbols have their missing bits set to zero
+    assert list(symbols_to_bytes([7, 7], 2, 3)) == [0xfc, 0]
+    assert list(symbols_to_bytes([], 1, 4)) == [0]
+
+
+@pytest.mark.parametrize('num_bits', range(1, MAX_NUM_BITS + 1))
+def test_byte_confidences(num_bits):
+    # A low confidence symbol only lowers the confidence of the bytes it carries bits of
+    rng = np.random.RandomState(num_bits)
+    for length in rng.randint(1, 100, 20):
+        symbol_count = get_num_symbols(length, num_bits)
+        for symbol in {0, symbol_count // 2, symbol_count - 1}:
+            confidences = np.ones(symbol_count)
+            confidences[symbol] = 0.0
+            start_bit = symbol * num_bits
+            expected = np.ones(length)
+            expected[start_bit // 8:min((start_bit + num_bits - 1) // 8 + 1, length)] = 0.0
+            assert np.array_equal(get_byte_confidences(confidences, length, num_bits), expected)
+
+
+def test_byte_confidences_minimum():
+    # A byte spread over several symbols gets the lowest of their confidences
+    confidences = np.array([0.9, 0.5, 0.7, 1.0, 1.0, 1.0, 1.0, 1.0])
+    assert np.array_equal(get_byte_confidences(confidences, 3, 3), [0.5, 0.7, 1.0])
+    # Bytes that are not fully carried by the symbols have a null confidence
+    assert np.array_equal(get_byte_confidences(confidences[:5], 3, 3), [0.5, 0.0, 0.0])
@@ -0,0 +1,20 @@
+import cv2
+import numpy as np
+import pytest
+
+from bench.micro import get_hsv_grid_frame
+from cv.SymbolRenderer import SymbolRenderer
+
+
+@pytest.mark.parametrize('width, height, rows, cols', [(800, 600, 4, 4), (803, 601, 3, 7), (64, 48, 1, 1)])
+def test_grid_layout(width, height, rows, cols):
+    # The rendered frames have the layout of the converted HSV grid frames, including for sizes that are not a
+    # multiple of the grid size (the vectorized conversion of large frames may round the colors differently)
+    rng = np.random.RandomState(0)
+    hues = np.arange(0, 180, 180 // 8)
+    renderer = SymbolRenderer(width, height)
+    symbol_indices = rng.randint(0, len(hues), (rows, cols))
+    expected = cv2.cvtColor(get_hsv_grid_frame(hues[symbol_indices], height, width), cv2.COLOR_HSV2BGR)
+    for frame in (renderer.render_symbol_grid(symbol_indices, hues), renderer.render_hue_grid(hues[symbol_indices])):
+        assert np.abs(np.int16(frame) - expected).max() <= 1
+        assert np.array_equal(frame.any(axis=2), expected.any(axis=2))
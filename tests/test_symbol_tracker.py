@@ -0,0 +1,16 @@
+import numpy as np
+
+from cv.SymbolTracker import SymbolTracker
+
+
+def test_drift():
+    # The hues seen by the camera slowly drift by 10, and the centroids follow them
+    rng = np.random.RandomState(0)
+    hues = np.array([10.0, 55.0, 100.0, 145.0])
+    tracker = SymbolTracker(hues)
+    for step in range(0, 200):
+        indices = rng.randint(0, len(hues), 16)
+        tracker.update(indices, (hues[indices] + 10.0 * step / 200.0 + rng.normal(0.0, 1.0, 16)) % 180.0)
+
+    assert np.all(np.abs(tracker.centroids - (hues + 10.0)) < 1.0)
+    assert np.all(np.abs(tracker.spreads - 1.0) < 0.5)
@@ -0,0 +1,29 @@
+import threading
+import time
+
+from utils.VirtualClock import VirtualClock
+
+
+def test_interleaving():
+    # Two threads sleeping with different periods must interleave as with a real clock
+    clock = VirtualClock()
+    events = []
+
+    def sleeper(name, period, count):
+        for i in range(0, count):
+            clock.sleep(period)
+            events.append((clock.time(), name))
+        clock.unregister()
+
+    threads = [threading.Thread(target=sleeper, args=('a', 0.3, 4)),
+               threading.Thread(target=sleeper, args=('b', 0.5, 3))]
+    for t in threads:
+        clock.register()
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert [round(t, 6) for t, name in events] == [0.3, 0.5, 0.6, 0.9, 1.0, 1.2, 1.5]
+    assert time.time() - start < 0.5
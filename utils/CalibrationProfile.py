@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+# Version of the profile file format, the profiles of other versions being ignored
+PROFILE_VERSION = 1
+
+# The state machines of several links (or both sides of a simulation) may share the same profile file
+_file_lock = threading.Lock()
+
+
+class CalibrationProfile:
+    """
+    Calibration results of one side of a link, for one camera and display pair: the screen corners, the modulation,
+    the hue centroid and spread of each symbol, the hues of the ACK symbols as seen by the camera, and the exposure
+    settings of the camera. A fixed installation can then reconnect with a quick verification of the stored screen,
+    instead of a full detection and calibration.
+    """
+
+    def __init__(self, screen_corners, num_bits, symbol_period, symbols, spreads=None, ack_hues=None, exposure=None):
+        """
+        :param screen_corners: outer corners of the screen of the other side, in the camera frames
+        :param num_bits: number of bits per symbol
+        :param symbol_period: symbol period, in seconds
+        :param symbols: hue centroid of each symbol
+        :param spreads: hue spread of each symbol, 0 for the symbols that were not measured
+        :param ack_hues: (NO ACK hue, ACK hue) seen by the camera, None if they were not calibrated
+        :param exposure: exposure settings of the camera, by capture property name
+        """
+        self.screen_corners = np.float32(screen_corners).reshape(4, 2)
+        self.num_bits = int(num_bits)
+        self.symbol_period = float(symbol_period)
+        self.symbols = np.array(symbols, dtype=np.float64)
+        self.spreads = np.zeros(len(self.symbols)) if spreads is None else np.array(spreads, dtype=np.float64)
+        self.ack_hues = None if ack_hues is None else [float(hue) for hue in ack_hues]
+        self.exposure = dict(exposure) if exposure is not None else {}
+
+    def to_dict(self) -> dict:
+        return {'screen_corners': self.screen_corners.tolist(), 'num_bits': self.num_bits,
+                'symbol_period': self.symbol_period, 'symbols': self.symbols.tolist(), 'spreads': self.spreads.tolist(),
+                'ack_hues': self.ack_hues, 'exposure': self.exposure}
+
+
+def get_profile_key(name, camera_name, display_name) -> str:
+    """Key of the profile of a state machine, for its camera and display"""
+    return name + "|" + camera_name + "|" + display_name
+
+
+def _read_profiles(file_name) -> dict:
+    if not os.path.exists(file_name):
+        return {}
+    try:
+        with open(file_name, "r") as f:
+            content = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning("Could not read the calibration profiles of " + file_name + ": " + str(e))
+        return {}
+    if content.get('version') != PROFILE_VERSION:
+        logging.warning("Ignoring the calibration profiles of " + file_name + ", of another version")
+        return {}
+    return content.get('profiles', {})
+
+
+def load_profile(file_name, key) -> Optional[CalibrationProfile]:
+    """
+    :param file_name: JSON profile file
+    :param key: key of the profile
+    :return: the stored profile, or None if there is none (or if it cannot be read)
+    """
+    with _file_lock:
+        entry = _read_profiles(file_name).get(key)
+    if entry is None:
+        return None
+    try:
+        return CalibrationProfile(entry['screen_corners'], entry['num_bits'], entry['symbol_period'],
+                                  entry['symbols'], entry.get('spreads'), entry.get('ack_hues'),
+                                  entry.get('exposure'))
+    except (KeyError, TypeError, ValueError) as e:
+        logging.warning("Ignoring the invalid calibration profile " + key + ": " + str(e))
+        return None
+
+
+def save_profile(file_name, key, profile):
+    """
+    Stores a profile, keeping the profiles of the other keys. The file is replaced atomically, so that it is never
+    read half written.
+
+    :param file_name: JSON profile file
+    :param key: key of the profile
+    :param profile: CalibrationProfile to store
+    :return:
+    """
+    with _file_lock:
+        profiles = _read_profiles(file_name)
+        profiles[key] = profile.to_dict()
+        temporary_file_name = file_name + ".tmp"
+        with open(temporary_file_name, "w") as f:
+            json.dump({'version': PROFILE_VERSION, 'profiles': profiles}, f, indent=1, sort_keys=True)
+        os.replace(temporary_file_name, file_name)
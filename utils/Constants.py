@@ -5,15 +5,182 @@ HEIGHT = 480
 
 DETECTION_PROPORTION = 4.0
 
-END_OF_FILE_MARKER = 26
-
 DEBUG = True
 SIMULATE = False
 USE_MASK = False
 
 NUM_BITS = 3
+# Each packet carries RS_INTERLEAVING_DEPTH interleaved RS(RS_codeword_size, RS_message_size) codewords. Larger
+# codewords have a lower overhead, e.g. RS(255, 223), or shortened variants such as RS(64, 48).
 RS_codeword_size = 12
 RS_message_size = 8
-num_symbols_per_data_packet = int(np.ceil(8 * RS_codeword_size / 3))
+RS_INTERLEAVING_DEPTH = 1
+RS_packet_size = RS_codeword_size * RS_INTERLEAVING_DEPTH
+RS_packet_message_size = RS_message_size * RS_INTERLEAVING_DEPTH
+num_symbols_per_data_packet = int(np.ceil(8 * RS_packet_size / NUM_BITS))
+
+# Grid mode: the screen is tiled into GRID_ROWS x GRID_COLS independent symbol cells, all sent during the same tick.
+# The cell size is the screen size divided by the grid size, so fewer rows/columns should be used when the camera is
+# far away from the screen.
+GRID_MODE = False
+GRID_ROWS = 4
+GRID_COLS = 4
+# Proportion of each cell (split between both borders) that the receiver ignores, to avoid inter-cell bleeding
+GRID_CELL_MARGIN = 0.3
+
+# When set, the detected screen quadrilateral is rectified with a homography into a fixed size frame, instead of
+# being cropped along its bounding box
+USE_HOMOGRAPHY = False
+RECTIFIED_WIDTH = 160
+RECTIFIED_HEIGHT = 120
+
+# Screen detection: each camera frame is searched for the screen on a coarse level, decimated
+# SCREEN_DETECTION_PYRAMID_LEVELS times by 2 (and on the finer levels if it is not found), with
+# SCREEN_DETECTION_RANGE_STEPS color ranges of increasing width. The corners of the largest screen found are then
+# refined at full resolution, around their coarse position only. The screen is locked once it is found at the same
+# position in two frames taken SCREEN_DETECTION_PERIOD seconds apart.
+SCREEN_DETECTION_PYRAMID_LEVELS = 2
+SCREEN_DETECTION_RANGE_STEPS = 7
+SCREEN_DETECTION_PERIOD = 0.05
+
+# Screen tracking: after the lock, the capture handler tracks the screen corners every SCREEN_TRACKING_PERIOD frames,
+# by matching templates of SCREEN_TRACKING_TEMPLATE_SIZE pixels around each corner (half size) within
+# SCREEN_TRACKING_SEARCH_RADIUS pixels of its last position. The homography is updated when a corner moves by at least
+# SCREEN_TRACKING_MIN_SHIFT pixels, so that small camera bumps are corrected during the transmission. A corner whose
+# best correlation is below SCREEN_TRACKING_MIN_SCORE is considered lost, and the last homography is then kept. Only
+# used with USE_HOMOGRAPHY.
+SCREEN_TRACKING = False
+SCREEN_TRACKING_PERIOD = 6
+SCREEN_TRACKING_TEMPLATE_SIZE = 12
+SCREEN_TRACKING_SEARCH_RADIUS = 10
+SCREEN_TRACKING_MIN_SHIFT = 0.5
+SCREEN_TRACKING_MIN_SCORE = 0.7
+
+# Fiducial markers: both screens draw a finder pattern (black and white squares, as in QR codes) of FIDUCIAL_SIZE
+# times the screen height in each corner, on white bands on the left and on the right of a smaller data area. The
+# screen is then localized in a single frame from the four patterns of at least FIDUCIAL_MIN_AREA camera pixels,
+# whatever the displayed colors, and the data area is checked to show the expected color. The patterns must be a few
+# camera pixels per module at least (~2.5 on the 80x60 pixel screens of the channel simulation), which the ideal
+# simulated camera does not give. The data area is then 332x548 pixels at 800x600.
+FIDUCIAL_MARKERS = False
+FIDUCIAL_SIZE = 0.3
+FIDUCIAL_MIN_AREA = 40
+
+# Screens located without the color detection (from the fiducial markers or a calibration profile) are accepted when
+# all their parts are saturated and within SCREEN_HUE_TOLERANCE hues of the expected color
+SCREEN_HUE_TOLERANCE = 20
+
+# Calibration profiles: when CALIBRATION_PROFILE is set to a JSON file, each side stores there its screen corners,
+# modulation, symbol hue centroids and spreads, ACK hues and camera exposure, keyed by its name, camera and display.
+# On the next start, the stored screen corners are checked on the camera frames instead of detecting the screen, and
+# the receiver offers a warm start by showing S_WARM_ACK instead of S_ACK. The transmitter accepts it by showing
+# S_WARM_ACK back before blacking out, and both sides then skip the calibration and the modulation negotiation. With
+# ADAPTIVE_MODULATION, the receiver first sends the modulation of its profile as in the negotiation, and both sides
+# fall back to the calibration unless the transmitter confirms that its profile has the same modulation. A side
+# falls back to the full detection when the stored screen is not seen within CALIBRATION_PROFILE_TIMEOUT seconds, the
+# time during which the stored screen is darker than SCREEN_DARK_VALUE (the peer has not started yet) excepted.
+CALIBRATION_PROFILE = None
+CALIBRATION_PROFILE_TIMEOUT = 1.0
+SCREEN_DARK_VALUE = 40
+
+# Number of timestamped frames kept by the capture handler (~0.5 s at 60 fps). The frames are read as views of the
+# buffer, which are processed before the next tick (the clock recovery checks them afterwards), or copied to be kept
+# longer. The longest read spans MODULATION_CHOICE_TICKS - 2 symbol periods, so the buffer must hold the frames of
+# MODULATION_CHOICE_TICKS + 1 symbol periods at least: 30 at 60 fps with 0.1 s symbols.
+FRAME_BUFFER_SIZE = 32
+
+# When set, the receiver classifies each symbol from all the frames captured during its period, except for the
+# frames captured within INTEGRATION_GUARD symbol periods of a transition
+MULTI_FRAME_INTEGRATION = False
+INTEGRATION_GUARD = 0.2
+
+# When set, the receiver continuously tracks the transmitter symbol clock from the transitions seen by the camera,
+# instead of relying on its own clock after the synchronization
+CLOCK_RECOVERY = False
+
+# Sliding window ARQ (selective repeat): the transmitter streams up to ARQ_WINDOW_SIZE unacknowledged packets, and
+# the first byte of each RS message is the packet sequence number modulo ARQ_SEQUENCE_MODULUS. The receiver screen
+# continuously shows its cumulative ACK (next expected sequence number) followed by the bitmap of the packets it
+# received after it, one symbol per cell. ARQ_SEQUENCE_MODULUS must be at most the number of symbols, and at
+# least twice the window size.
+SLIDING_WINDOW = False
+ARQ_WINDOW_SIZE = 4
+ARQ_SEQUENCE_MODULUS = 8
+# Number of packet durations after which an unacknowledged packet is retransmitted
+ARQ_TIMEOUT_PACKETS = 2
+
+# Adaptive modulation: during the calibration, the transmitter shows MODULATION_PROBE_COUNT evenly spaced hues for
+# MODULATION_PROBE_TICKS ticks each, from which the receiver estimates the hue offset and noise of the link. It then
+# selects the number of bits per symbol (evenly spaced hue constellations) and the symbol period with the highest bit
+# rate whose estimated symbol error rate is below MODULATION_TARGET_SER, and sends its choice to the transmitter with
+# ACK/NO_ACK symbols, one bit per MODULATION_CHOICE_TICKS ticks. The transmitter echoes the bits back, and the receiver
+# confirms (or rejects, in which case the negotiation is repeated) by repeating an ACK (or a NO ACK)
+# MODULATION_CONFIRMATION_BITS times, read by majority. Both then switch to the selected modulation, and the receiver
+# calibrates the new constellation over MODULATION_TRAINING_TICKS ticks per symbol. When not set, NUM_BITS and the
+# transmission rate of the state machines are used. The ACK feedback always uses the NUM_BITS constellation.
+ADAPTIVE_MODULATION = False
+MODULATION_NUM_BITS = [1, 2, 3, 4, 5, 6]
+MODULATION_SYMBOL_PERIODS = [0.1, 0.075, 0.05, 0.04]
+MODULATION_TARGET_SER = 0.005
+MODULATION_PROBE_COUNT = 16
+MODULATION_PROBE_TICKS = 3
+MODULATION_CHOICE_TICKS = 4
+MODULATION_CONFIRMATION_BITS = 3
+MODULATION_TRAINING_TICKS = 2
+# Periods faster than the calibration one are only selected if the camera captures at least this many frames in the
+# stable part of each symbol
+MODULATION_MIN_FRAMES_PER_SYMBOL = 1.5
+# Lower bound of the per frame hue deviation, for the variations that are not seen during the calibration
+MODULATION_HUE_STD_FLOOR = 0.5
+
+# Symbol tracking: after the calibration, the receiver keeps updating the hue centroid and spread of each symbol from
+# the symbols of the packets validated by the RS decoder, each measurement having a weight of TRACKING_RATE, so that
+# slow changes of the ambient light are followed. With the sliding window, every TRACKING_PILOT_INTERVAL-th packet slot
+# carries known pilot symbols (all the symbols in turn) instead of data, so that rare symbols are tracked too (0 to
+# disable the pilots).
+SYMBOL_TRACKING = False
+TRACKING_RATE = 0.1
+TRACKING_PILOT_INTERVAL = 0
+
+# Soft decisions: the confidence of each symbol is the distance of its hue to the decision boundary with the second
+# closest symbol, in units of the tracked spread of the symbol, of at least SOFT_DECISION_MIN_SPREAD hues (or of
+# SOFT_DECISION_DEFAULT_SPREAD hues before it is tracked, and without tracking), and the confidence of a byte is the
+# lowest confidence of the symbols carrying it.
+# The codewords that the RS decoder cannot correct are decoded again with their 2, 4, ... least confident bytes below
+# ERASURE_THRESHOLD as erasures (generalized minimum distance decoding), up to RS_codeword_size - RS_message_size -
+# ERASURE_RESERVE erasures, so that the reserved parity bytes can still correct errors outside of the erased bytes.
+SOFT_DECISION = False
+SOFT_DECISION_DEFAULT_SPREAD = 2.0
+SOFT_DECISION_MIN_SPREAD = 0.5
+ERASURE_THRESHOLD = 2.0
+ERASURE_RESERVE = 2
+
+# Decode process: the receiver copies the frames of each tick into DECODE_FRAME_SLOTS frame slots in shared memory,
+# which a separate process classifies while the receiver waits for the next tick (up to DECODE_QUEUE_SIZE ticks ahead).
+# The detected symbols are collected at the end of each packet, so that the decoding runs on another core without
+# competing for the GIL with the capture, display and state machine threads. The shared memory queues rely on the
+# store ordering of x86 machines, and the receiver refuses to start with it elsewhere.
+DECODE_PROCESS = False
+DECODE_FRAME_SLOTS = 128
+DECODE_QUEUE_SIZE = 64
+
+# Display: the window thread waits for new frames at most DISPLAY_EVENT_PERIOD seconds before processing the window
+# events. The BGR frames of the last DISPLAY_FRAME_CACHE_SIZE colors and grid patterns are kept (1.4 MB each at
+# 800x600), and the presentation times of the last DISPLAY_PRESENTATION_LOG_SIZE frames. The data symbol grids are
+# rendered into DISPLAY_RENDER_BUFFERS reusable frames, so a frame is overwritten DISPLAY_RENDER_BUFFERS ticks after
+# it was submitted, which must be longer than the window thread takes to show it.
+DISPLAY_EVENT_PERIOD = 0.01
+DISPLAY_FRAME_CACHE_SIZE = 72
+DISPLAY_RENDER_BUFFERS = 3
+DISPLAY_PRESENTATION_LOG_SIZE = 256
+
+# When set, the state machines record the time spent in each state, the tick lateness and the processing times of
+# the frame reads, the symbol decoding and the RS coding. When INSTRUMENTATION_OUTPUT is set too, each state machine
+# writes them when it terminates, to <INSTRUMENTATION_OUTPUT>_<name>.json (Chrome trace events) and .prom (Prometheus).
+# The simulation sets it when a trace is requested
+INSTRUMENTATION = False
+INSTRUMENTATION_OUTPUT = None
 
+# Clock of the state machines (time and sleeps), the wall clock when None. The headless simulation sets a virtual clock
+CLOCK = None
 SIMULATION_HANDLER = None
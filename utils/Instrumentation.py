@@ -0,0 +1,150 @@
+import collections
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Maximum number of trace events kept per registry, the oldest ones being dropped first
+MAX_TRACE_EVENTS = 200000
+
+METRIC_PREFIX = "pdc_"
+
+# Common time origin of the trace events of all the registries of the process
+TRACE_ORIGIN = time.perf_counter()
+
+
+class Summary:
+    """Count, sum and extrema of the observations of a metric"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+
+class Instrumentation:
+    """
+    Registry of the counters, summaries and trace events of one state machine. Durations are measured on the wall
+    clock (also when the state machine runs on a virtual clock), so that the trace shows where the processing time
+    goes. The registry can be exported as Chrome trace events (chrome://tracing, Perfetto) or Prometheus text.
+    """
+
+    def __init__(self, name, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.counters = collections.defaultdict(float)
+        self.summaries = collections.defaultdict(Summary)
+        self.events = collections.deque(maxlen=MAX_TRACE_EVENTS)
+        self.lock = threading.Lock()
+
+        self.state = None
+        self.state_start = None
+
+    def count(self, name, value=1.0, **labels):
+        if self.enabled:
+            with self.lock:
+                self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            with self.lock:
+                self.summaries[(name, tuple(sorted(labels.items())))].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager recording the duration of its block as an observation (in seconds) and a trace event"""
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.observe(name + "_seconds", end - start, **labels)
+            self._add_event(name, "processing", start, end, labels)
+
+    def set_state(self, state):
+        """Closes the trace span of the previous state and opens the one of the given state, if it changed"""
+        if not self.enabled or state == self.state:
+            return
+
+        now = time.perf_counter()
+        if self.state is not None:
+            self.count("state_seconds_total", now - self.state_start, state=self.state)
+            self.count("state_entries_total", 1, state=self.state)
+            self._add_event(self.state, "state", self.state_start, now, {})
+        self.state = state
+        self.state_start = now
+
+    def close(self):
+        """Closes the span of the current state"""
+        self.set_state(None)
+
+    def _add_event(self, name, category, start, end, labels):
+        with self.lock:
+            self.events.append((name, category, start, end, labels))
+
+    def get_chrome_trace_events(self, pid=1, tid=1) -> list:
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': self.name}}]
+        with self.lock:
+            for name, category, start, end, labels in self.events:
+                events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                               'ts': 1e6 * (start - TRACE_ORIGIN), 'dur': 1e6 * (end - start),
+                               'args': {str(k): str(v) for k, v in labels}})
+        return events
+
+    def get_prometheus_samples(self) -> list:
+        """:return: list of (metric family, metric type, sample line)"""
+        samples = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                samples.append((name, 'counter', _format_sample(name, labels, self.name, value)))
+            for (name, labels), summary in sorted(self.summaries.items()):
+                samples.append((name, 'summary', _format_sample(name + "_count", labels, self.name, summary.count)))
+                samples.append((name, 'summary', _format_sample(name + "_sum", labels, self.name, summary.sum)))
+                samples.append((name + "_max", 'gauge', _format_sample(name + "_max", labels, self.name,
+                                                                        summary.max)))
+        return samples
+
+
+def _format_sample(name, labels, machine, value) -> str:
+    label_text = ",".join(['machine="' + machine + '"'] + [str(k) + '="' + str(v) + '"' for k, v in labels])
+    return METRIC_PREFIX + name + "{" + label_text + "} " + repr(float(value))
+
+
+def write_chrome_trace(file_name, instrumentations):
+    """Writes the trace events of several registries, one thread per registry"""
+    events = []
+    for i, instrumentation in enumerate(instrumentations):
+        events.extend(instrumentation.get_chrome_trace_events(tid=i + 1))
+
+    with open(file_name, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def get_prometheus_text(instrumentations) -> str:
+    """Prometheus text exposition of several registries, the samples of each metric family being grouped"""
+    families = collections.OrderedDict()
+    for instrumentation in instrumentations:
+        for family, metric_type, line in instrumentation.get_prometheus_samples():
+            families.setdefault((family, metric_type), []).append(line)
+
+    lines = []
+    for (family, metric_type), family_lines in families.items():
+        lines.append("# TYPE " + METRIC_PREFIX + family + " " + metric_type)
+        lines.extend(family_lines)
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_text(file_name, instrumentations):
+    with open(file_name, "w") as f:
+        f.write(get_prometheus_text(instrumentations))
@@ -0,0 +1,137 @@
+import math
+
+import numpy as np
+
+from utils import Constants
+
+
+def get_evenly_spaced_hues(num_symbols) -> np.ndarray:
+    """Constellation of num_symbols hues evenly spaced over the hue circle, starting at 10"""
+    return np.uint8(np.round(10 + np.arange(num_symbols) * 180.0 / num_symbols) % 180)
+
+
+def get_candidates() -> list:
+    """
+    Modulations that can be selected, i.e. all the combinations of MODULATION_NUM_BITS and MODULATION_SYMBOL_PERIODS
+
+    :return: list of (number of bits per symbol, symbol period)
+    """
+    return [(num_bits, period) for num_bits in Constants.MODULATION_NUM_BITS
+            for period in Constants.MODULATION_SYMBOL_PERIODS]
+
+
+def get_choice_bit_count() -> int:
+    """Number of bits needed to send the index of the selected candidate"""
+    return max(1, int(math.ceil(math.log2(len(get_candidates())))))
+
+
+def encode_choice(index) -> list:
+    """Bits of a candidate index, most significant bit first"""
+    bit_count = get_choice_bit_count()
+    return [(index >> (bit_count - 1 - i)) & 1 for i in range(0, bit_count)]
+
+
+def decode_choice(bits) -> int:
+    index = 0
+    for bit in bits:
+        index = (index << 1) | int(bit)
+    return index
+
+
+def _cyclic_difference(hues, references):
+    """Signed cyclic difference hues - references, in [-90, 90)"""
+    return (np.asarray(hues, dtype=np.float64) - np.asarray(references, dtype=np.float64) + 90.0) % 180.0 - 90.0
+
+
+def get_hue_statistics(probe_hues, samples):
+    """
+    Statistics of the hues seen by the receiver for each probe hue shown by the transmitter
+
+    :param probe_hues: array of the displayed hues
+    :param samples: for each probe hue, the array of the hues measured on each frame (and on each grid cell)
+    :return: (circular mean of the seen hues, RMS deviation of the samples from that mean), for each probe hue
+    """
+    seen_hues = np.zeros(len(probe_hues))
+    hue_stds = np.zeros(len(probe_hues))
+    for i, probe_samples in enumerate(samples):
+        angles = np.asarray(probe_samples, dtype=np.float64).ravel() * 2.0 * np.pi / 180.0
+        seen_hues[i] = (np.arctan2(np.sin(angles).mean(), np.cos(angles).mean()) * 180.0 / (2.0 * np.pi)) % 180.0
+        hue_stds[i] = np.sqrt(np.mean(_cyclic_difference(probe_samples, seen_hues[i]) ** 2))
+    return seen_hues, hue_stds
+
+
+def predict_seen_hues(probe_hues, seen_hues, hue_stds, hues):
+    """
+    Interpolates the hue offset and deviation measured on the probe hues at other displayed hues
+
+    :return: (predicted seen hues, predicted deviations)
+    """
+    order = np.argsort(probe_hues)
+    probe_hues = np.asarray(probe_hues, dtype=np.float64)[order]
+    offsets = _cyclic_difference(np.asarray(seen_hues)[order], probe_hues)
+    # Offsets are interpolated as unit vectors, so that offsets of both signs close to +-90 do not average to 0
+    offset_cos = np.interp(hues, probe_hues, np.cos(offsets * np.pi / 90.0), period=180.0)
+    offset_sin = np.interp(hues, probe_hues, np.sin(offsets * np.pi / 90.0), period=180.0)
+    predicted_offsets = np.arctan2(offset_sin, offset_cos) * 90.0 / np.pi
+
+    predicted_stds = np.interp(hues, probe_hues, np.asarray(hue_stds)[order], period=180.0)
+    return (np.asarray(hues, dtype=np.float64) + predicted_offsets) % 180.0, predicted_stds
+
+
+def estimate_symbol_error_rate(probe_hues, seen_hues, hue_stds, num_bits, frames_per_symbol) -> float:
+    """
+    Estimates the symbol error rate of the evenly spaced constellation of 2^num_bits hues, assuming that the
+    receiver classifies each symbol to the closest calibrated hue, with a gaussian error on the measured hue whose
+    deviation decreases with the square root of the number of integrated frames.
+
+    :param probe_hues: calibration hues displayed by the transmitter
+    :param seen_hues: mean hues seen by the receiver for each probe hue
+    :param hue_stds: per frame deviation of the seen hues for each probe hue
+    :param num_bits: number of bits per symbol
+    :param frames_per_symbol: number of frames integrated per symbol
+    :return: the mean symbol error probability
+    """
+    constellation = get_evenly_spaced_hues(2 ** num_bits)
+    predicted_hues, predicted_stds = predict_seen_hues(probe_hues, seen_hues, hue_stds, constellation)
+
+    distances = np.abs(_cyclic_difference(predicted_hues[:, np.newaxis], predicted_hues[np.newaxis, :]))
+    np.fill_diagonal(distances, np.inf)
+    # Half the distance to the closest other symbol is the decision margin, crossed on either side
+    margins = distances.min(axis=1) / 2.0
+    sigmas = np.maximum(predicted_stds, Constants.MODULATION_HUE_STD_FLOOR) / math.sqrt(max(frames_per_symbol, 1.0))
+
+    return float(np.mean([math.erfc(margin / (sigma * math.sqrt(2.0))) for margin, sigma in zip(margins, sigmas)]))
+
+
+def select_modulation(probe_hues, seen_hues, hue_stds, frames_per_tick, base_period):
+    """
+    Selects the candidate with the highest bit rate whose estimated symbol error rate is below
+    MODULATION_TARGET_SER, or the most reliable candidate if none is.
+
+    :param probe_hues: calibration hues displayed by the transmitter
+    :param seen_hues: mean hues seen by the receiver for each probe hue
+    :param hue_stds: per frame deviation of the seen hues for each probe hue
+    :param frames_per_tick: mean number of frames captured in the stable part of a calibration tick
+    :param base_period: symbol period of the calibration
+    :return: the index of the selected candidate, and the estimated symbol error rate of each candidate (None for
+    the candidates that are too fast for the camera)
+    """
+    estimates = []
+    for num_bits, period in get_candidates():
+        frames_per_symbol = frames_per_tick * period / base_period
+        if frames_per_symbol < Constants.MODULATION_MIN_FRAMES_PER_SYMBOL and period < base_period:
+            estimates.append(None)
+            continue
+        if not Constants.MULTI_FRAME_INTEGRATION:
+            frames_per_symbol = 1.0
+        estimates.append(estimate_symbol_error_rate(probe_hues, seen_hues, hue_stds, num_bits, frames_per_symbol))
+
+    candidates = get_candidates()
+    valid = [i for i in range(0, len(candidates)) if estimates[i] is not None]
+    reliable = [i for i in valid if estimates[i] <= Constants.MODULATION_TARGET_SER]
+    if len(reliable) > 0:
+        index = max(reliable, key=lambda i: (candidates[i][0] / candidates[i][1], -estimates[i]))
+    else:
+        index = min(valid, key=lambda i: (estimates[i], -candidates[i][0] / candidates[i][1]))
+
+    return index, estimates
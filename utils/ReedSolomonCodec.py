@@ -0,0 +1,197 @@
+import numpy as np
+import unireedsolomon
+from typing import Tuple
+
+from utils import Constants
+
+# GF(2^8) arithmetic, with the same field as unireedsolomon.RSCoder defaults (generator 3, prime polynomial 0x11b)
+GF_GENERATOR = 3
+GF_PRIM = 0x11b
+GF_FCR = 1
+
+
+def _gf_mul_no_lut(x, y):
+    result = 0
+    while y:
+        if y & 1:
+            result ^= x
+        y >>= 1
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_PRIM
+    return result
+
+
+GF_EXP = np.zeros(512, dtype=np.int64)
+GF_LOG = np.zeros(256, dtype=np.int64)
+_x = 1
+for _i in range(0, 255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x = _gf_mul_no_lut(_x, GF_GENERATOR)
+GF_EXP[255:510] = GF_EXP[0:255]
+
+# GF_MUL[a, b] is the product of a and b
+GF_MUL = np.where((np.arange(256)[:, np.newaxis] > 0) & (np.arange(256)[np.newaxis, :] > 0),
+                  GF_EXP[GF_LOG[:, np.newaxis] + GF_LOG[np.newaxis, :]], 0).astype(np.uint8)
+
+
+def get_generator_polynomial(num_ecc) -> np.ndarray:
+    """Coefficients (highest degree first) of g(x) = (x - a^fcr) ... (x - a^(fcr + num_ecc - 1))"""
+    generator = np.array([1], dtype=np.uint8)
+    for i in range(0, num_ecc):
+        root = GF_EXP[i + GF_FCR]
+        shifted = np.append(generator, 0).astype(np.uint8)
+        scaled = np.insert(GF_MUL[generator, root], 0, 0).astype(np.uint8)
+        generator = shifted ^ scaled
+    return generator
+
+
+class ReedSolomonCodec:
+    """
+    Reed-Solomon coding layer of the packets. A packet carries depth codewords of RS(n, k), whose bytes are
+    interleaved (byte j of codeword d is sent at position j * depth + d), so that a burst of misread symbols is
+    spread over several codewords.
+
+    Encoding and error detection are vectorized over whole batches of codewords. Only the codewords with non null
+    syndromes are decoded by unireedsolomon, which also reports the number of corrected bytes.
+    """
+
+    def __init__(self, n=None, k=None, depth=None):
+        self.n = Constants.RS_codeword_size if n is None else n
+        self.k = Constants.RS_message_size if k is None else k
+        self.depth = Constants.RS_INTERLEAVING_DEPTH if depth is None else depth
+
+        self.message_size = self.k * self.depth
+        self.packet_size = self.n * self.depth
+        self.generator = get_generator_polynomial(self.n - self.k)
+        self.syndrome_roots = GF_EXP[np.arange(GF_FCR, GF_FCR + self.n - self.k)].astype(np.uint8)
+        self.rs_coder = unireedsolomon.RSCoder(self.n, self.k)
+
+    def encode(self, message) -> np.ndarray:
+        """
+        :param message: bytes-like object of at most message_size bytes, zero padded at the end
+        :return: uint8 array of packet_size interleaved bytes
+        """
+        return self.encode_batch(self._to_array(message, self.message_size)[np.newaxis, :])[0]
+
+    def encode_batch(self, messages) -> np.ndarray:
+        """
+        :param messages: uint8 array of shape (number of packets, message_size)
+        :return: uint8 array of shape (number of packets, packet_size)
+        """
+        messages = np.asarray(messages, dtype=np.uint8)
+        codeword_messages = messages.reshape(-1, self.k)
+
+        # Systematic encoding: the parity bytes are the remainder of m(x) * x^(n - k) divided by g(x), computed
+        # for all the codewords at once by a linear feedback shift register
+        remainder = np.zeros((len(codeword_messages), self.n - self.k), dtype=np.uint8)
+        for j in range(0, self.k):
+            feedback = codeword_messages[:, j] ^ remainder[:, 0]
+            remainder[:, :-1] = remainder[:, 1:]
+            remainder[:, -1] = 0
+            remainder ^= GF_MUL[feedback[:, np.newaxis], self.generator[np.newaxis, 1:]]
+
+        codewords = np.concatenate((codeword_messages, remainder), axis=1)
+        return self._interleave(codewords.reshape(len(messages), self.depth, self.n))
+
+    def compute_syndromes(self, codewords) -> np.ndarray:
+        """
+        :param codewords: uint8 array of shape (number of codewords, n)
+        :return: uint8 array of shape (number of codewords, n - k), all null for valid codewords
+        """
+        syndromes = np.zeros((len(codewords), self.n - self.k), dtype=np.uint8)
+        for j in range(0, self.n):
+            syndromes = GF_MUL[syndromes, self.syndrome_roots[np.newaxis, :]] ^ codewords[:, j, np.newaxis]
+        return syndromes
+
+    def decode(self, packet, erasures_pos=None) -> Tuple[np.ndarray, int]:
+        """
+        :param packet: packet_size interleaved bytes
+        :param erasures_pos: optional positions of the packet bytes that are known to be unreliable
+        :return: the message_size bytes of the message, and the number of corrected bytes
+        :raise unireedsolomon.RSCodecError: when a codeword cannot be decoded
+        """
+        codewords = self._deinterleave(self._to_array(packet, self.packet_size)[np.newaxis, :])[0]
+        invalid = np.any(self.compute_syndromes(codewords), axis=1)
+
+        codeword_erasures = [[] for d in range(0, self.depth)]
+        for position in (erasures_pos or []):
+            codeword_erasures[position % self.depth].append(position // self.depth)
+
+        corrected_count = 0
+        messages = codewords[:, :self.k].copy()
+        for d in np.flatnonzero(invalid):
+            decoded_codeword = self._decode_codeword(codewords[d], codeword_erasures[d])
+            corrected_count += int(np.count_nonzero(decoded_codeword != codewords[d]))
+            messages[d] = decoded_codeword[:self.k]
+
+        return messages.ravel(), corrected_count
+
+    def decode_soft(self, packet, byte_confidences, threshold, max_erasures) -> Tuple[np.ndarray, int]:
+        """
+        Generalized minimum distance decoding: each codeword that cannot be decoded as is, is decoded again with its
+        2, 4, ... least confident bytes (among the ones below the threshold) as erasures, up to max_erasures, until
+        it succeeds. An erasure only uses half the redundancy needed to correct an error.
+
+        :param packet: packet_size interleaved bytes
+        :param byte_confidences: confidence of each of the packet_size bytes
+        :param threshold: confidence below which bytes can be erased
+        :param max_erasures: maximum number of erasures per codeword
+        :return: the message_size bytes of the message, and the number of corrected bytes
+        :raise unireedsolomon.RSCodecError: when a codeword cannot be decoded
+        """
+        codewords = self._deinterleave(self._to_array(packet, self.packet_size)[np.newaxis, :])[0]
+        confidences = self._deinterleave(np.asarray(byte_confidences, dtype=np.float64)[np.newaxis, :])[0]
+        invalid = np.any(self.compute_syndromes(codewords), axis=1)
+
+        corrected_count = 0
+        messages = codewords[:, :self.k].copy()
+        for d in np.flatnonzero(invalid):
+            candidates = [int(j) for j in np.argsort(confidences[d], kind='stable') if confidences[d, j] < threshold]
+            erasure_limit = max(0, min(max_erasures, len(candidates)))
+            erasure_counts = list(range(0, erasure_limit + 1, 2))
+            if erasure_counts[-1] != erasure_limit:
+                erasure_counts.append(erasure_limit)
+
+            for erasure_count in erasure_counts:
+                try:
+                    decoded_codeword = self._decode_codeword(codewords[d], candidates[:erasure_count])
+                    break
+                except unireedsolomon.RSCodecError:
+                    if erasure_count == erasure_counts[-1]:
+                        raise
+
+            corrected_count += int(np.count_nonzero(decoded_codeword != codewords[d]))
+            messages[d] = decoded_codeword[:self.k]
+
+        return messages.ravel(), corrected_count
+
+    def _decode_codeword(self, codeword, erasures_pos) -> np.ndarray:
+        """
+        :param codeword: the n bytes of a codeword with non null syndromes
+        :param erasures_pos: positions of the erased bytes in the codeword
+        :return: the corrected codeword
+        :raise unireedsolomon.RSCodecError: when the codeword cannot be decoded
+        """
+        message, ecc = self.rs_coder.decode(codeword, nostrip=True, erasures_pos=sorted(erasures_pos) or None,
+                                            return_string=False)
+        decoded_codeword = np.array(list(message) + list(ecc), dtype=np.uint8)
+        # Beyond its correction capability, the decoder can output a word that is not a codeword
+        if np.any(self.compute_syndromes(decoded_codeword[np.newaxis, :])):
+            raise unireedsolomon.RSCodecError("Could not correct codeword")
+        return decoded_codeword
+
+    def _interleave(self, codewords):
+        # (packets, depth, n) -> (packets, n * depth), with byte j of codeword d at position j * depth + d
+        return codewords.transpose(0, 2, 1).reshape(len(codewords), self.packet_size)
+
+    def _deinterleave(self, packets):
+        return packets.reshape(len(packets), self.n, self.depth).transpose(0, 2, 1)
+
+    def _to_array(self, data, size):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(data, dtype=np.uint8)
+        array = np.zeros(size, dtype=np.uint8)
+        array[:len(data)] = data
+        return array
@@ -0,0 +1,90 @@
+import platform
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+# The head and tail counters are kept on separate cache lines, as they are written by different processes
+COUNTER_STRIDE = 64
+HEADER_SIZE = 2 * COUNTER_STRIDE
+# Machines on which the stores of a process are seen in order by the other processes (total store order)
+STORE_ORDERED_MACHINES = ('x86_64', 'amd64', 'x86', 'i386', 'i686')
+
+
+def is_store_ordered() -> bool:
+    """Whether the stores of a process are seen in order by the other processes on this machine, as on x86"""
+    return platform.machine().lower() in STORE_ORDERED_MACHINES
+
+
+class SharedRing:
+    """
+    Single producer, single consumer queue of fixed size records in a shared memory block, without locks nor system
+    calls, so that two processes can exchange records by polling it.
+
+    The producer writes a record in place and then publishes it by incrementing the tail counter, and the consumer
+    reads a record in place and then releases it by incrementing the head counter. Each counter is only written by one
+    side, after the record, which relies on the stores of a process being seen in order by the other one (as on x86).
+    Python has no memory barrier to order them on weakly ordered machines (e.g. ARM), on which a process could see a
+    counter before the record, so the ring cannot be created there.
+    """
+
+    def __init__(self, dtype, capacity, name=None):
+        """
+        :param dtype: numpy dtype of the records, usually a structured dtype
+        :param capacity: number of records
+        :param name: name of the shared memory block of an existing ring to attach to, or None to create a ring
+        :raise RuntimeError: on a machine whose stores are not seen in order by the other processes
+        """
+        if not is_store_ordered():
+            raise RuntimeError("SharedRing relies on the store ordering of x86, and is not supported on " +
+                               platform.machine())
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity * self.dtype.itemsize)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+
+        self.head = np.ndarray((1,), dtype=np.int64, buffer=self.memory.buf, offset=0)
+        self.tail = np.ndarray((1,), dtype=np.int64, buffer=self.memory.buf, offset=COUNTER_STRIDE)
+        self.records = np.ndarray((capacity,), dtype=self.dtype, buffer=self.memory.buf, offset=HEADER_SIZE)
+        if self.owner:
+            self.head[0] = 0
+            self.tail[0] = 0
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def __len__(self):
+        return int(self.tail[0] - self.head[0])
+
+    def get_write_slot(self) -> Optional[np.ndarray]:
+        """Record in which the next record has to be written before calling publish, or None if the ring is full"""
+        tail = int(self.tail[0])
+        if tail - int(self.head[0]) >= self.capacity:
+            return None
+        return self.records[tail % self.capacity]
+
+    def publish(self):
+        """Makes the record written in the current write slot available to the consumer"""
+        self.tail[0] += 1
+
+    def peek(self) -> Optional[np.ndarray]:
+        """Oldest record, which stays valid until release is called, or None if the ring is empty"""
+        head = int(self.head[0])
+        if head == int(self.tail[0]):
+            return None
+        return self.records[head % self.capacity]
+
+    def release(self):
+        """Frees the oldest record, once it has been read"""
+        self.head[0] += 1
+
+    def close(self):
+        # The views on the block must be dropped before closing it
+        self.head = self.tail = self.records = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
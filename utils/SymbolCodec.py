@@ -0,0 +1,76 @@
+import numpy as np
+
+from utils.Constants import NUM_BITS
+
+MAX_NUM_BITS = 6
+
+# SYMBOL_BITS[num_bits][symbol] is the row of the num_bits bits of the symbol, most significant bit first
+SYMBOL_BITS = [None] + [((np.arange(2 ** n)[:, np.newaxis] >> np.arange(n - 1, -1, -1)) & 1).astype(np.uint8)
+                        for n in range(1, MAX_NUM_BITS + 1)]
+# BIT_WEIGHTS[num_bits] converts rows of num_bits bits back to symbols
+BIT_WEIGHTS = [None] + [np.uint8(1) << np.arange(n - 1, -1, -1, dtype=np.uint8) for n in range(1, MAX_NUM_BITS + 1)]
+
+
+def bytes_to_symbols(data, num_bits=NUM_BITS) -> np.ndarray:
+    """
+    Splits bytes into num_bits symbols, starting from the most significant bit of the first byte. The last symbol
+    is padded with zeros.
+
+    :param data: bytes-like object or array of bytes
+    :param num_bits: number of bits per symbol, between 1 and MAX_NUM_BITS
+    :return: uint8 array of symbol indices
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(data, dtype=np.uint8)
+    bits = np.unpackbits(np.asarray(data, dtype=np.uint8))
+    padding = -len(bits) % num_bits
+    if padding > 0:
+        bits = np.concatenate((bits, np.zeros(padding, dtype=np.uint8)))
+
+    return bits.reshape(-1, num_bits).dot(BIT_WEIGHTS[num_bits]).astype(np.uint8)
+
+
+def symbols_to_bytes(symbols, num_bytes, num_bits=NUM_BITS) -> np.ndarray:
+    """
+    Reassembles bytes from num_bits symbols, starting from the most significant bit of the first byte. Missing
+    bits are set to zero, and padding bits are ignored.
+
+    :param symbols: array of symbol indices
+    :param num_bytes: number of bytes to reassemble
+    :param num_bits: number of bits per symbol, between 1 and MAX_NUM_BITS
+    :return: uint8 array of num_bytes bytes
+    """
+    bits = SYMBOL_BITS[num_bits][np.asarray(symbols, dtype=np.intp)].ravel()
+    if len(bits) < 8 * num_bytes:
+        bits = np.concatenate((bits, np.zeros(8 * num_bytes - len(bits), dtype=np.uint8)))
+
+    return np.packbits(bits[:8 * num_bytes])
+
+
+def get_byte_confidences(symbol_confidences, num_bytes, num_bits=NUM_BITS) -> np.ndarray:
+    """
+    Confidence of each reassembled byte, i.e. the lowest confidence of the symbols carrying its bits. Bytes that
+    are not fully carried by the symbols have a null confidence.
+
+    :param symbol_confidences: confidence of each symbol
+    :param num_bytes:
+    :param num_bits: number of bits per symbol, between 1 and MAX_NUM_BITS
+    :return: float array of num_bytes confidences
+    """
+    symbol_confidences = np.asarray(symbol_confidences, dtype=np.float64)
+    positions = np.arange(len(symbol_confidences)) * num_bits
+    confidences = np.full(num_bytes, np.inf)
+
+    # A symbol carries bits of at most two bytes: the ones of its first and last bits
+    for byte_indices in (positions // 8, (positions + num_bits - 1) // 8):
+        valid = byte_indices < num_bytes
+        np.minimum.at(confidences, byte_indices[valid], symbol_confidences[valid])
+
+    # Bytes whose bits are not all carried by the symbols
+    confidences[len(symbol_confidences) * num_bits // 8:] = 0.0
+    return confidences
+
+
+def get_num_symbols(num_bytes, num_bits=NUM_BITS) -> int:
+    """Number of num_bits symbols needed to carry num_bytes bytes"""
+    return -(-8 * num_bytes // num_bits)
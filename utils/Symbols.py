@@ -1,9 +1,12 @@
 from utils.Constants import WIDTH, HEIGHT, NUM_BITS
 from utils.HSVBounds import *
+from utils.Modulation import get_evenly_spaced_hues
 
 S_VOID = 0
 S_NO_ACK = 15
 S_ACK = 105
+# Shown instead of S_ACK to offer (receiver) or accept (transmitter) a warm start from the calibration profiles
+S_WARM_ACK = 60
 
 # Deprecated variables
 S_ZERO = S_NO_ACK
@@ -26,11 +29,15 @@ BIT_MASK = NUM_SYMBOLS - 1
 
 SYMBOLS = np.zeros((NUM_SYMBOLS), dtype=np.uint8)
 
-SYMBOLS[0] = np.uint8(10)
-SYMBOLS[1] = np.uint8(20)
-SYMBOLS[2] = np.uint8(30)
-SYMBOLS[3] = np.uint8(50)
-SYMBOLS[4] = np.uint8(80)
-SYMBOLS[5] = np.uint8(110)
-SYMBOLS[6] = np.uint8(140)
-SYMBOLS[7] = np.uint8(170)
\ No newline at end of file
+if NUM_BITS == 3:
+    SYMBOLS[0] = np.uint8(10)
+    SYMBOLS[1] = np.uint8(20)
+    SYMBOLS[2] = np.uint8(30)
+    SYMBOLS[3] = np.uint8(50)
+    SYMBOLS[4] = np.uint8(80)
+    SYMBOLS[5] = np.uint8(110)
+    SYMBOLS[6] = np.uint8(140)
+    SYMBOLS[7] = np.uint8(170)
+else:
+    # Other constellations have evenly spaced hues
+    SYMBOLS[:] = get_evenly_spaced_hues(NUM_SYMBOLS)
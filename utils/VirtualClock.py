@@ -0,0 +1,77 @@
+import threading
+import time
+
+
+class SimulationStopped(Exception):
+    """Raised in the participant threads sleeping on a virtual clock that was stopped"""
+    pass
+
+
+class RealClock:
+    """Wall clock, used by the state machines outside of the headless simulation"""
+
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, duration):
+        if duration > 0:
+            time.sleep(duration)
+
+
+class VirtualClock:
+    """
+    Discrete event clock shared by the threads of a simulation. The time only advances when all the participant
+    threads are sleeping, and then jumps to the earliest wake up time, so that a session runs as fast as the CPU
+    allows while keeping the relative timings of the threads.
+
+    The number of participants must be registered before they start, and each participant must unregister when it
+    terminates. A participant that waits without calling sleep (e.g. a busy loop on time()) stalls the clock.
+    """
+
+    def __init__(self, start_time=0.0):
+        self.now = start_time
+        self.participant_count = 0
+        self.wake_times = {}
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def register(self):
+        with self.condition:
+            self.participant_count += 1
+
+    def unregister(self):
+        with self.condition:
+            self.participant_count -= 1
+            self._advance()
+
+    def stop(self):
+        """Terminates the participants, which raise SimulationStopped from their current or next sleep"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, duration):
+        with self.condition:
+            if self.stopped:
+                raise SimulationStopped()
+
+            thread_id = threading.get_ident()
+            wake_time = self.now + max(duration, 0.0)
+            self.wake_times[thread_id] = wake_time
+            self._advance()
+
+            while self.now < wake_time and not self.stopped:
+                self.condition.wait()
+            del self.wake_times[thread_id]
+
+            if self.stopped:
+                raise SimulationStopped()
+
+    def _advance(self):
+        # Called with the condition held
+        if len(self.wake_times) > 0 and len(self.wake_times) >= self.participant_count:
+            self.now = max(self.now, min(self.wake_times.values()))
+            self.condition.notify_all()
@@ -0,0 +1,277 @@
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+from cv.CV_GUI_Handler import MAIN_WINDOW, OpenCvHandler
+from cv.CV_Video_Capture_Handler import CV_Video_Capture_Handler
+from rcvr import receiver
+from snd import transmitter
+from utils import Constants
+from utils.ReedSolomonCodec import ReedSolomonCodec
+from utils.VirtualClock import VirtualClock
+from utils.simulation_handler import SimulationHandler, get_crashed_names, get_random_channel, run_state_machine
+
+
+def get_stripes(file_size, payload_size, link_count) -> list:
+    """
+    Splits a file into one contiguous stripe per link, aligned on the packet payloads so that only the last packet of
+    each stripe is padded
+
+    :return: list of (offset, length) of the stripe of each link, the last ones being empty for small files
+    """
+    payload_count = -(-file_size // payload_size)
+    stripe_size = max(1, -(-payload_count // link_count)) * payload_size
+
+    stripes = []
+    for i in range(0, link_count):
+        offset = min(i * stripe_size, file_size)
+        stripes.append((offset, min(stripe_size, file_size - offset)))
+    return stripes
+
+
+def get_part_file_name(output_file_name, link_index) -> str:
+    """File written by the receiver of the given link, with the stripe it received"""
+    return output_file_name + ".part" + str(link_index)
+
+
+def join_parts(output_file_name, link_count) -> bool:
+    """
+    Concatenates the stripes received by the links into the output file, and removes them
+
+    :return: whether the stripes of all the links were received
+    """
+    complete = True
+    with open(output_file_name, "wb") as f:
+        for i in range(0, link_count):
+            part_file_name = get_part_file_name(output_file_name, i)
+            if not os.path.exists(part_file_name):
+                logging.error("Link " + str(i) + " did not receive its stripe")
+                complete = False
+                continue
+            with open(part_file_name, "rb") as part:
+                f.write(part.read())
+            os.remove(part_file_name)
+    return complete
+
+
+class LinkManager:
+    """
+    Runs the transmitters or the receivers of several links in parallel, in the threads of the same process. Each link
+    has its own camera and screen: its frames are captured by the thread of its capture handler, and its packets are
+    decoded by the thread of its state machine.
+
+    The stripes of a file are assigned to the links in order, so that link i of the transmitting machine must face
+    link i of the receiving machine.
+    """
+
+    def __init__(self, clock=None):
+        """
+        :param clock: virtual clock of a simulation, on which the state machine threads are registered
+        """
+        self.clock = clock
+        self.results = {}
+        self.threads = []
+
+    def add_transmitter(self, file_name, stripe, cap, cv_handler, name):
+        """
+        :param file_name: file whose stripe is transmitted
+        :param stripe: (offset, length) of the stripe of the link
+        :param cap: capture backend of the link
+        :param cv_handler: display backend of the link
+        :param name: name of the link transmitter, in the results and the instrumentation
+        :return:
+        """
+        offset, length = stripe
+        self._add_state_machine(name, lambda: transmitter.Transmitter(file_name, cap, cv_handler, name, offset, length))
+
+    def add_receiver(self, output_file_name, cap, cv_handler, name):
+        """
+        :param output_file_name: file written with the stripe received by the link
+        :param cap: capture backend of the link
+        :param cv_handler: display backend of the link
+        :param name: name of the link receiver, in the results and the instrumentation
+        :return:
+        """
+        self._add_state_machine(name, lambda: receiver.Receiver(output_file_name, cap, cv_handler, name))
+
+    def _add_state_machine(self, name, constructor):
+        self.threads.append(threading.Thread(target=run_state_machine,
+                                             args=(name, constructor, self.results, self.clock), daemon=True))
+
+    def run(self, max_duration=None) -> dict:
+        """
+        Runs all the state machines until they exit, or until one of them crashes
+
+        :param max_duration: (virtual) time after which a simulation is aborted, in seconds
+        :return: the state machines by name, their end and CPU times, and the exceptions of those that crashed
+        """
+        for thread in self.threads:
+            if self.clock is not None:
+                self.clock.register()
+            thread.start()
+
+        while any(thread.is_alive() for thread in self.threads):
+            if self.clock is not None and max_duration is not None and self.clock.time() > max_duration:
+                logging.error("Links aborted after " + str(max_duration) + " seconds")
+                self.clock.stop()
+                break
+            if len(get_crashed_names(self.results)) > 0:
+                logging.error("Links aborted, as the " + ", ".join(get_crashed_names(self.results)) + " crashed")
+                if self.clock is not None:
+                    self.clock.stop()
+                break
+            time.sleep(0.01)
+
+        for thread in self.threads:
+            thread.join(1.0)
+        return self.results
+
+
+def send_file(file_name, device_indices, window_positions=None):
+    """
+    Transmits a file over several links, one stripe per link
+
+    :param file_name: file to transmit
+    :param device_indices: camera of each link
+    :param window_positions: optional (x, y) desktop position of the window of each link, to open it on its screen
+    :return:
+    """
+    link_count = len(device_indices)
+    stripes = get_stripes(os.path.getsize(file_name), transmitter.get_payload_size(ReedSolomonCodec()), link_count)
+
+    manager = LinkManager()
+    for i in range(0, link_count):
+        position = window_positions[i] if window_positions is not None else None
+        manager.add_transmitter(file_name, stripes[i], CV_Video_Capture_Handler(device_indices[i]),
+                                OpenCvHandler(MAIN_WINDOW + "_" + str(i), position=position), "transmitter" + str(i))
+    manager.run()
+
+
+def receive_file(output_file_name, device_indices, window_positions=None) -> bool:
+    """
+    Receives a file over several links, and joins the stripes received by each link
+
+    :return: whether the stripes of all the links were received
+    """
+    link_count = len(device_indices)
+    manager = LinkManager()
+    for i in range(0, link_count):
+        position = window_positions[i] if window_positions is not None else None
+        manager.add_receiver(get_part_file_name(output_file_name, i), CV_Video_Capture_Handler(device_indices[i]),
+                             OpenCvHandler(MAIN_WINDOW + "_" + str(i), position=position), "receiver" + str(i))
+    manager.run()
+    return join_parts(output_file_name, link_count)
+
+
+def run_simulated_links(file_name, output_file_name, link_count, max_duration=600.0, channel_seed=None,
+                        channel_severity=1.0) -> dict:
+    """
+    Runs the transmitters and the receivers of several simulated links in parallel on a shared virtual clock
+
+    :param file_name: file to transmit
+    :param output_file_name: file joined from the stripes received by the links
+    :param link_count: number of links
+    :param max_duration: (virtual) time after which the session is aborted, in seconds
+    :param channel_seed: optional seed of the random channels of the links, the ideal camera being simulated otherwise
+    :param channel_severity: scale of the channel impairments
+    :return: statistics of the session
+    """
+    if os.path.exists(output_file_name):
+        os.remove(output_file_name)
+
+    Constants.DEBUG = False
+    Constants.SIMULATE = True
+    clock = VirtualClock()
+    Constants.CLOCK = clock
+
+    stripes = get_stripes(os.path.getsize(file_name), transmitter.get_payload_size(ReedSolomonCodec()), link_count)
+    manager = LinkManager(clock)
+    for i in range(0, link_count):
+        simulation_handler = SimulationHandler()
+        if channel_seed is not None:
+            seed = channel_seed + 2 * i
+            simulation_handler.tmtr.set_channel(get_random_channel(seed, channel_severity))
+            simulation_handler.rcvr.set_channel(get_random_channel(seed + 1, channel_severity))
+        # Each simulated side is both the camera and the screen of its state machine
+        manager.add_receiver(get_part_file_name(output_file_name, i), simulation_handler.rcvr, simulation_handler.rcvr,
+                             "receiver" + str(i))
+        manager.add_transmitter(file_name, stripes[i], simulation_handler.tmtr, simulation_handler.tmtr,
+                                "transmitter" + str(i))
+
+    wall_start_time = time.time()
+    results = manager.run(max_duration)
+    wall_time = time.time() - wall_start_time
+    Constants.CLOCK = None
+
+    complete = join_parts(output_file_name, link_count)
+    with open(file_name, "rb") as f:
+        sent_data = f.read()
+    with open(output_file_name, "rb") as f:
+        received_data = f.read()
+
+    # The links run concurrently, so the file is received at the end of the longest data phase
+    data_times = []
+    for i in range(0, link_count):
+        tmtr = results.get("transmitter" + str(i))
+        data_times.append(sum(tmtr.state_times.get(state, 0.0) for state in
+                              (transmitter.State.SEND, transmitter.State.WAIT_FOR_ACK)) if tmtr else 0.0)
+    data_time = max(data_times)
+
+    return {
+        'success': len(get_crashed_names(results)) == 0 and complete and received_data == sent_data,
+        'crashed': get_crashed_names(results),
+        'link_count': link_count,
+        'file_size': len(sent_data),
+        'received_size': len(received_data),
+        'stripe_sizes': [length for offset, length in stripes],
+        'data_times': data_times,
+        'data_time': data_time,
+        'goodput': 8.0 * len(received_data) / data_time if data_time > 0 else 0.0,
+        'session_time': max([t for name, t in results.items() if name.endswith('_end_time')] or [0.0]),
+        'wall_time': wall_time,
+    }
+
+
+def _parse_position(text):
+    x, y = text.split(",")
+    return int(x), int(y)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transmits a file over several camera/screen links in parallel")
+    parser.add_argument('mode', choices=['send', 'receive', 'simulate'])
+    parser.add_argument('--file', default="../data/dummyText1.txt", help="file to transmit")
+    parser.add_argument('--output', default="../decoded.txt", help="file written by the receiver")
+    parser.add_argument('--devices', type=int, nargs='+', default=[0], help="camera index of each link")
+    parser.add_argument('--window-positions', type=_parse_position, nargs='+', default=None,
+                        help="x,y desktop position of the window of each link")
+    parser.add_argument('--links', type=int, default=2, help="number of simulated links")
+    parser.add_argument('--max-duration', type=float, default=600.0, help="simulated time limit, in seconds")
+    parser.add_argument('--channel-seed', type=int, default=None, help="simulate random channels from this seed")
+    parser.add_argument('--channel-severity', type=float, default=1.0, help="scale of the channel impairments")
+    args = parser.parse_args()
+
+    if args.mode == 'send':
+        send_file(args.file, args.devices, args.window_positions)
+    elif args.mode == 'receive':
+        sys.exit(0 if receive_file(args.output, args.devices, args.window_positions) else 1)
+    else:
+        logging.getLogger().setLevel(logging.WARNING)
+        stats = run_simulated_links(args.file, args.output, args.links, args.max_duration, args.channel_seed,
+                                    args.channel_severity)
+        print("Transmission " + ("succeeded" if stats['success'] else "FAILED") + " over " + str(stats['link_count']) +
+              " links: received " + str(stats['received_size']) + "/" + str(stats['file_size']) + " bytes")
+        if len(stats['crashed']) > 0:
+            print("Crashed: " + ", ".join(stats['crashed']))
+        print("Goodput: " + str(round(stats['goodput'], 2)) + " bit/s over " + str(round(stats['data_time'], 2)) +
+              " s of data phase (per link: " + str([round(t, 2) for t in stats['data_times']]) + " s)")
+        print("Session time: " + str(round(stats['session_time'], 2)) + " s, simulated in " +
+              str(round(stats['wall_time'], 2)) + " s")
+        sys.exit(0 if stats['success'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,28 @@
+import argparse
+import collections
 import logging
+import math
+import os
 import sys
 import threading
+import time
 from time import sleep
 
 import cv2
 import numpy as np
 import scipy.misc as scm
-from typing import Tuple
+from typing import List, Tuple
 
 from cv import CV_GUI_Handler, CV_Video_Capture_Handler
-from cv.CV_GUI_Handler import OpenCvHandler, NO_FRAME
-from cv.ImageProcessing import crop
+from cv.CV_GUI_Handler import NullDisplayHandler, OpenCvHandler
+from cv.Fiducials import FiducialLayout
+from cv.ImageProcessing import crop, get_rectifying_homography, warp
+from cv.SymbolRenderer import SymbolRenderer
 from rcvr import receiver
 from snd import transmitter
 from utils import Constants
-
-run_flag1 = True
-run_flag2 = True
+from utils.Instrumentation import write_chrome_trace, write_prometheus_text
+from utils.VirtualClock import SimulationStopped, VirtualClock
 
 def simulate_camera(frame):
     scaled_frame = frame[::10, ::10]
@@ -32,170 +38,617 @@ def simulate_camera(frame):
     return camera_frame
 
 
-class SimulationHandler:
-    class __SimulationHandler:
-        tmtr = None
-        rcvr = None
-
-        def __init__(self):
-            # Instantiate the 2 receiver/transmitter singletons
-            self.tmtr = SimulationHandler.TmtrSide()
-            self.rcvr = SimulationHandler.RcvrSide()
-
-        def __str__(self):
-            return "Simulation handler singleton" + repr(self)
-
-    instance = None
-
-    def __init__(self):
-        if not SimulationHandler.instance:
-            SimulationHandler.instance = SimulationHandler.__SimulationHandler()
-
-    def __getattr__(self, item):
-        return getattr(self.instance, item)
-
-    def __setattr__(self, item, value):
-        return setattr(self.instance, item, value)
-
-    class TmtrSide:
-        class __TmtrSide:
-            def __init__(self):
-                pass
-
-        tmtrInst = None
-
-        def __init__(self):
-            if not SimulationHandler.TmtrSide.tmtrInst:
-                SimulationHandler.TmtrSide.tmtrInst = SimulationHandler.TmtrSide.__TmtrSide()
-            self.frame = simulate_camera(
-                np.full((CV_GUI_Handler.HEIGHT, CV_GUI_Handler.WIDTH, 3), (0, 0, 14), dtype=np.uint8))
-
-            self.screen_boundaries = (0, CV_Video_Capture_Handler.CV_Video_Capture_Handler.WIDTH,
-                                      0, CV_Video_Capture_Handler.CV_Video_Capture_Handler.HEIGHT)
-
-        def kill(self):
-            global run_flag1
-            run_flag1 = False
-
-        def send_new_frame(self, new_frame):
-            self.frame = simulate_camera(new_frame)
-
-        def display_bgr_color(self, bgr_col):
-            """Displays the given color on the whole screen"""
-            color_frame = np.full((CV_GUI_Handler.HEIGHT, CV_GUI_Handler.WIDTH, 3), bgr_col, dtype=np.uint8)
-            self.send_new_frame(color_frame)
-
-        def display_hsv_color(self, hsv_col):
-            """Converts the given color from HSV to BGR, and displays it"""
-            converted_color = cv2.cvtColor(np.array([[[hsv_col, 255, 255]]], dtype=np.uint8), cv2.COLOR_HSV2BGR)
-            color_frame = np.full((CV_GUI_Handler.HEIGHT, CV_GUI_Handler.WIDTH, 3), converted_color, dtype=np.uint8)
-            self.send_new_frame(color_frame)
-
-        def black_out(self):
-            self.send_new_frame(NO_FRAME)
+class ChannelStage:
+    """Stage of the simulated optical channel, applied to float32 BGR camera frames with values in [0, 255]"""
+    NOISE_BANK_PADDING = 64
+    noise_bank = None
 
-        def display_hsv_frame(self, hsvframe):
-            resized_frame = scm.imresize(hsvframe, (Constants.WIDTH, Constants.HEIGHT), interp='bilinear')
-            resized_frame = cv2.cvtColor(resized_frame, cv2.COLOR_HSV2BGR)
-            self.send_new_frame(resized_frame)
+    def apply(self, frame, rng) -> np.ndarray:
+        raise NotImplementedError()
 
-        def readHSVFrame(self) -> Tuple[bool, np.ndarray]:
-            ret, frame = True, SimulationHandler.instance.rcvr.frame
-            cropped_frame = crop(simulate_camera(frame), self.screen_boundaries)
-            return ret, cv2.cvtColor(cropped_frame, cv2.COLOR_BGR2HSV)
+    def get_noise(self, shape, rng) -> np.ndarray:
+        """
+        Unit gaussian noise, read at a random offset of a noise bank drawn once (drawing a full frame of gaussian
+        noise at each capture would dominate the simulation time)
+        """
+        padding = ChannelStage.NOISE_BANK_PADDING
+        if self.noise_bank is None or self.noise_bank.shape[0] < shape[0] + padding or \
+                self.noise_bank.shape[1] < shape[1] + padding or self.noise_bank.shape[2:] != tuple(shape[2:]):
+            self.noise_bank = rng.standard_normal((shape[0] + padding, shape[1] + padding) + tuple(shape[2:]),
+                                                  dtype=np.float32)
+        dy, dx = rng.integers(0, padding, 2)
+        return self.noise_bank[dy:dy + shape[0], dx:dx + shape[1]]
 
-        def set_screen_boundaries(self, bounds):
-            self.screen_boundaries = bounds
 
-        def __getattr__(self, item):
-            return getattr(self.tmtrInst, item)
+class GammaWhiteBalanceStage(ChannelStage):
+    """The display gamma is linearized, the white balance gains are applied and the camera gamma is encoded"""
 
-        def __setattr__(self, name, value):
-            return setattr(self.tmtrInst, name, value)
+    def __init__(self, display_gamma=2.2, camera_gamma=2.2, white_balance=(1.0, 1.0, 1.0)):
+        self.display_gamma = display_gamma
+        self.camera_gamma = camera_gamma
+        self.white_balance = white_balance
+
+        # The whole transfer function is applied as a per channel lookup table, on the quantized frame
+        linear = np.power(np.arange(256) / 255.0, display_gamma)[:, np.newaxis] * np.array(white_balance)
+        self.lut = np.uint8(np.round(255.0 * np.power(np.clip(linear, 0.0, 1.0), 1.0 / camera_gamma)))
+        self.lut = self.lut.reshape(1, 256, 3)
+
+    def apply(self, frame, rng):
+        return np.float32(cv2.LUT(cv2.convertScaleAbs(frame), self.lut))
+
+
+class DefocusBlurStage(ChannelStage):
+    def __init__(self, sigma=1.0):
+        self.sigma = sigma
+
+    def apply(self, frame, rng):
+        return cv2.GaussianBlur(frame, (0, 0), self.sigma)
 
-    class RcvrSide:
-        class __ReceiverSide:
-            def __init__(self):
-                pass
 
-        rcvrInst = None
+class PerspectiveStage(ChannelStage):
+    """Keystone distortion, moving each corner of the frame inwards by up to max_displacement pixels"""
 
-        def __init__(self):
-            if not SimulationHandler.RcvrSide.rcvrInst:
-                SimulationHandler.RcvrSide.rcvrInst = SimulationHandler.RcvrSide.__ReceiverSide()
-            self.frame = simulate_camera(
-                np.full((CV_GUI_Handler.HEIGHT, CV_GUI_Handler.WIDTH, 3), (0, 0, 14), dtype=np.uint8))
+    def __init__(self, max_displacement=8.0, seed=0):
+        from utils.Constants import WIDTH, HEIGHT
+        corners = np.float32([[0, 0], [WIDTH - 1, 0], [WIDTH - 1, HEIGHT - 1], [0, HEIGHT - 1]])
+        inwards = np.float32([[1, 1], [-1, 1], [-1, -1], [1, -1]])
+        displacements = np.random.default_rng(seed).uniform(0.0, max_displacement, (4, 2)).astype(np.float32)
+        self.homography = cv2.getPerspectiveTransform(corners, corners + inwards * displacements)
+        self.size = (WIDTH, HEIGHT)
+
+    def apply(self, frame, rng):
+        return cv2.warpPerspective(frame, self.homography, self.size, flags=cv2.INTER_LINEAR)
+
+
+class GaussianNoiseStage(ChannelStage):
+    def __init__(self, sigma=2.0):
+        self.sigma = sigma
+
+    def apply(self, frame, rng):
+        return cv2.scaleAdd(ChannelStage.get_noise(self, frame.shape, rng), self.sigma, frame)
+
+
+class ShotNoiseStage(ChannelStage):
+    """Photon noise, whose variance is proportional to the intensity"""
+
+    def __init__(self, gain=0.1):
+        self.gain = gain
+
+    def apply(self, frame, rng):
+        noise_std = cv2.sqrt(cv2.max(frame, 0.0) * np.float32(self.gain))
+        return cv2.add(frame, cv2.multiply(ChannelStage.get_noise(self, frame.shape, rng), noise_std))
+
+
+class ChannelModel:
+    """
+    Simulated camera looking at a screen. A captured frame integrates the frames displayed during the exposure
+    time, each row being exposed rolling_shutter_skew seconds after the first one, and then goes through the
+    stages of the channel. When a frame rate is given, frames are only captured at multiples of the frame period
+    (shifted by the frame phase), and each capture is kept, so that successive reads return the same frame.
+    """
+
+    def __init__(self, stages=(), exposure_time=0.0, rolling_shutter_skew=0.0, frame_rate=None, frame_phase=0.0,
+                 seed=0):
+        self.stages = list(stages)
+        self.exposure_time = exposure_time
+        self.rolling_shutter_skew = rolling_shutter_skew
+        self.frame_rate = frame_rate
+        self.frame_phase = frame_phase
+        self.rng = np.random.default_rng(seed)
+
+    def get_capture_index(self, timestamp) -> int:
+        """Sequence number of the last frame captured at the given time"""
+        return int(math.floor((timestamp - self.frame_phase) * self.frame_rate))
+
+    def get_capture_time(self, index) -> float:
+        return index / self.frame_rate + self.frame_phase
+
+    def capture(self, history, capture_time) -> np.ndarray:
+        """
+        :param history: list of (display time, BGR frame) of the displayed frames, in display order
+        :param capture_time: time at which the last row of the frame is read
+        :return: BGR camera frame
+        """
+        frame = self._integrate_exposure(history, capture_time)
+        for stage in self.stages:
+            frame = stage.apply(frame, self.rng)
+        return cv2.convertScaleAbs(frame)
+
+    def _integrate_exposure(self, history, capture_time):
+        display_times = np.array([t for t, f in history])
+        height = history[-1][1].shape[0]
+
+        # Rows are read from top to bottom, each one after an exposure of exposure_time
+        row_end_times = capture_time - self.rolling_shutter_skew * np.arange(height - 1, -1, -1) / max(height - 1, 1)
+        row_start_times = row_end_times - self.exposure_time
+
+        first = max(np.searchsorted(display_times, row_start_times[0], side='right') - 1, 0)
+        last = max(np.searchsorted(display_times, row_end_times[-1], side='right') - 1, 0)
+        if first == last:
+            # No transition during the exposure of the frame
+            return np.float32(history[last][1])
+
+        frame = np.zeros(history[-1][1].shape, dtype=np.float32)
+        for i in range(first, last + 1):
+            # The first frame is considered displayed forever before, and the last one until now
+            start = display_times[i] if i > 0 else -np.inf
+            end = display_times[i + 1] if i + 1 < len(history) else np.inf
+
+            if self.exposure_time > 0:
+                weights = np.clip(np.minimum(row_end_times, end) - np.maximum(row_start_times, start), 0.0, None)
+                weights = np.float32(weights / self.exposure_time)
+            else:
+                weights = np.float32((row_end_times >= start) & (row_end_times < end))
+
+            if np.any(weights > 0):
+                frame += history[i][1] * weights[:, np.newaxis, np.newaxis]
+
+        return frame
+
+
+def get_random_channel(seed=0, severity=1.0, frame_rate=60.0) -> ChannelModel:
+    """
+    Draws the parameters of all the channel stages from the seed
+
+    :param seed:
+    :param severity: scale of the impairments, 0 giving an ideal channel (apart from the frame rate)
+    :param frame_rate: nominal camera frame rate, the actual one being slightly off
+    :return:
+    """
+    rng = np.random.default_rng(seed)
+    stages = [GammaWhiteBalanceStage(display_gamma=rng.uniform(2.0, 2.4), camera_gamma=rng.uniform(1.8, 2.4),
+                                     white_balance=1.0 + severity * rng.uniform(-0.15, 0.15, 3)),
+              PerspectiveStage(max_displacement=severity * rng.uniform(0.0, 10.0), seed=seed),
+              DefocusBlurStage(sigma=severity * rng.uniform(0.5, 1.5)),
+              ShotNoiseStage(gain=severity * rng.uniform(0.05, 0.3)),
+              GaussianNoiseStage(sigma=severity * rng.uniform(1.0, 4.0))]
+    if severity == 0:
+        stages = [GammaWhiteBalanceStage()]
+
+    frame_period = 1.0 / frame_rate
+    return ChannelModel(stages, exposure_time=severity * rng.uniform(0.3, 0.8) * frame_period,
+                        rolling_shutter_skew=severity * rng.uniform(0.3, 0.9) * frame_period,
+                        frame_rate=frame_rate * (1.0 + severity * rng.uniform(-0.02, 0.02)),
+                        frame_phase=rng.uniform(0.0, frame_period), seed=seed)
+
+
+def _get_time():
+    return Constants.CLOCK.time() if Constants.CLOCK is not None else time.time()
+
+
+def _rectify(side, camera_frame):
+    """Camera frame of a side to HSV frame, warped or cropped to the detected screen"""
+    if side.homography is not None:
+        cropped_frame = warp(camera_frame, side.homography, Constants.RECTIFIED_WIDTH, Constants.RECTIFIED_HEIGHT)
+    else:
+        cropped_frame = crop(camera_frame, side.screen_boundaries)
+    return cv2.cvtColor(cropped_frame, cv2.COLOR_BGR2HSV)
+
+
+def _get_channel_frames(side, display_side, first_index, last_index) -> List[Tuple[int, float, np.ndarray]]:
+    """
+    Frames captured through the channel of a side, which films the screen of the display side
+
+    :return: list of (sequence number, capture time, HSV frame) of the frames between both sequence numbers
+    """
+    channel = side.channel
+    history = list(display_side.history)
+    first_index = max(first_index, last_index - Constants.FRAME_BUFFER_SIZE + 1)
+
+    frames = []
+    for index in range(first_index, last_index + 1):
+        if index not in side.captures:
+            start_time = time.thread_time()
+            side.captures[index] = channel.capture(history, channel.get_capture_time(index))
+            side.channel_cpu_time += time.thread_time() - start_time
+        frames.append((index, channel.get_capture_time(index), _rectify(side, side.captures[index])))
+
+    for index in [i for i in side.captures if i <= last_index - Constants.FRAME_BUFFER_SIZE]:
+        del side.captures[index]
+
+    return frames
+
+
+def _read_channel_frame(side, display_side, timestamp=None) -> np.ndarray:
+    """HSV frame captured through the channel of a side, the closest to the given time (by default the last one)"""
+    current_time = _get_time()
+    if side.channel.frame_rate is None:
+        start_time = time.thread_time()
+        camera_frame = side.channel.capture(list(display_side.history), current_time)
+        side.channel_cpu_time += time.thread_time() - start_time
+        return _rectify(side, camera_frame)
+
+    index = side.channel.get_capture_index(current_time)
+    if timestamp is not None:
+        index = min(index, int(round((timestamp - side.channel.frame_phase) * side.channel.frame_rate)))
+    return _get_channel_frames(side, display_side, index, index)[0][2]
+
+
+def _read_channel_frames_between(side, display_side, start_time, end_time) -> List[np.ndarray]:
+    channel = side.channel
+    if channel.frame_rate is None:
+        return [_read_channel_frame(side, display_side)]
+
+    first_index = channel.get_capture_index(start_time) + 1
+    last_index = channel.get_capture_index(min(end_time, _get_time()))
+    return [frame for index, t, frame in _get_channel_frames(side, display_side, first_index, last_index)]
+
+
+def _read_channel_frames_since(side, display_side, sequence_number) -> List[Tuple[int, float, np.ndarray]]:
+    if side.channel.frame_rate is None:
+        # Frames captured continuously have no sequence numbers
+        return []
+    return _get_channel_frames(side, display_side, sequence_number + 1,
+                               side.channel.get_capture_index(_get_time()))
+
+
+class SimulatedSide:
+    """
+    Simulated side of a link, which is both the screen and the camera of its state machine: the frames it displays
+    are filmed by the simulated camera when they are sent, and it films the screen of its peer, either ideally or
+    through a ChannelModel
+    """
 
-            self.screen_boundaries = (0, CV_Video_Capture_Handler.CV_Video_Capture_Handler.WIDTH,
-                                      0, CV_Video_Capture_Handler.CV_Video_Capture_Handler.HEIGHT)
-
-        def kill(self):
-            global run_flag2
-            run_flag2 = False
-
-        def send_new_frame(self, new_frame):
-            self.frame = simulate_camera(new_frame)
-
-        def display_bgr_color(self, bgr_col):
-            """Displays the given color on the whole screen"""
-            color_frame = np.full((CV_GUI_Handler.HEIGHT, CV_GUI_Handler.WIDTH, 3), bgr_col, dtype=np.uint8)
-            self.send_new_frame(color_frame)
-
-        def display_hsv_color(self, hsv_col):
-            """Converts the given color from HSV to BGR, and displays it"""
-            converted_color = cv2.cvtColor(np.array([[[hsv_col, 255, 255]]], dtype=np.uint8), cv2.COLOR_HSV2BGR)
-            color_frame = np.full((CV_GUI_Handler.HEIGHT, CV_GUI_Handler.WIDTH, 3), converted_color, dtype=np.uint8)
-            self.send_new_frame(color_frame)
-
-        def black_out(self):
-            self.send_new_frame(NO_FRAME)
-
-        def display_hsv_frame(self, hsvframe):
-            resized_frame = scm.imresize(hsvframe, (Constants.WIDTH, Constants.HEIGHT), interp='bilinear')
-            resized_frame = cv2.cvtColor(resized_frame, cv2.COLOR_HSV2BGR)
-            self.send_new_frame(resized_frame)
-
-        def readHSVFrame(self) -> Tuple[bool, np.ndarray]:
-            ret, frame = True, SimulationHandler.instance.tmtr.frame
-            cropped_frame = crop(simulate_camera(frame), self.screen_boundaries)
-            return ret, cv2.cvtColor(cropped_frame, cv2.COLOR_BGR2HSV)
+    def __init__(self):
+        self.frame = simulate_camera(
+            np.full((CV_GUI_Handler.HEIGHT, CV_GUI_Handler.WIDTH, 3), (0, 0, 14), dtype=np.uint8))
+
+        self.screen_boundaries = (0, CV_Video_Capture_Handler.CV_Video_Capture_Handler.WIDTH,
+                                  0, CV_Video_Capture_Handler.CV_Video_Capture_Handler.HEIGHT)
+        self.homography = None
+
+        # Frames displayed by this side, and frames captured through the channel by its camera (if any)
+        self.history = collections.deque([(-np.inf, self.frame)], maxlen=Constants.FRAME_BUFFER_SIZE)
+        self.channel = None
+        self.captures = {}
+        self.channel_cpu_time = 0.0
+        # Side displaying the screen filmed by this side, and whether the state machine of this side is running
+        self.peer = None
+        self.running = True
+        # Identifier of the last displayed frame, which is presented as soon as it is sent. The rendered frames are
+        # copied by the simulated camera, so a single reusable frame is enough
+        self.frame_id = 0
+        self.layout = FiducialLayout(CV_GUI_Handler.WIDTH, CV_GUI_Handler.HEIGHT, Constants.FIDUCIAL_MARKERS,
+                                     Constants.FIDUCIAL_SIZE)
+        self.renderer = SymbolRenderer(self.layout.data_width, self.layout.data_height, 0)
+        self.render_frame = self.layout.new_frame()
+
+    def kill(self):
+        self.running = False
+
+    def send_new_frame(self, new_frame) -> int:
+        self.frame = simulate_camera(new_frame)
+        self.history.append((_get_time(), self.frame))
+        self.frame_id += 1
+        return self.frame_id
+
+    def get_presentation_time(self, frame_id):
+        if frame_id == self.frame_id:
+            return self.history[-1][0]
+        return None
+
+    def prerender_hsv_colors(self, hsv_cols):
+        pass
+
+    def display_bgr_color(self, bgr_col):
+        """Displays the given color on the whole screen"""
+        color_frame = self.layout.new_frame()
+        self.layout.get_data_view(color_frame)[:] = bgr_col
+        return self.send_new_frame(color_frame)
+
+    def display_hsv_color(self, hsv_col):
+        """Converts the given color from HSV to BGR, and displays it"""
+        converted_color = cv2.cvtColor(np.array([[[hsv_col, 255, 255]]], dtype=np.uint8), cv2.COLOR_HSV2BGR)
+        color_frame = self.layout.new_frame()
+        self.layout.get_data_view(color_frame)[:] = converted_color
+        return self.send_new_frame(color_frame)
+
+    def display_hsv_grid(self, color_matrix):
+        """Displays a grid of hues, each cell of the screen showing the corresponding color matrix entry"""
+        self.renderer.render_hue_grid(color_matrix, self.layout.get_data_view(self.render_frame))
+        return self.send_new_frame(self.render_frame)
+
+    def display_symbol_grid(self, symbol_indices, hues):
+        """Displays a grid of symbols, with the palette lookup of the display"""
+        self.renderer.render_symbol_grid(symbol_indices, hues, self.layout.get_data_view(self.render_frame))
+        return self.send_new_frame(self.render_frame)
+
+    def black_out(self):
+        return self.send_new_frame(self.layout.template)
+
+    def display_hsv_frame(self, hsvframe):
+        resized_frame = scm.imresize(hsvframe, (Constants.WIDTH, Constants.HEIGHT), interp='bilinear')
+        resized_frame = cv2.cvtColor(resized_frame, cv2.COLOR_HSV2BGR)
+        return self.send_new_frame(resized_frame)
+
+    def readHSVFrame(self) -> Tuple[bool, np.ndarray]:
+        if self.channel is not None:
+            return True, _read_channel_frame(self, self.peer)
+
+        # The displayed frames are already filmed by the simulated camera when they are sent
+        return True, _rectify(self, self.peer.frame)
+
+    def readHSVFrameAt(self, timestamp) -> Tuple[bool, np.ndarray]:
+        if self.channel is not None:
+            return True, _read_channel_frame(self, self.peer, timestamp)
+
+        # The ideal simulated camera has no frame history
+        return self.readHSVFrame()
+
+    def readHSVFramesBetween(self, start_time, end_time) -> List[np.ndarray]:
+        if self.channel is not None:
+            return _read_channel_frames_between(self, self.peer, start_time, end_time)
+        return [self.readHSVFrame()[1]]
+
+    def readHSVFramesSince(self, sequence_number) -> List[Tuple[int, float, np.ndarray]]:
+        if self.channel is not None:
+            return _read_channel_frames_since(self, self.peer, sequence_number)
+        return []
+
+    def is_frame_valid(self, sequence_number) -> bool:
+        # The simulated frames are computed when they are read, and never overwritten
+        return True
+
+    def set_channel(self, channel):
+        """Channel through which the camera of this side films the other screen, None for the ideal camera"""
+        self.channel = channel
+        self.captures = {}
+        self.channel_cpu_time = 0.0
+
+    def set_screen_boundaries(self, bounds):
+        self.screen_boundaries = bounds
+
+    def get_camera_name(self):
+        return "simulated camera"
+
+    def get_display_name(self):
+        return "simulated display"
+
+    def get_exposure_settings(self):
+        return {}
+
+    def set_exposure_settings(self, settings):
+        pass
 
-        def set_screen_boundaries(self, bounds):
-            self.screen_boundaries = bounds
+    def set_screen_corners(self, corners):
+        self.homography = get_rectifying_homography(corners, Constants.RECTIFIED_WIDTH, Constants.RECTIFIED_HEIGHT)
 
-        def __getattr__(self, item):
-            return getattr(self.rcvrInst, item)
 
-        def __setattr__(self, name, value):
-            return setattr(self.rcvrInst, name, value)
+class SimulationHandler:
+    """
+    Simulated transmitter and receiver sides of one link: each side displays its frames on its simulated screen, and
+    films the screen of the other side with its simulated camera
+    """
 
+    def __init__(self):
+        self.tmtr = SimulatedSide()
+        self.rcvr = SimulatedSide()
+        self.tmtr.peer = self.rcvr
+        self.rcvr.peer = self.tmtr
+
+
+def run_state_machine(name, constructor, results, clock):
+    """
+    Thread target running a transmitter or a receiver until it exits, and recording it in the results. A crash is
+    recorded as the exception, in results[name + '_error'], and stops the clock at once, as the other state machines
+    would wait for the crashed one until the time limit (the virtual clock runs ahead of the polling of the results)
+    """
+    try:
+        state_machine = constructor()
+        results[name] = state_machine
+        state_machine.run()
+    except (SystemExit, SimulationStopped):
+        pass
+    except Exception as e:
+        logging.exception("The " + name + " crashed")
+        results[name + '_error'] = e
+        if clock is not None:
+            clock.stop()
+    finally:
+        if name in results:
+            results[name + '_end_time'] = results[name].clock.time()
+            results[name + '_cpu_time'] = time.thread_time()
+        if clock is not None:
+            clock.unregister()
+
+
+def get_crashed_names(results) -> List[str]:
+    """Names of the state machines of the results that crashed"""
+    return [name[:-len('_error')] for name in list(results) if name.endswith('_error')]
+
+
+def run_simulation(file_name, output_file_name, headless=True, max_duration=600.0, channels=None,
+                   instrumentation_output=None) -> dict:
+    """
+    Runs a full transmitter/receiver session. In headless mode, the state machines use a virtual clock, so that the
+    session runs as fast as the CPU allows, and nothing is displayed.
+
+    :param file_name: file to transmit
+    :param output_file_name: file written by the receiver
+    :param headless: use the virtual clock and the null display backend instead of the GUI and the wall clock
+    :param max_duration: (virtual) time after which the session is aborted, in seconds
+    :param channels: optional (transmitter channel, receiver channel), the ChannelModel through which the camera of
+    each side films the other screen
+    :param instrumentation_output: optional prefix of the Chrome trace (.json) and Prometheus (.prom) files written
+    with the instrumentation of both state machines
+    :return: statistics of the session, which is aborted as soon as a state machine crashes
+    """
+    if os.path.exists(output_file_name):
+        os.remove(output_file_name)
+
+    clock = None
+    if headless:
+        # Debug captures would be written to disk at each frame read
+        Constants.DEBUG = False
+        clock = VirtualClock()
+        cv_handler = NullDisplayHandler()
+    else:
+        cv_handler = OpenCvHandler()
+    Constants.CLOCK = clock
+    if instrumentation_output is not None:
+        Constants.INSTRUMENTATION = True
 
-def main():
     Constants.SIMULATE = True
-
     simulation_handler = SimulationHandler()
     Constants.SIMULATION_HANDLER = simulation_handler
+    if channels is not None:
+        simulation_handler.tmtr.set_channel(channels[0])
+        simulation_handler.rcvr.set_channel(channels[1])
 
-    cv_handler = OpenCvHandler()
     cv_handler.send_new_frame(simulation_handler.rcvr.frame)
 
-    rcvr_thread = threading.Thread(target=receiver.main)
-    rcvr_thread.setDaemon(True)
-    rcvr_thread.start()
-
-    tmtr_thread = threading.Thread(target=transmitter.main)
-    tmtr_thread.setDaemon(True)
-    tmtr_thread.start()
+    results = {}
+    threads = [threading.Thread(target=run_state_machine,
+                                args=('receiver', lambda: receiver.Receiver(output_file_name), results, clock),
+                                daemon=True),
+               threading.Thread(target=run_state_machine,
+                                args=('transmitter', lambda: transmitter.Transmitter(file_name), results, clock),
+                                daemon=True)]
+
+    wall_start_time = time.time()
+    for thread in threads:
+        if clock is not None:
+            clock.register()
+        thread.start()
+
+    while (simulation_handler.tmtr.running or simulation_handler.rcvr.running) and \
+            any(thread.is_alive() for thread in threads):
+        if clock is not None and clock.time() > max_duration:
+            logging.error("Simulation aborted after " + str(max_duration) + " seconds")
+            clock.stop()
+            break
+        if len(get_crashed_names(results)) > 0:
+            logging.error("Simulation aborted, as the " + ", ".join(get_crashed_names(results)) + " crashed")
+            if clock is not None:
+                clock.stop()
+            break
 
-    while run_flag1 or run_flag2:
         # main window shows what the transmitter is displaying, secondary shows what the receiver is displaying
         cv_handler.send_new_frame(simulation_handler.tmtr.frame)
         cv_handler.send_scnd_new_frame(simulation_handler.rcvr.frame)
-        sleep(0.1)
+        sleep(0.01 if headless else 0.1)
+
+    for thread in threads:
+        thread.join(1.0)
+    wall_time = time.time() - wall_start_time
 
     logging.info("Simulation terminated")
     cv_handler.kill()
-    sys.exit(0)
+    Constants.CLOCK = None
+
+    instrumentations = [results[name].instrumentation for name in ('transmitter', 'receiver') if name in results]
+    if instrumentation_output is not None:
+        write_chrome_trace(instrumentation_output + ".json", instrumentations)
+        write_prometheus_text(instrumentation_output + ".prom", instrumentations)
+
+    return _get_statistics(file_name, output_file_name, results, wall_time)
+
+
+def _get_statistics(file_name, output_file_name, results, wall_time) -> dict:
+    sent_data = b''
+    if os.path.exists(file_name):
+        with open(file_name, "rb") as f:
+            sent_data = f.read()
+    received_data = b''
+    if os.path.exists(output_file_name):
+        with open(output_file_name, "rb") as f:
+            received_data = f.read()
+
+    tmtr = results.get('transmitter')
+    rcvr = results.get('receiver')
+    session_time = max(results.get('transmitter_end_time', 0.0), results.get('receiver_end_time', 0.0))
+
+    # The goodput is computed over the data phase of the transmitter, which ends when all the packets are acknowledged
+    data_time = 0.0
+    if tmtr is not None:
+        data_time = sum(tmtr.state_times.get(state, 0.0) for state in
+                        (transmitter.State.SEND, transmitter.State.WAIT_FOR_ACK))
+
+    # Symbol and packet error rates over the packet slots in which the transmitter sent a packet (the receiver
+    # decodes one packet per slot)
+    symbol_count = symbol_error_count = packet_count = packet_error_count = 0
+    if tmtr is not None and rcvr is not None:
+        for sent, received, corrected_count in zip(tmtr.sent_symbol_log, rcvr.received_symbol_log,
+                                                   rcvr.corrected_error_counts):
+            if sent is None:
+                continue
+            symbol_count += len(sent)
+            symbol_error_count += int(np.count_nonzero(np.asarray(sent) != np.asarray(received[:len(sent)])))
+            packet_count += 1
+            packet_error_count += corrected_count is None
+
+    # The receiver thread also simulates its camera channel, which is not part of the decoding time
+    decoding_cpu_time = results.get('receiver_cpu_time', 0.0) - Constants.SIMULATION_HANDLER.rcvr.channel_cpu_time
+    decoded_symbol_count = sum(len(symbols) for symbols in rcvr.received_symbol_log) if rcvr else 0
+
+    return {
+        'success': len(get_crashed_names(results)) == 0 and os.path.exists(output_file_name) and
+                   received_data == sent_data,
+        'crashed': get_crashed_names(results),
+        'file_size': len(sent_data),
+        'received_size': len(received_data),
+        'session_time': session_time,
+        'data_time': data_time,
+        'goodput': 8.0 * len(received_data) / data_time if data_time > 0 else 0.0,
+        'symbol_error_rate': symbol_error_count / symbol_count if symbol_count > 0 else None,
+        'packet_error_rate': packet_error_count / packet_count if packet_count > 0 else None,
+        'decoding_cpu_time': decoding_cpu_time,
+        'cpu_time_per_symbol': decoding_cpu_time / decoded_symbol_count if decoded_symbol_count > 0 else None,
+        'num_bits': tmtr.num_bits if tmtr is not None else None,
+        'symbol_period': tmtr.symbol_period if tmtr is not None else None,
+        'packet_count': tmtr.packet_count if tmtr is not None else 0,
+        'retransmission_count': tmtr.retransmission_count if tmtr is not None else 0,
+        'corrected_error_count': sum(c for c in rcvr.corrected_error_counts if c is not None) if rcvr else 0,
+        'wall_time': wall_time,
+        'transmitter_state_times': {state.value: t for state, t in tmtr.state_times.items()} if tmtr else {},
+        'receiver_state_times': {state.value: t for state, t in rcvr.state_times.items()} if rcvr else {},
+    }
+
+
+def print_statistics(stats):
+    print("Transmission " + ("succeeded" if stats['success'] else "FAILED") + ": received " +
+          str(stats['received_size']) + "/" + str(stats['file_size']) + " bytes")
+    if len(stats['crashed']) > 0:
+        print("Crashed: " + ", ".join(stats['crashed']))
+    print("Goodput: " + str(round(stats['goodput'], 2)) + " bit/s over " + str(round(stats['data_time'], 2)) +
+          " s of data phase")
+    print("Modulation: " + str(stats['num_bits']) + " bits per symbol, symbol period of " +
+          str(stats['symbol_period']) + " s")
+    print("Packets: " + str(stats['packet_count']) + ", retransmissions: " + str(stats['retransmission_count']) +
+          ", corrected bytes: " + str(stats['corrected_error_count']))
+    print("Symbol error rate: " + str(stats['symbol_error_rate']) + ", packet error rate: " +
+          str(stats['packet_error_rate']) + ", CPU time per symbol: " + str(stats['cpu_time_per_symbol']) + " s")
+    print("Session time: " + str(round(stats['session_time'], 2)) + " s, simulated in " +
+          str(round(stats['wall_time'], 2)) + " s")
+    for side in ('transmitter', 'receiver'):
+        for state, t in stats[side + '_state_times'].items():
+            print("  " + side + " " + state + ": " + str(round(t, 3)) + " s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates a transmission between a transmitter and a receiver")
+    parser.add_argument('--file', default="../data/dummyText1.txt", help="file to transmit")
+    parser.add_argument('--output', default="../decoded.txt", help="file written by the receiver")
+    parser.add_argument('--gui', action='store_true', help="display the screens, and run in real time")
+    parser.add_argument('--max-duration', type=float, default=600.0, help="simulated time limit, in seconds")
+    parser.add_argument('--channel-seed', type=int, default=None, help="simulate a random channel with this seed")
+    parser.add_argument('--channel-severity', type=float, default=1.0, help="scale of the channel impairments")
+    parser.add_argument('--frame-rate', type=float, default=60.0, help="nominal camera frame rate")
+    parser.add_argument('--trace', default=None, help="prefix of the Chrome trace and Prometheus files to write")
+    args = parser.parse_args()
+
+    channels = None
+    if args.channel_seed is not None:
+        channels = (get_random_channel(args.channel_seed, args.channel_severity, args.frame_rate),
+                    get_random_channel(args.channel_seed + 1, args.channel_severity, args.frame_rate))
+
+    if not args.gui:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    stats = run_simulation(args.file, args.output, headless=not args.gui, max_duration=args.max_duration,
+                           channels=channels, instrumentation_output=args.trace)
+    print_statistics(stats)
+    sys.exit(0 if stats['success'] else 1)
 
 
 if __name__ == '__main__':